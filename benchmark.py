@@ -0,0 +1,585 @@
+"""Reproducible end-to-end benchmark of the generation pipeline, no GPU needed.
+
+Starts a fake Ollama and one or more fake ComfyUI servers, points the real
+pipeline from ``comic_core`` at them and generates strips in every requested
+mode and concurrency level::
+
+    python benchmark.py --modes pipelined streaming --concurrency 1 4 --strips 8
+
+For each scenario it reports throughput, strip latency percentiles, time to
+the first image, the HTTP requests each strip cost (``/history`` polls
+included), per-stage means from the tracer and peak memory. Results are
+written as JSON under ``benchmark_results/`` (named after the commit) so runs
+can be compared with ``--compare``. Caches are bypassed so every strip is
+really written and rendered.
+
+The ``preview`` mode renders quick previews of every panel first and then
+finishes them at full quality; its first image is the first preview. Give
+the fake servers a ``--step-latency`` so render time follows steps and size.
+Every scenario also reports the share of prompt encoders the servers served
+from their node cache; ``--encode-latency`` and ``--comfyui-cache-lru`` set
+what an encoder costs and how many node results each fake server keeps.
+
+``--templating 100 1000 5000`` instead measures building per-panel workflows
+from synthetic graphs of that many nodes, compiled template against the old
+deep copy and full-graph scan.
+
+``--startup`` instead measures how long ``comic_core`` and the app take to
+import in a fresh interpreter (and which heavy dependencies that pulls in),
+and how long a Streamlit rerun of the app takes against a ComfyUI that
+answers after ``--response-delay`` seconds.
+
+``--parser [CORPUS]`` instead times script parsing, the old regex parser
+against the single-pass one, and counts the strips each parses completely
+and the panels whose dialogue each loses.
+CORPUS is a directory of saved scripts or a JSON lines file with a
+``script`` (as written by ``comic_batch.py``) or ``response`` field; without
+it a synthetic corpus in the layouts the model writes is used.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from streamlit.testing.v1 import AppTest
+except ImportError:
+    AppTest = None  # Rerun latency is only measured with Streamlit installed
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+import comic_core as cc
+import image_cache
+import ollama_client
+import tracing
+import workflow_template
+from comic_batch import percentile
+from fake_comfyui import FakeComfyUI
+from fake_ollama import FakeOllama, tokenize
+
+MODES = ("sequential", "pipelined", "batched", "streaming", "preview")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results")
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "comiccrafter.py")
+STARTUP_MODULES = ("comic_core", "comiccrafter")
+HEAVY_MODULES = ("requests", "PIL", "websocket", "streamlit")
+
+
+def run_strip(mode, topic, workflow_json, config, timeout):
+    """Generates one strip and returns its latency, first image time and panel count."""
+    start = time.perf_counter()
+    first_image = None
+    previews_done = None
+    panels_done = 0
+    if mode == "streaming":
+        results = cc.generate_strip_streaming(topic, workflow_json, config, timeout, use_cache=False,
+                                              script_cache=False)
+    else:
+        _, panels = cc.write_script(topic, use_cache=False)
+        if mode == "sequential":
+            results = ((panel, cc.generate_panel_image(panel, workflow_json, config, use_cache=False))
+                       for panel in panels)
+        elif mode == "batched":
+            results = cc.generate_panels_batched(panels, workflow_json, config, timeout, use_cache=False)
+        elif mode == "preview":
+            previews = []
+            for panel, panel_image in cc.generate_panels_pipelined(panels, workflow_json,
+                                                                   cc.preview_config(config, workflow_json),
+                                                                   timeout, use_cache=False):
+                if panel_image:
+                    previews.append(dict(panel, image=panel_image, quality=cc.PREVIEW))
+                    if first_image is None:
+                        first_image = time.perf_counter() - start
+            previews_done = time.perf_counter() - start
+            results = ((preview, panel and panel["image"]) for preview, panel in
+                       cc.finish_panels(previews, workflow_json, config, timeout, use_cache=False))
+        else:
+            results = cc.generate_panels_pipelined(panels, workflow_json, config, timeout, use_cache=False)
+    for panel, panel_image in results:
+        if panel_image:
+            panels_done += 1
+            if first_image is None:
+                first_image = time.perf_counter() - start
+    return {"latency": time.perf_counter() - start, "first_image": first_image, "previews": previews_done,
+            "panels": panels_done}
+
+
+def request_counts(fakes):
+    totals = Counter()
+    for fake in fakes:
+        totals.update(fake.request_counts)
+    return totals
+
+
+def run_scenario(mode, concurrency, args, comfyui_fakes, ollama_fake):
+    """Runs ``args.strips`` strips in ``mode`` with ``concurrency`` at a time."""
+    tracing.metrics = tracing.Metrics()
+    workflow_json = cc.load_custom_workflow()
+    config = {
+        "model_path": cc.DEFAULT_MODEL,
+        "width": args.width,
+        "height": args.height,
+        "steps": args.steps,
+        "cfg": 7.5,
+        "seed": args.seed,
+        "sampler": "euler",
+        "scheduler": "normal"
+    }
+    topics = [f"benchmark {mode} {concurrency} strip {i}" for i in range(args.strips)]
+    before = request_counts(comfyui_fakes)
+    ollama_before = sum(ollama_fake.request_counts.values())
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        strips = list(executor.map(lambda topic: run_strip(mode, topic, workflow_json, config, args.timeout), topics))
+    elapsed = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    requests_made = request_counts(comfyui_fakes) - before
+    completed = [strip for strip in strips if strip["panels"] == cc.PANEL_COUNT]
+    latencies = [strip["latency"] for strip in completed]
+    first_images = [strip["first_image"] for strip in strips if strip["first_image"] is not None]
+    previews = [strip["previews"] for strip in strips if strip["previews"] is not None]
+    histograms, counters = tracing.metrics.snapshot()
+    encodes = counters.get("conditioning_hits", 0) + counters.get("conditioning_misses", 0)
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "strips": len(strips),
+        "completed": len(completed),
+        "elapsed": elapsed,
+        "strips_per_hour": len(completed) / elapsed * 3600 if elapsed else 0.0,
+        "latency": {f"p{int(q * 100)}": percentile(latencies, q) for q in (0.5, 0.95, 0.99)},
+        "first_image": {f"p{int(q * 100)}": percentile(first_images, q) for q in (0.5, 0.95)},
+        "all_previews": {f"p{int(q * 100)}": percentile(previews, q) for q in (0.5, 0.95)} if previews else None,
+        "requests_per_strip": {endpoint: count / len(strips) for endpoint, count in sorted(requests_made.items())},
+        "ollama_requests": sum(ollama_fake.request_counts.values()) - ollama_before,
+        "conditioning_hit_rate": counters.get("conditioning_hits", 0) / encodes if encodes else None,
+        "stage_means": {stage: total / count for stage, (count, total, _) in sorted(histograms.items()) if count},
+        "peak_traced_memory_mb": peak_memory / 1024 ** 2,
+    }
+
+
+def large_workflow(nodes):
+    """Builds a valid text-to-image graph of about ``nodes`` nodes (a long LoRA chain)."""
+    workflow = {"ckpt": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": cc.DEFAULT_MODEL}}}
+    model, clip = ["ckpt", 0], ["ckpt", 1]
+    for i in range(max(1, nodes - 7)):
+        workflow[f"lora{i}"] = {"class_type": "LoraLoader", "inputs": {
+            "model": model, "clip": clip, "lora_name": f"style_{i}.safetensors",
+            "strength_model": 0.5, "strength_clip": 0.5}}
+        model, clip = [f"lora{i}", 0], [f"lora{i}", 1]
+    workflow.update({
+        "positive": {"class_type": "CLIPTextEncode", "inputs": {"text": "A beautiful landscape", "clip": clip}},
+        "negative": {"class_type": "CLIPTextEncode", "inputs": {"text": "ugly, blurry", "clip": clip}},
+        "latent": {"class_type": "EmptyLatentImage", "inputs": {"width": 768, "height": 768, "batch_size": 1}},
+        "sampler": {"class_type": "KSampler", "inputs": {
+            "model": model, "positive": ["positive", 0], "negative": ["negative", 0], "latent_image": ["latent", 0],
+            "seed": 0, "steps": 30, "cfg": 7.5, "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0}},
+        "decode": {"class_type": "VAEDecode", "inputs": {"samples": ["sampler", 0], "vae": ["ckpt", 2]}},
+        "save": {"class_type": "SaveImage", "inputs": {"filename_prefix": "bench", "images": ["decode", 0]}},
+    })
+    return workflow
+
+
+def legacy_panel_workflow(panel, workflow, config):
+    """The per-panel build the template replaced: full deep copy, full scan, full hash."""
+    workflow = json.loads(json.dumps(workflow))
+    for node in workflow.values():
+        if node["class_type"] in ("Empty Latent Image", "EmptyLatentImage"):
+            node["inputs"]["width"] = config["width"]
+            node["inputs"]["height"] = config["height"]
+        elif node["class_type"] == "KSampler":
+            node["inputs"].update(steps=config["steps"], cfg=config["cfg"], seed=config["seed"] + panel["number"],
+                                  sampler_name=config["sampler"], scheduler=config["scheduler"])
+        elif node["class_type"] == "CheckpointLoaderSimple":
+            node["inputs"]["ckpt_name"] = config["model_path"]
+    for node_id, node in workflow.items():
+        if node["class_type"] == "CLIPTextEncode" and "neg" not in node_id.lower():
+            if "ugly" not in node["inputs"].get("text", "").lower():
+                node["inputs"]["text"] = f"comic panel, cartoon style, {panel['prompt']}"
+    return workflow, image_cache.workflow_key(workflow)
+
+
+def benchmark_templating(sizes, panels=4, repeat=20):
+    """Times per-panel workflow building on synthetic graphs of each size."""
+    config = {"model_path": cc.DEFAULT_MODEL, "width": 512, "height": 512, "steps": 20, "cfg": 7.5, "seed": 1,
+              "sampler": "euler", "scheduler": "normal"}
+    strip = [{"number": n, "prompt": f"panel {n}"} for n in range(1, panels + 1)]
+    results = []
+    for size in sizes:
+        workflow = large_workflow(size)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            template = workflow_template.WorkflowTemplate(workflow)
+        compile_time = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for panel in strip:
+                legacy_panel_workflow(panel, workflow, config)
+        legacy_time = (time.perf_counter() - start) / (repeat * panels)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for panel in strip:
+                template.render(f"comic panel, cartoon style, {panel['prompt']}",
+                                settings=dict(config, seed=config["seed"] + panel["number"]))
+        template_time = (time.perf_counter() - start) / (repeat * panels)
+
+        results.append({"nodes": len(workflow), "compile_ms": compile_time * 1000,
+                        "legacy_panel_ms": legacy_time * 1000, "template_panel_ms": template_time * 1000,
+                        "speedup": legacy_time / template_time if template_time else 0.0})
+        print(f"{len(workflow):6} nodes  compile {compile_time * 1000:8.2f} ms  "
+              f"per panel: legacy {legacy_time * 1000:8.3f} ms, template {template_time * 1000:8.3f} ms "
+              f"({results[-1]['speedup']:.0f}x)")
+    return results
+
+
+def legacy_parse_comic_script(script):
+    """The parser the single-pass one replaced: DOTALL regex, first '-' split, line-by-line fallback."""
+    def make_panel(panel_num, content):
+        parts = content.split('-', 1)
+        visual, dialogue = (parts[0].strip(), parts[1].strip()) if len(parts) > 1 else (content.strip(), "")
+        return {"number": int(panel_num), "visual": visual, "dialogue": dialogue, "prompt": visual}
+
+    panels = [make_panel(n, content) for n, content in re.findall(r"Panel (\d+):(.*?)(?=Panel \d+:|$)", script, re.DOTALL)]
+    if len(panels) < 4:
+        current_panel = None
+        for line in script.split('\n'):
+            if line.strip():
+                if line.lower().startswith("panel"):
+                    try:
+                        panel_num = int(re.search(r"Panel (\d+)", line, re.IGNORECASE).group(1))
+                        content = line.split(':', 1)[1].strip() if ':' in line else ""
+                        current_panel = {"number": panel_num, "visual": content, "dialogue": "", "prompt": content}
+                        panels.append(current_panel)
+                    except Exception:
+                        pass
+                elif current_panel and not line.startswith("Panel"):
+                    current_panel["dialogue"] += " " + line.strip()
+                    current_panel["prompt"] += " " + line.strip()
+    while len(panels) < 4:
+        panels.append({"number": len(panels) + 1, "visual": "Comic scene", "dialogue": "Missing panel content",
+                       "prompt": "Comic scene"})
+    panels.sort(key=lambda x: x["number"])
+    return panels[:4]
+
+
+CORPUS_TOPICS = ("a cat who learns to skateboard", "the office coffee machine rebelling", "a dragon afraid of fire",
+                 "two robots on a first date", "grandma's high-tech kitchen", "a snail in a race")
+CORPUS_SCENES = (("wide-angle shot of {topic} in a sunny park", "Well, this is new."),
+                 ("close-up of the main character's wide-eyed face", "Wait, what?!"),
+                 ("mid-air chaos, speed lines everywhere, a well-timed crash", "Not again!"),
+                 ("everyone laughing at sunset, a half-eaten sandwich on the bench", "Same time tomorrow?"))
+
+
+def corpus_script(layout, topic, rng, panels=4):
+    """Writes one script in one of the layouts Mistral produces for the app's prompt and the Modelfile."""
+    scenes = [(visual.format(topic=topic), text) for visual, text in CORPUS_SCENES[:panels]]
+    if layout == "json":
+        return json.dumps({"panels": [{"prompt": f"comic style, {visual}", "description": visual.split(",")[0],
+                                       "text": text} for visual, text in scenes]}, indent=2)
+    if layout == "json_list":
+        return json.dumps([{"panel": n, "prompt": f"comic style, {visual}", "description": visual.split(",")[0],
+                            "text": text} for n, (visual, text) in enumerate(scenes, 1)])
+    if layout == "fenced":
+        return f"Here is your comic about {topic}:\n\n```json\n" + corpus_script("json", topic, rng, panels) + "\n```"
+    if layout == "modelfile":
+        roles = ("Introduction", "Main Storyline", "Climax", "Moral or Punchline")
+        return f"Here is a comic about {topic}:\n\n" + "\n\n".join(
+            f"{n}. **Panel {n} ({roles[n - 1]}):**\n   - Image Prompt: comic style, {visual}\n"
+            f"   - Image Description: {visual.split(',')[0]}\n   - Text: \"{text}\""
+            for n, (visual, text) in enumerate(scenes, 1))
+    if layout == "bold":
+        return f"**Title: {topic.title()}**\n\n" + "\n\n".join(
+            f"**Panel {n}:** {visual}.\n{rng.choice(('Cat', 'Narrator', 'Bob'))}: \"{text}\""
+            for n, (visual, text) in enumerate(scenes, 1)) + "\n\nI hope you enjoy it!"
+    if layout == "labeled":
+        return "".join(f"Panel {n}: {rng.choice(('Scene', 'Setting'))}: {visual} at 5:00 - \"{text}\"\n"
+                       for n, (visual, text) in enumerate(scenes, 1))
+    if layout == "truncated":
+        return "".join(f"Panel {n}: {visual} - \"{text}\"\n" for n, (visual, text) in enumerate(scenes[:2], 1))
+    return "".join(f"Panel {n}: {visual} - \"{text}\"\n" for n, (visual, text) in enumerate(scenes, 1))
+
+
+def sample_corpus(size, seed=1):
+    """Builds ``size`` scripts spread over every layout, one in ten of them cut short."""
+    rng = random.Random(seed)
+    layouts = ("plain", "modelfile", "bold", "json", "plain", "modelfile", "labeled", "json_list", "fenced",
+               "truncated")
+    return [corpus_script(layouts[i % len(layouts)], rng.choice(CORPUS_TOPICS), rng) for i in range(size)]
+
+
+def load_corpus(path):
+    """Reads scripts from a directory of text files or a JSON lines file (``script`` or ``response`` field)."""
+    if os.path.isdir(path):
+        scripts = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".txt", ".md", ".json")):
+                with open(os.path.join(path, name), encoding="utf-8") as f:
+                    scripts.append(f.read())
+        return scripts
+    scripts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            script = record.get("script") or record.get("response")
+            if script:
+                scripts.append(script)
+    return scripts
+
+
+def split_words(script, panels):
+    """Counts panels whose dialogue was cut off the visual at the hyphen of a word like 'close-up'."""
+    return sum(1 for panel in panels
+               if re.search(r"\w$", panel["visual"]) and re.match(r"\w", panel["dialogue"])
+               and f"{panel['visual'][-12:]}-{panel['dialogue'][:12]}" in script)
+
+
+def lost_dialogue(script, panels):
+    """Counts panels drawn without the dialogue the script gave them."""
+    return sum(1 for panel in panels if not panel["dialogue"] and panel["number"] <= script.count("anel"))
+
+
+def benchmark_parser(scripts, repeat=20):
+    """Times both parsers on ``scripts`` and counts the strips each would draw correctly."""
+    tokenized = [tokenize(script) for script in scripts]
+    results = {"scripts": len(scripts)}
+    for name, parse in (("legacy", legacy_parse_comic_script), ("single_pass", cc.parse_comic_script)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parsed = [parse(script) for script in scripts]
+        elapsed = (time.perf_counter() - start) / (repeat * len(scripts))
+        if name == "legacy":
+            # Placeholders are rendered as if they were panels
+            complete = sum(1 for panels in parsed if not any(p["dialogue"] == "Missing panel content" for p in panels))
+        else:
+            complete = sum(1 for panels in parsed if not cc.check_panels(panels))
+        results[name] = {"ms_per_script": elapsed * 1000, "complete": complete,
+                         "word_splits": sum(split_words(script, panels) for script, panels in zip(scripts, parsed)),
+                         "lost_dialogues": sum(lost_dialogue(script, panels)
+                                               for script, panels in zip(scripts, parsed))}
+        print(f"{name:>12} {elapsed * 1000:8.3f} ms/script  {complete}/{len(scripts)} complete  "
+              f"{results[name]['word_splits']} dialogues split inside a word  "
+              f"{results[name]['lost_dialogues']} dialogues lost")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for tokens in tokenized:
+            parser = cc.PanelStreamParser()
+            for token in tokens:
+                parser.feed(token)
+            parser.close()
+    elapsed = (time.perf_counter() - start) / (repeat * len(scripts))
+    results["streamed_ms_per_script"] = elapsed * 1000
+    print(f"{'streamed':>12} {elapsed * 1000:8.3f} ms/script  fed one token at a time")
+    return results
+
+
+def import_time(module, repeat=5):
+    """Returns the fastest import of ``module`` in a fresh interpreter and the heavy modules it loaded."""
+    code = (f"import sys, time, json; start = time.perf_counter(); import {module}; "
+            f"print(json.dumps([time.perf_counter() - start, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))")
+    best, heavy = None, []
+    for _ in range(repeat):
+        run = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed, heavy = json.loads(run.stdout.strip().splitlines()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    return best, heavy
+
+
+def rerun_latency(reruns, response_delay):
+    """Times Streamlit reruns of the app against a fake ComfyUI answering after ``response_delay``."""
+    fake = FakeComfyUI(render_latency=0.05, response_delay=response_delay).start()
+    cc.COMFYUI_HOST = fake.host
+    cc.COMFYUI_SERVERS = [fake.host]
+    try:
+        app = AppTest.from_file(APP_FILE, default_timeout=60)
+        start = time.perf_counter()
+        app.run()  # The first run also starts the health checks and the warm-up
+        first_run = time.perf_counter() - start
+        times = []
+        for _ in range(reruns):
+            start = time.perf_counter()
+            app.run()
+            times.append(time.perf_counter() - start)
+    finally:
+        fake.stop()
+    return {"response_delay": response_delay, "first_run": first_run,
+            "rerun": {f"p{int(q * 100)}": percentile(times, q) for q in (0.5, 0.95)},
+            "status_requests": fake.request_counts["/"]}
+
+
+def benchmark_startup(reruns, response_delay):
+    """Measures module import times and app rerun latency."""
+    result = {"imports": {}}
+    for module in STARTUP_MODULES:
+        elapsed, heavy = import_time(module)
+        result["imports"][module] = {"seconds": elapsed, "heavy_modules": heavy}
+        print(f"import {module:<14} {elapsed * 1000:8.1f} ms  loads: {', '.join(heavy) or 'nothing heavy'}")
+    if AppTest is None:
+        print("Streamlit is not installed, skipping rerun latency")
+        return result
+    result["reruns"] = rerun_latency(reruns, response_delay)
+    print(f"app first run {result['reruns']['first_run'] * 1000:8.1f} ms  rerun p50 "
+          f"{result['reruns']['rerun']['p50'] * 1000:.1f} ms  p95 {result['reruns']['rerun']['p95'] * 1000:.1f} ms  "
+          f"status probes {result['reruns']['status_requests']} in {reruns + 1} runs "
+          f"(server answering after {response_delay * 1000:.0f} ms)")
+    return result
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        return commit or None, bool(dirty)
+    except OSError:
+        return None, False
+
+
+def compare(previous, current):
+    """Prints throughput and median latency changes for scenarios in both runs."""
+    before = {(s["mode"], s["concurrency"]): s for s in previous["scenarios"]}
+    print(f"\nCompared with {previous['meta'].get('commit') or 'unknown commit'}:")
+    for scenario in current["scenarios"]:
+        old = before.get((scenario["mode"], scenario["concurrency"]))
+        if not old:
+            continue
+        throughput = (scenario["strips_per_hour"] / old["strips_per_hour"] - 1) * 100 if old["strips_per_hour"] else 0
+        latency = (scenario["latency"]["p50"] / old["latency"]["p50"] - 1) * 100 if old["latency"]["p50"] else 0
+        print(f"  {scenario['mode']:>10} x{scenario['concurrency']:<3} throughput {throughput:+.1f}%, "
+              f"p50 latency {latency:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the comic pipeline against fake backends.")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=["pipelined", "streaming"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4], help="strips generated at once")
+    parser.add_argument("--strips", type=int, default=8, help="strips per scenario")
+    parser.add_argument("--servers", type=int, default=2, help="fake ComfyUI servers")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per fake render")
+    parser.add_argument("--render-steps", type=int, default=10, help="progress events per fake render")
+    parser.add_argument("--step-latency", type=float, default=0.0,
+                        help="extra fake render seconds per sampler step and megapixel")
+    parser.add_argument("--encode-latency", type=float, default=0.0, help="seconds per fake prompt encoder run")
+    parser.add_argument("--comfyui-cache-lru", type=int, default=cc.COMFYUI_CACHE_LRU,
+                        help="node results each fake server keeps (0 = only the last prompt's)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of fake renders that fail")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="fake Ollama writing speed")
+    parser.add_argument("--ollama-parallel", type=int, default=1, help="scripts the fake Ollama writes at once")
+    parser.add_argument("--max-in-flight", type=int, default=0, help="panels rendering per server (0 = unlimited)")
+    parser.add_argument("--polling", action="store_true", help="poll /history instead of using the WebSocket")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300, help="seconds allowed per strip")
+    parser.add_argument("--output", help="result file (default: benchmark_results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--templating", nargs="+", type=int, metavar="NODES",
+                        help="benchmark workflow templating on graphs of these sizes instead of the pipeline")
+    parser.add_argument("--startup", action="store_true",
+                        help="benchmark import time and app rerun latency instead of the pipeline")
+    parser.add_argument("--reruns", type=int, default=20, help="app reruns timed by --startup")
+    parser.add_argument("--response-delay", type=float, default=0.2,
+                        help="seconds the fake ComfyUI takes to answer during --startup")
+    parser.add_argument("--parser", nargs="?", const="", metavar="CORPUS",
+                        help="benchmark script parsing on CORPUS (or a synthetic one) instead of the pipeline")
+    parser.add_argument("--corpus-size", type=int, default=210, help="scripts in the synthetic --parser corpus")
+    args = parser.parse_args()
+
+    if args.templating or args.startup or args.parser is not None:
+        commit, dirty = git_commit()
+        result = {"meta": {"commit": commit, "dirty": dirty, "python": sys.version.split()[0],
+                           "time": datetime.datetime.now(datetime.timezone.utc).isoformat()}, "scenarios": []}
+        if args.templating:
+            result["templating"] = benchmark_templating(args.templating)
+        if args.startup:
+            result["startup"] = benchmark_startup(args.reruns, args.response_delay)
+        if args.parser is not None:
+            scripts = load_corpus(args.parser) if args.parser else sample_corpus(args.corpus_size)
+            result["parser"] = benchmark_parser(scripts)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+        return
+
+    ollama_fake = FakeOllama(tokens_per_second=args.tokens_per_second, parallel=args.ollama_parallel).start()
+    comfyui_fakes = [FakeComfyUI(render_latency=args.latency, steps=args.render_steps,
+                                 failure_rate=args.failure_rate, seed=args.seed + i,
+                                 step_latency=args.step_latency, encode_latency=args.encode_latency,
+                                 cache_size=args.comfyui_cache_lru).start()
+                     for i in range(args.servers)]
+    ollama_client.OLLAMA_URL = ollama_fake.url
+    cc.COMFYUI_SERVERS = [fake.host for fake in comfyui_fakes]
+    cc.MAX_IN_FLIGHT_PER_SERVER = args.max_in_flight
+    cc.USE_WEBSOCKET = not args.polling
+
+    commit, dirty = git_commit()
+    result = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "scenarios": [],
+    }
+    try:
+        for mode in args.modes:
+            for concurrency in args.concurrency:
+                scenario = run_scenario(mode, concurrency, args, comfyui_fakes, ollama_fake)
+                result["scenarios"].append(scenario)
+                print(f"{mode:>10} x{concurrency:<3} {scenario['strips_per_hour']:8.0f} strips/h  "
+                      f"p50 {scenario['latency']['p50']:.2f}s  p95 {scenario['latency']['p95']:.2f}s  "
+                      f"first image p50 {scenario['first_image']['p50']:.2f}s  "
+                      + (f"all previews p50 {scenario['all_previews']['p50']:.2f}s  " if scenario["all_previews"] else "")
+                      + f"{scenario['completed']}/{scenario['strips']} ok  "
+                      f"encodes reused {scenario['conditioning_hit_rate'] or 0:.0%}  "
+                      f"history/strip {scenario['requests_per_strip'].get('history', 0):.1f}  "
+                      f"peak {scenario['peak_traced_memory_mb']:.1f} MB")
+    finally:
+        for fake in comfyui_fakes:
+            fake.stop()
+        ollama_fake.stop()
+    if resource is not None:
+        result["meta"]["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    output = args.output
+    if not output:
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{(commit or 'nocommit')[:8]}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Pooled HTTP client for the ComfyUI API.
+
+One ``ComfyUIClient`` per server owns a keep-alive ``requests.Session``, so
+prompt submissions, history reads, queue probes and image downloads reuse TCP
+connections instead of opening one per call. Each endpoint has its own
+timeout, idempotent requests are retried with exponential back-off, and
+images are streamed from /view in chunks. Request counts and a latency
+histogram per endpoint are kept for every client.
+"""
+import threading
+import time
+
+import lazy
+
+requests = lazy.module("requests")  # Imported by the first client
+
+# Seconds before a request to each endpoint gives up
+DEFAULT_TIMEOUTS = {
+    "status": 1,
+    "prompt": 10,
+    "history": 5,
+    "view": 30,
+    "queue": 2,
+    "upload": 30,
+    "cancel": 2,
+}
+RETRIES = 2  # Retries for connection errors and 502/503/504 answers
+BACKOFF = 0.3  # Seconds; doubled after every retry
+POOL_SIZE = 16  # Kept-alive connections per server
+CHUNK_SIZE = 64 * 1024  # Bytes read per chunk when streaming images
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+
+class EndpointStats:
+    """Request count, error count and latency histogram for one endpoint."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def record(self, seconds, error):
+        self.count += 1
+        self.seconds += seconds
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def as_dict(self):
+        return {"count": self.count, "errors": self.errors, "seconds": self.seconds, "buckets": list(self.buckets)}
+
+
+def percentile(buckets, q):
+    """Returns the histogram bucket bound below which a fraction ``q`` of requests fall."""
+    total = sum(buckets)
+    if not total:
+        return 0.0
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, buckets):
+        seen += count
+        if seen >= q * total:
+            return bound
+    return LATENCY_BUCKETS[-1]
+
+
+class ComfyUIClient:
+    """Keep-alive client for one ComfyUI server."""
+
+    def __init__(self, host, timeouts=None, retries=RETRIES, backoff=BACKOFF, pool_size=POOL_SIZE):
+        self.host = host
+        self.base_url = f"http://{host}"
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),  # Never resubmit a prompt that may have been queued
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _request(self, endpoint, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts[endpoint])
+        start = time.perf_counter()
+        error = True
+        try:
+            response = self.session.request(method, self.base_url + path, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            with self._stats_lock:
+                self.stats.setdefault(endpoint, EndpointStats()).record(time.perf_counter() - start, error)
+
+    def status(self):
+        """Checks whether the server answers on /."""
+        try:
+            return self._request("status", "GET", "/").status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def queue_prompt(self, prompt, client_id):
+        """Submits a workflow and returns ComfyUI's JSON answer."""
+        return self._request("prompt", "POST", "/prompt", json={"prompt": prompt, "client_id": client_id}).json()
+
+    def history(self, prompt_id):
+        """Returns the /history entry mapping for ``prompt_id``."""
+        return self._request("history", "GET", f"/history/{prompt_id}").json()
+
+    def queue(self):
+        """Returns the running and pending queue."""
+        response = self._request("queue", "GET", "/queue")
+        response.raise_for_status()
+        return response.json()
+
+    def delete_queued(self, prompt_ids):
+        """Removes prompts that have not started yet from the queue."""
+        response = self._request("cancel", "POST", "/queue", json={"delete": list(prompt_ids)})
+        response.raise_for_status()
+
+    def interrupt(self, prompt_id):
+        """Stops ``prompt_id`` if it is the prompt running now."""
+        response = self._request("cancel", "POST", "/interrupt", json={"prompt_id": prompt_id})
+        response.raise_for_status()
+
+    def iter_view(self, filename, subfolder="", folder_type="output", chunk_size=CHUNK_SIZE):
+        """Streams an output image from /view in chunks."""
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        with self._request("view", "GET", "/view", params=params, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
+
+    def upload_image(self, path, name):
+        """Uploads the image file at ``path`` to the input folder as ``name`` and returns ComfyUI's answer.
+
+        An existing file of that name is overwritten, so uploading the same
+        image twice is harmless.
+        """
+        with open(path, "rb") as f:
+            response = self._request("upload", "POST", "/upload/image", files={"image": (name, f, "image/png")},
+                                     data={"overwrite": "true"})
+        response.raise_for_status()
+        return response.json()
+
+    def snapshot(self):
+        """Returns a copy of the per-endpoint request statistics."""
+        with self._stats_lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in self.stats.items()}
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host):
+    """Returns the shared client for ``host`` so its connections are reused."""
+    with _clients_lock:
+        client = _clients.get(host)
+        if client is None:
+            client = _clients[host] = ComfyUIClient(host)
+        return client
+
+
+def total_stats():
+    """Sums the per-endpoint statistics of every client."""
+    with _clients_lock:
+        clients = list(_clients.values())
+    totals = {}
+    for client in clients:
+        for endpoint, stats in client.snapshot().items():
+            total = totals.setdefault(endpoint, {"count": 0, "errors": 0, "seconds": 0.0,
+                                                 "buckets": [0] * len(LATENCY_BUCKETS)})
+            total["count"] += stats["count"]
+            total["errors"] += stats["errors"]
+            total["seconds"] += stats["seconds"]
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], stats["buckets"])]
+    return totals
@@ -0,0 +1,193 @@
+"""Event-driven ComfyUI completion tracking over the /ws?clientId= stream.
+
+ComfyUI pushes ``executing``, ``progress``, ``executed`` and error messages to
+every WebSocket opened with the same client id that was sent to /prompt. The
+listener below keeps one socket per server open in a background thread and
+records the state of every prompt it hears about, so callers can block until
+their prompt finishes instead of polling /history.
+
+The ``websocket-client`` package is optional. Without it (or while the socket
+is down) ``connected`` stays False and callers fall back to polling.
+"""
+import json
+import threading
+import time
+import uuid
+
+import lazy
+
+websocket = lazy.module("websocket", optional=True)  # pip install websocket-client
+
+# Stable for the whole process so Streamlit reruns keep receiving their events
+CLIENT_ID = str(uuid.uuid4())
+
+RECONNECT_DELAY = 1  # Seconds before the first reconnect attempt
+MAX_RECONNECT_DELAY = 30  # Upper bound for the reconnect back-off
+STATE_TTL = 600  # Seconds a finished prompt's state is kept if nobody collects it
+
+
+class PromptState:
+    """What the listener knows about a single prompt."""
+
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+        self.node = None
+        self.outputs = {}
+        self.error = None
+        self.done = False
+        self.started_at = None
+        self.finished_at = None
+
+
+class ComfyUIEventListener:
+    """Background WebSocket client that tracks prompt progress and completion."""
+
+    def __init__(self, ws_url, client_id=CLIENT_ID):
+        self.ws_url = ws_url
+        self.client_id = client_id
+        self.connected = False
+        self._states = {}
+        self._current_prompt = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stop = threading.Event()
+        self._ws = None
+
+    def start(self):
+        """Starts the listener thread if websocket-client is available."""
+        if websocket is None or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="comfyui-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the listener thread and closes the socket."""
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while not self._stop.is_set():
+            try:
+                ws = websocket.WebSocket()
+                ws.connect(f"{self.ws_url}?clientId={self.client_id}", timeout=5)
+                ws.settimeout(None)
+                self._ws = ws
+                self.connected = True
+                delay = RECONNECT_DELAY
+                while not self._stop.is_set():
+                    message = ws.recv()
+                    if isinstance(message, str):  # Binary frames are latent previews
+                        self._handle(json.loads(message))
+            except Exception:
+                pass
+            finally:
+                self.connected = False
+                self._ws = None
+                with self._condition:
+                    self._condition.notify_all()
+            self._stop.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _state(self, prompt_id):
+        state = self._states.get(prompt_id)
+        if state is None:
+            state = self._states[prompt_id] = PromptState()
+        return state
+
+    def _handle(self, message):
+        """Applies one ComfyUI event to the tracked prompt states."""
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id") or self._current_prompt
+
+        with self._condition:
+            if msg_type == "execution_start":
+                self._current_prompt = data.get("prompt_id")
+                self._state(self._current_prompt).started_at = time.time()
+            elif msg_type == "executing" and prompt_id:
+                state = self._state(prompt_id)
+                if data.get("node") is None:
+                    self._finish(state)
+                    self._current_prompt = None
+                else:
+                    self._current_prompt = prompt_id
+                    state.node = data["node"]
+                    if state.started_at is None:
+                        state.started_at = time.time()
+            elif msg_type == "progress" and prompt_id:
+                state = self._state(prompt_id)
+                state.value = data.get("value", 0)
+                state.max = data.get("max", 0)
+            elif msg_type == "executed" and prompt_id:
+                self._state(prompt_id).outputs[str(data.get("node"))] = data.get("output") or {}
+            elif msg_type == "execution_success" and prompt_id:
+                self._finish(self._state(prompt_id))
+            elif msg_type in ("execution_error", "execution_interrupted") and prompt_id:
+                state = self._state(prompt_id)
+                state.error = data.get("exception_message") or msg_type
+                self._finish(state)
+            else:
+                return
+            self._condition.notify_all()
+
+    def _finish(self, state):
+        if not state.done:
+            state.done = True
+            state.finished_at = time.time()
+        self._prune()
+
+    def _prune(self):
+        cutoff = time.time() - STATE_TTL
+        for prompt_id in [p for p, s in self._states.items() if s.done and s.finished_at < cutoff]:
+            del self._states[prompt_id]
+
+    def wait(self, prompt_id, timeout, on_progress=None):
+        """Blocks until the prompt finishes, the socket drops or ``timeout`` passes.
+
+        Returns the prompt's ``PromptState`` once it is done, otherwise None.
+        ``on_progress(value, max)`` is called on the waiting thread whenever
+        the sampler reports a new step.
+        """
+        deadline = time.time() + timeout
+        last_progress = None
+        with self._condition:
+            while True:
+                state = self._states.get(prompt_id)
+                if state is not None:
+                    progress = (state.value, state.max)
+                    if on_progress and state.max and progress != last_progress:
+                        last_progress = progress
+                        on_progress(*progress)
+                    if state.done:
+                        return state
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.connected:
+                    return None
+                self._condition.wait(remaining)
+
+    def forget(self, prompt_id):
+        """Drops the state of a prompt whose result has been collected."""
+        with self._condition:
+            self._states.pop(prompt_id, None)
+
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def get_listener(ws_url):
+    """Returns the running listener for ``ws_url``, starting it on first use."""
+    with _listeners_lock:
+        listener = _listeners.get(ws_url)
+        if listener is None:
+            listener = _listeners[ws_url] = ComfyUIEventListener(ws_url)
+        listener.start()
+        return listener
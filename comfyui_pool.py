@@ -0,0 +1,169 @@
+"""Pool of ComfyUI servers with least-loaded dispatch and health checks.
+
+Every backend is probed through ``/queue`` on a background thread. The queue
+depth it reports, plus the prompts dispatched to it since that probe, is the
+backend's load; ``acquire`` hands out the healthy backend with the lowest
+load. Backends that fail ``max_failures`` times in a row, or whose probe
+fails, are ejected and re-admitted as soon as a probe succeeds again. With
+``max_in_flight`` set, ``acquire`` waits rather than exceed that many
+concurrent renders on a backend. A ``prefer`` backend, e.g. the one that
+already encoded a panel's prompt, wins unless it is more than
+``AFFINITY_SLACK`` prompts busier than the least-loaded one.
+"""
+import threading
+import time
+
+import comfyui_client
+from comfyui_client import requests
+
+HEALTH_INTERVAL = 5  # Seconds between /queue probes
+MAX_FAILURES = 3  # Consecutive failed renders before a backend is ejected
+AFFINITY_SLACK = 1  # Extra load a preferred backend may carry and still be chosen
+
+
+class ComfyUIBackend:
+    """One ComfyUI server and what the pool knows about its load."""
+
+    def __init__(self, host):
+        self.host = host
+        self.healthy = True
+        self.queue_depth = 0
+        self.dispatched = 0  # Prompts sent since the last probe
+        self.in_flight = 0
+        self.failures = 0
+        self.last_checked = None
+
+    @property
+    def load(self):
+        return self.queue_depth + self.dispatched
+
+    def __repr__(self):
+        return f"ComfyUIBackend({self.host!r}, healthy={self.healthy}, load={self.load})"
+
+
+class BackendPool:
+    """Dispatches renders across several ComfyUI servers."""
+
+    def __init__(self, hosts, health_interval=HEALTH_INTERVAL, max_failures=MAX_FAILURES, max_in_flight=None):
+        self.backends = [ComfyUIBackend(host) for host in hosts]
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Condition()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts the background health checker."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="comfyui-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.health_interval):
+            self.refresh()
+
+    def probe(self, backend):
+        """Reads a backend's queue depth, ejecting or re-admitting it."""
+        try:
+            queue = comfyui_client.get_client(backend.host).queue()
+            depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+        except (requests.exceptions.RequestException, ValueError):
+            with self._lock:
+                backend.healthy = False
+                backend.last_checked = time.time()
+            return False
+        with self._lock:
+            backend.queue_depth = depth
+            backend.dispatched = 0
+            backend.failures = 0
+            backend.healthy = True
+            backend.last_checked = time.time()
+            self._lock.notify_all()
+        return True
+
+    def refresh(self):
+        """Probes every backend once."""
+        for backend in self.backends:
+            self.probe(backend)
+
+    def healthy_backends(self):
+        with self._lock:
+            return [backend for backend in self.backends if backend.healthy]
+
+    def acquire(self, exclude=(), timeout=None, prefer=None):
+        """Reserves the least-loaded healthy backend not in ``exclude``, or None.
+
+        The backend whose host is ``prefer`` counts as ``AFFINITY_SLACK``
+        less loaded. If every candidate is at ``max_in_flight``, waits up to
+        ``timeout`` seconds (forever if None) for one to free up.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                candidates = [b for b in self.backends if b.healthy and b.host not in exclude]
+                if not candidates:
+                    return None
+                if self.max_in_flight:
+                    free = [b for b in candidates if b.in_flight < self.max_in_flight]
+                else:
+                    free = candidates
+                if free:
+                    backend = min(free, key=lambda b: (b.load - (AFFINITY_SLACK if b.host == prefer else 0),
+                                                       b.host != prefer, b.in_flight))
+                    backend.dispatched += 1
+                    backend.in_flight += 1
+                    return backend
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def release(self, backend, success):
+        """Returns a backend after a render; repeated failures eject it.
+
+        ``success`` None leaves the failure count alone, e.g. for a workflow
+        the server rejected, which says nothing about its health.
+        """
+        with self._lock:
+            backend.in_flight = max(0, backend.in_flight - 1)
+            if success:
+                backend.failures = 0
+            elif success is not None:
+                backend.failures += 1
+                if backend.failures >= self.max_failures:
+                    backend.healthy = False
+            self._lock.notify_all()
+
+    def has_candidates(self, exclude=()):
+        with self._lock:
+            return any(b.healthy and b.host not in exclude for b in self.backends)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(hosts, max_in_flight=None):
+    """Returns the running pool for ``hosts``, starting its health checks on first use.
+
+    A new pool is probed before anyone sees it, but outside the lock, so a
+    slow server does not hold up callers asking for other pools.
+    """
+    key = tuple(hosts)
+    with _pools_lock:
+        pool = _pools.get(key)
+    if pool is None:
+        pool = BackendPool(hosts, max_in_flight=max_in_flight)
+        pool.refresh()
+        with _pools_lock:
+            pool = _pools.setdefault(key, pool)  # Another thread may have published one meanwhile
+    with _pools_lock:
+        pool.max_in_flight = max_in_flight
+        pool.start()
+        return pool
@@ -0,0 +1,247 @@
+"""Headless batch generation of comic strips, without Streamlit.
+
+Reads one topic per line from a file (or stdin) and renders a strip for
+each one::
+
+    python comic_batch.py topics.txt --output strips.jsonl --concurrency 4
+
+Results are appended to the ``--output`` JSON lines file as each strip
+finishes, and panel images are saved under ``--images-dir``. Running the
+same command again skips topics already in the output, so an interrupted
+batch resumes where it stopped. Throughput and per-stage latency are
+printed at the end; ``--trace-file`` also keeps the detailed trace of every
+strip.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import comic_core as cc
+import image_store
+import job_queue
+import tracing
+
+STAGES = ("script", "panels", "total")
+TRACED_STAGES = ("llm", "queue_prompt", "comfyui_queue_wait", "comfyui_execution", "download")
+
+
+class ConsoleProgress(cc.Progress):
+    """Prints pipeline messages to stderr."""
+
+    def info(self, message):
+        print(message, file=sys.stderr)
+
+    def success(self, message):
+        print(message, file=sys.stderr)
+
+    def warning(self, message):
+        print(f"Warning: {message}", file=sys.stderr)
+
+    def error(self, message):
+        print(f"Error: {message}", file=sys.stderr)
+
+
+def read_topics(path):
+    """Returns the non-empty, non-comment lines of ``path`` ("-" for stdin)."""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith("#")]
+
+
+def load_completed(path):
+    """Returns the keys of strips already written successfully to ``path``."""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash; the strip is generated again
+            if not record.get("error"):
+                completed.add(record["key"])
+    return completed
+
+
+def percentile(values, q):
+    """Returns the nearest-rank percentile ``q`` (0-1) of ``values``."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def run_strip(topic, key, args, config, workflow_json, script_slots, progress):
+    """Writes and renders one strip, returning its output record."""
+    timings = {}
+    start = time.perf_counter()
+    with script_slots:
+        script, panels = cc.write_script(topic, args.panels, args.structured or None, not args.no_cache)
+    timings["script"] = time.perf_counter() - start
+
+    strip_dir = os.path.join(args.images_dir, key[:16])
+    os.makedirs(strip_dir, exist_ok=True)
+
+    panels_start = time.perf_counter()
+    if args.batched:
+        panel_results = cc.generate_panels_batched(panels, workflow_json, config, args.timeout,
+                                                   not args.no_cache, progress)
+    else:
+        panel_results = cc.generate_panels_pipelined(panels, workflow_json, config, args.timeout, not args.no_cache)
+    results = []
+    try:
+        with image_store.strip(key):
+            for panel, panel_image in panel_results:
+                if not panel_image:
+                    continue
+                image_path = os.path.join(strip_dir, f"panel_{panel['number']}.png")
+                image_store.save_image(panel_image, image_path)
+                results.append(dict(panel, image_path=image_path))
+    finally:
+        cc.get_image_store().discard(key)
+    timings["panels"] = time.perf_counter() - panels_start
+    timings["total"] = time.perf_counter() - start
+
+    record = {"key": key, "topic": topic, "script": script, "timings": timings,
+              "panels": sorted(results, key=lambda x: x["number"])}
+    if not results:
+        record["error"] = "Failed to generate any comic panels"
+    elif len(results) < len(panels):
+        record["error"] = f"Only {len(results)} of {len(panels)} panels were generated"
+    return record
+
+
+def traced_strip(topic, key, *args):
+    """Runs ``run_strip`` inside its own trace."""
+    with tracing.trace("strip", "strips", topic=topic, key=key):
+        return run_strip(topic, key, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate comic strips for a list of topics.")
+    parser.add_argument("topics", nargs="?", default="-", help="file with one topic per line, - for stdin")
+    parser.add_argument("--output", default="strips.jsonl", help="JSON lines file results are appended to")
+    parser.add_argument("--images-dir", default="batch_images")
+    parser.add_argument("--concurrency", type=int, default=2, help="strips generated at once")
+    parser.add_argument("--script-concurrency", type=int, default=1, help="scripts written at once")
+    parser.add_argument("--max-in-flight", type=int, default=2, help="panels rendering per ComfyUI server")
+    parser.add_argument("--timeout", type=float, default=cc.STRIP_TIMEOUT, help="seconds allowed per strip")
+    parser.add_argument("--workflow", help="ComfyUI workflow JSON to use instead of the default")
+    parser.add_argument("--batched", action="store_true", help="render each strip as one ComfyUI job")
+    parser.add_argument("--panels", type=int, default=cc.PANEL_COUNT, help="panels per strip")
+    parser.add_argument("--structured", action="store_true", help="ask Ollama for the panels as JSON")
+    parser.add_argument("--no-cache", action="store_true", help="do not reuse cached scripts or images")
+    parser.add_argument("--no-warm-up", action="store_true", help="do not load the model before timing strips")
+    parser.add_argument("--model", default=cc.DEFAULT_MODEL)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--cfg", type=float, default=7.5)
+    parser.add_argument("--seed", type=int, default=0, help="0 for a time-based seed")
+    parser.add_argument("--sampler", default="euler_a")
+    parser.add_argument("--scheduler", default="normal")
+    parser.add_argument("--trace-file", default=tracing.TRACE_FILE, help="append strip traces to this JSON lines file")
+    parser.add_argument("--no-tracing", action="store_true", help="do not record traces or stage metrics")
+    args = parser.parse_args()
+    tracing.TRACE_FILE = args.trace_file
+    tracing.enabled = not args.no_tracing
+
+    progress = ConsoleProgress()
+    config = {
+        "model_path": args.model,
+        "width": args.width,
+        "height": args.height,
+        "steps": args.steps,
+        "cfg": args.cfg,
+        "seed": args.seed,
+        "sampler": args.sampler,
+        "scheduler": args.scheduler
+    }
+    # Keys are taken before a random seed is picked so a resumed run recognises finished strips
+    key_fields = {"config": config, "batched": args.batched}
+    if args.panels != cc.PANEL_COUNT:
+        key_fields["panels"] = args.panels  # Keeps the keys of earlier 4-panel runs
+    keys = {topic: job_queue.dedupe_key(dict(key_fields, topic=topic)) for topic in read_topics(args.topics)}
+    if not config["seed"]:
+        config["seed"] = int(time.time())
+
+    completed = load_completed(args.output)
+    pending = [(topic, key) for topic, key in keys.items() if key not in completed]
+    print(f"{len(keys)} topics, {len(keys) - len(pending)} already done, {len(pending)} to generate",
+          file=sys.stderr)
+    if not pending:
+        return
+
+    if not cc.check_server_status():
+        progress.error("ComfyUI server is not running. Please start it first.")
+        sys.exit(1)
+    workflow_json = cc.load_custom_workflow(args.workflow, progress)
+    if not workflow_json:
+        progress.error("No workflow available.")
+        sys.exit(1)
+
+    cc.MAX_IN_FLIGHT_PER_SERVER = args.max_in_flight
+    if not args.no_warm_up:
+        # Load the model on every server first so the first strips do not pay for it
+        pool = cc.get_backend_pool()
+        pool.refresh()
+        hosts = [backend.host for backend in pool.backends if backend.healthy]
+        warm_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, len(hosts))) as executor:
+            warm = sum(executor.map(lambda host: cc.warm_up(host, args.model, workflow_json), hosts))
+        print(f"{warm}/{len(hosts)} servers warmed up in {time.perf_counter() - warm_start:.1f}s", file=sys.stderr)
+
+    script_slots = threading.Semaphore(args.script_concurrency)
+    timings = {stage: [] for stage in STAGES}
+    done = failed = 0
+    start = time.perf_counter()
+
+    with open(args.output, "a", encoding="utf-8") as output, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {
+            executor.submit(traced_strip, topic, key, args, config, workflow_json, script_slots, progress): (topic, key)
+            for topic, key in pending
+        }
+        for future in as_completed(futures):
+            topic, key = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"key": key, "topic": topic, "error": str(e)}
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            os.fsync(output.fileno())
+            if record.get("error"):
+                failed += 1
+                print(f"[{done + failed}/{len(pending)}] {topic}: {record['error']}", file=sys.stderr)
+            else:
+                done += 1
+                for stage in STAGES:
+                    timings[stage].append(record["timings"][stage])
+                print(f"[{done + failed}/{len(pending)}] {topic}: {record['timings']['total']:.1f}s", file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(f"{done} strips done, {failed} failed in {elapsed:.1f}s "
+          f"({done / elapsed * 3600 if elapsed else 0:.1f} strips/hour)")
+    for stage in STAGES:
+        print(f"  {stage}: p50 {percentile(timings[stage], 0.5):.1f}s, p95 {percentile(timings[stage], 0.95):.1f}s")
+    histograms, counters = tracing.metrics.snapshot()
+    for stage in TRACED_STAGES:
+        if stage in histograms:
+            count, total, _ = histograms[stage]
+            print(f"  {stage}: {count}x, mean {total / count:.2f}s")
+    for name, value in sorted(counters.items()):
+        print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
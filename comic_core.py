@@ -0,0 +1,1577 @@
+"""Core comic generation pipeline, importable without Streamlit.
+
+Script writing (Ollama), script parsing, workflow building and everything
+that talks to ComfyUI lives here, so the Streamlit app, the background
+worker and the batch CLI share one implementation. Functions that used to
+draw Streamlit elements report through a ``Progress`` object instead; the
+default one ignores every update.
+"""
+import subprocess
+import time
+import hashlib
+import json
+import os
+import threading
+import re
+import queue
+import random
+import tempfile
+import comfyui_client
+import comfyui_events
+import comfyui_pool
+import image_cache
+import image_store
+import job_queue
+import ollama_client
+import tracing
+import workflow_template
+from comfyui_client import requests
+from workflow_template import is_node_link
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+# --- Progress Reporting ---
+
+class Progress:
+    """Receives status messages and progress from the pipeline.
+
+    The base class ignores everything. The Streamlit app shows updates as
+    page elements and the batch CLI prints them; worker threads use the
+    silent default.
+    """
+    def info(self, message):
+        pass
+
+    def success(self, message):
+        pass
+
+    def warning(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+    def update(self, fraction, message=None):
+        """Reports how far the current render is, from 0.0 to 1.0."""
+        pass
+
+SILENT = Progress()
+
+# --- Ollama Comic Generator ---
+
+# Ollama HTTP API settings; the CLI is only used when the API cannot be reached
+OLLAMA_MODEL = "comiccrafter"  # Use your custom model or "mistral"
+OLLAMA_KEEP_ALIVE = ollama_client.DEFAULT_KEEP_ALIVE  # Keeps the model loaded between strips
+PANEL_COUNT = 4  # Panels per strip unless asked otherwise
+MAX_PANELS = 8
+# "json" asks Ollama for panels constrained to script_schema() instead of free text
+STRUCTURED_SCRIPTS = os.environ.get("COMICCRAFTER_SCRIPT_FORMAT", "text") == "json"
+SCRIPT_ATTEMPTS = 3  # Scripts written per strip before a malformed one is given up on
+SCRIPT_ERROR = "Error generating comic"
+SCRIPT_UPDATE_INTERVAL = 0.25  # Seconds between on_script() updates while a script streams in
+
+class ScriptError(Exception):
+    """Raised when no script could be written that describes every panel."""
+
+def build_script_prompt(prompt, panel_count=PANEL_COUNT, structured=False):
+    """Wraps a comic topic in the script-writing instructions."""
+    if structured:
+        return (f"Generate a {panel_count}-panel comic strip script about: {prompt}. Answer in JSON with a "
+                f"\"panels\" list of {panel_count} objects, each holding the image \"prompt\" (a detailed "
+                "description for the image model), a short image \"description\" and the \"text\" beneath "
+                "the panel. Make each panel concise and visual.")
+    return f"Generate a {panel_count}-panel comic strip script about: {prompt}. Please format it as 'Panel 1: [description of visual scene] - [character dialogue/text]', and so on for all {panel_count} panels. Make each panel concise and visual."
+
+def build_completion_prompt(prompt, script, missing, panel_count=PANEL_COUNT, structured=False):
+    """Asks for only the ``missing`` panel numbers of a script that was cut short."""
+    numbers = f"panel{'s' if len(missing) > 1 else ''} {', '.join(str(n) for n in missing)}"
+    if structured:
+        layout = (f"answering in JSON with a \"panels\" list of {len(missing)} objects, each holding the image "
+                  "\"prompt\" (a detailed description for the image model), a short image \"description\" and "
+                  "the \"text\" beneath the panel")
+    else:
+        layout = "formatted as 'Panel N: [description of visual scene] - [character dialogue/text]'"
+    return (f"Continue this {panel_count}-panel comic strip script about: {prompt}. Write only {numbers} of this "
+            f"same story, {layout}. Make each panel concise and visual. The script so far:\n\n{script}")
+
+def script_schema(panel_count=PANEL_COUNT):
+    """Returns the JSON schema structured scripts are constrained to, the Modelfile's three fields per panel."""
+    panel = {
+        "type": "object",
+        "properties": {field: {"type": "string"} for field in ("prompt", "description", "text")},
+        "required": ["prompt", "description", "text"]
+    }
+    return {
+        "type": "object",
+        "properties": {"panels": {"type": "array", "items": panel, "minItems": panel_count, "maxItems": panel_count}},
+        "required": ["panels"]
+    }
+
+def ollama_command(model, structured=False):
+    """Returns the CLI command used when the HTTP API cannot be reached."""
+    return ["ollama", "run", model] + (["--format", "json"] if structured else [])
+
+# Function to generate comic script using Ollama
+def generate_comic(prompt, options=None, use_cache=True, keep_alive=OLLAMA_KEEP_ALIVE, panel_count=PANEL_COUNT,
+                   structured=False):
+    full_prompt = build_script_prompt(prompt, panel_count, structured)
+    output_format = script_schema(panel_count) if structured else None
+    return ask_ollama(full_prompt, options, use_cache, keep_alive, output_format)
+
+def ask_ollama(full_prompt, options=None, use_cache=True, keep_alive=OLLAMA_KEEP_ALIVE, output_format=None):
+    """Returns the model's answer to ``full_prompt``, or ``SCRIPT_ERROR`` and the reason it failed."""
+    model = OLLAMA_MODEL
+    structured = output_format is not None
+
+    with tracing.span("llm", model=model) as span:
+        # Prefer the HTTP API: pooled connection, resident model and cached results
+        try:
+            return ollama_client.generate(model, full_prompt, options, keep_alive, use_cache,
+                                          output_format=output_format).strip()
+        except ollama_client.OllamaError:
+            span.set(fallback="cli")
+
+        # Fall back to the Ollama CLI using 'run' instead of 'chat'
+        try:
+            result = subprocess.run(
+                ollama_command(model, structured),
+                input=full_prompt,
+                text=True,
+                capture_output=True
+            )
+        except OSError as e:
+            return f"{SCRIPT_ERROR}: {e}"  # No CLI installed either
+
+    if result.returncode == 0:
+        return result.stdout.strip()
+    else:
+        error_msg = result.stderr if result.stderr else "Unknown error occurred."
+        return f"{SCRIPT_ERROR}: {error_msg}"
+
+# Function to stream the comic script as it is written
+def stream_comic(prompt, options=None, use_cache=True, keep_alive=OLLAMA_KEEP_ALIVE, panel_count=PANEL_COUNT,
+                 structured=False):
+    """Yields the comic script in chunks as Ollama writes it."""
+    model = OLLAMA_MODEL
+    full_prompt = build_script_prompt(prompt, panel_count, structured)
+    output_format = script_schema(panel_count) if structured else None
+    produced = False
+
+    with tracing.span("llm", model=model, streamed=True) as span:
+        try:
+            for chunk in ollama_client.stream(model, full_prompt, options, keep_alive, use_cache,
+                                              output_format=output_format):
+                if not produced:
+                    span.set(first_chunk=time.time())
+                produced = True
+                yield chunk
+            return
+        except ollama_client.OllamaError:
+            if produced:
+                return  # Keep what was written before the connection dropped
+            span.set(fallback="cli")
+
+    # Fall back to the Ollama CLI, reading its output line by line
+    with tempfile.TemporaryFile(mode="w+") as stderr:
+        process = subprocess.Popen(
+            ollama_command(model, structured),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            text=True
+        )
+        process.stdin.write(full_prompt)
+        process.stdin.close()
+        for line in process.stdout:
+            produced = True
+            yield line
+        process.wait()
+
+        if process.returncode != 0 and not produced:
+            stderr.seek(0)
+            error_msg = stderr.read() or "Unknown error occurred."
+            yield f"{SCRIPT_ERROR}: {error_msg}"
+
+# Function to write a script that can actually be drawn
+def write_script(prompt, panel_count=PANEL_COUNT, structured=None, use_cache=True, keep_alive=OLLAMA_KEEP_ALIVE,
+                 attempts=SCRIPT_ATTEMPTS):
+    """Writes and parses a script, writing it again while it is malformed.
+
+    Returns (script, panels) once every panel has an image prompt, so no
+    render is ever queued for a broken script. Raises ``ScriptError`` when
+    Ollama fails or no attempt produced a usable script.
+    """
+    structured = STRUCTURED_SCRIPTS if structured is None else structured
+    problems = []
+    for attempt in range(attempts):
+        # A rewrite skips the cache and replaces the malformed script in it
+        script = generate_comic(prompt, use_cache=use_cache and not attempt, keep_alive=keep_alive,
+                                panel_count=panel_count, structured=structured)
+        if script.startswith(SCRIPT_ERROR):
+            raise ScriptError(script)
+        panels = parse_comic_script(script, panel_count)
+        problems = check_panels(panels, panel_count)
+        if not problems:
+            return script, panels
+        tracing.count("script_rewrites")
+    raise ScriptError(f"No usable script after {attempts} attempts ({'; '.join(problems)})")
+
+# Function to finish a script that was cut short
+def complete_script(prompt, script, panels, panel_count=PANEL_COUNT, structured=None, keep_alive=OLLAMA_KEEP_ALIVE,
+                    attempts=SCRIPT_ATTEMPTS):
+    """Asks the model for only the panels ``script`` lacks, keeping the ones it has.
+
+    Returns (script, panels) like ``write_script``, the script being the one
+    given followed by the model's answer. Raises ``ScriptError`` when Ollama
+    fails or no attempt supplied every missing panel.
+    """
+    structured = STRUCTURED_SCRIPTS if structured is None else structured
+    kept = {panel["number"]: panel for panel in panels if panel["prompt"]}
+    missing = [n for n in range(1, panel_count + 1) if n not in kept]
+    full_prompt = build_completion_prompt(prompt, script, missing, panel_count, structured)
+    output_format = script_schema(len(missing)) if structured else None
+    problems = []
+    for attempt in range(attempts):
+        answer = ask_ollama(full_prompt, use_cache=not attempt, keep_alive=keep_alive, output_format=output_format)
+        if answer.startswith(SCRIPT_ERROR):
+            raise ScriptError(answer)
+        found = parse_comic_script(answer, panel_count)
+        if not {panel["number"] for panel in found} <= set(missing):
+            # Numbered from 1 (as JSON panels always are); they fill the gaps in order
+            found = [dict(panel, number=n) for n, panel in zip(missing, found)]
+        completed = sorted(list(kept.values()) + [panel for panel in found if panel["number"] in missing],
+                           key=lambda x: x["number"])
+        problems = check_panels(completed, panel_count)
+        if not problems:
+            return f"{script.rstrip()}\n\n{answer}", completed
+        tracing.count("script_rewrites")
+    raise ScriptError(f"No usable completion after {attempts} attempts ({'; '.join(problems)})")
+
+# --- Script Parsing ---
+
+# 'Panel 2:', '**Panel 2 (Main Storyline):**', '2. panel 2 -', '### Panel 2', or 'Panel 2:' further along a line.
+# The pattern starts at the literal 'anel' so the regex engine can skip ahead to it; the rest is checked in
+# header_start().
+PANEL_HEADER = re.compile(r"anel[ \t]*(\d+)\b[ \t]*(?:\([^)\n]*\))?[ \t*_]*(:|[.\-–—](?=\s)|$)[ \t*_]*",
+                          re.MULTILINE)
+HEADER_PREFIX = " \t>#*_0123456789.)-"  # List numbers and markdown allowed before a header
+# 'Image Prompt:', '- **Text:**'... as laid out in the Modelfile
+FIELD_NAMES = {
+    "image prompt": "prompt", "prompt": "prompt",
+    "image description": "description", "description": "description", "visual": "description",
+    "scene": "description", "setting": "description",
+    "text": "text", "dialogue": "text", "caption": "text", "narration": "text"
+}
+LABEL_CHARS = " \t>*_•-"  # Bullets and markdown around a field label
+# A dash with spaces around it, or right before the quoted dialogue; never the one in 'close-up'
+DIALOGUE_SEPARATOR = re.compile(r"[-–—]{1,2}(?:(?:(?<=\s[-–—])|(?<=\s[-–—]{2}))\s+|\s*(?=[\"“]))")
+QUOTE = re.compile(r"[\"“]")
+SPEAKER = re.compile(r"(?:^|(?<=[.!?]))\s*[A-Z][\w' ]{0,30}:\s*$")  # 'Dog:' before its quoted line
+FENCE = re.compile(r"```[\w-]*[ \t]*\n")  # Opens a markdown code block, e.g. ```json
+
+def header_start(text, match):
+    """Returns where the header of a PANEL_HEADER match begins, or None for 'panel' inside a sentence."""
+    start = match.start() - 1
+    if start < 0 or text[start] not in "Pp":
+        return None
+    line_start = text.rfind("\n", 0, start) + 1
+    prefix = text[line_start:start]
+    if not prefix.strip(HEADER_PREFIX):
+        return line_start
+    return start if prefix[-1].isspace() and match.group(2) == ":" else None
+
+def clean_text(text):
+    """Collapses whitespace and drops markdown emphasis and template brackets."""
+    return " ".join(text.replace("**", "").split()).strip(" *_[]-–—")
+
+def split_dialogue(content):
+    """Splits a panel's free text into the visual description and the dialogue."""
+    parts = DIALOGUE_SEPARATOR.split(content.strip(), 1)
+    if len(parts) == 1:
+        # No separator: a quoted line at the end is still the dialogue
+        quote = QUOTE.search(content)
+        if quote and quote.start() and content.rstrip().endswith(("\"", "”")):
+            speaker = SPEAKER.search(content, 0, quote.start())
+            split_at = speaker.start() if speaker else quote.start()
+            parts = [content[:split_at].rstrip(" :,"), content[split_at:]]
+    visual = clean_text(parts[0])
+    dialogue = clean_text(parts[1]) if len(parts) > 1 else ""
+    return visual, dialogue
+
+def make_panel(panel_num, content, fields=None):
+    """Builds a panel dict from the text that follows its 'Panel N:' header.
+
+    ``fields`` holds the image prompt, description and text when the script
+    gives them separately; they take precedence over the free text.
+    """
+    fields = fields or {}
+    visual, dialogue = split_dialogue(content) if content else ("", "")
+    prompt = fields.get("prompt") or fields.get("description") or visual
+    return {
+        "number": int(panel_num),
+        "visual": fields.get("description") or visual or prompt,
+        "dialogue": fields.get("text") or dialogue,
+        "prompt": prompt  # Used as the image generation prompt
+    }
+
+def field_label(block, colon):
+    """Returns the field named before ``colon`` if it starts its line, e.g. '- **Image Prompt:**'."""
+    line_start = block.rfind("\n", 0, colon) + 1
+    return FIELD_NAMES.get(block[line_start:colon].strip(LABEL_CHARS).lower()), line_start
+
+def parse_panel(panel_num, block):
+    """Builds a panel from everything between its header and the next one."""
+    fields = {}
+    content = []
+    pos = 0
+    colon = block.find(":")
+    while colon >= 0:
+        name, line_start = field_label(block, colon)
+        if name is None or line_start < pos:
+            colon = block.find(":", colon + 1)
+            continue
+        content.append(block[pos:line_start])
+        line_end = block.find("\n", colon)
+        line_end = len(block) if line_end < 0 else line_end
+        value = clean_text(block[colon + 1:line_end])
+        if not value:
+            # The value is on the line after its label
+            next_start = line_end + 1
+            next_end = block.find("\n", next_start)
+            next_end = len(block) if next_end < 0 else next_end
+            following = block[next_start:next_end]
+            next_colon = following.find(":")
+            if following.strip() and (next_colon < 0 or field_label(following, next_colon)[0] is None):
+                value, line_end = clean_text(following), next_end
+        fields.setdefault(name, value)
+        pos = line_end
+        colon = block.find(":", pos)
+    content.append(block[pos:])
+    if fields.get("description") and "text" not in fields:
+        # 'Scene: a park - "Hi!"' carries its dialogue like an unlabeled panel does
+        fields["description"], dialogue = split_dialogue(fields["description"])
+        if dialogue:
+            fields["text"] = dialogue
+    return make_panel(panel_num, "".join(content).strip(), fields)
+
+def json_start(text):
+    """Tells from its first characters whether a script is JSON: an object, or a list of panel objects.
+
+    Returns None while there is too little text to tell.
+    """
+    text = text.lstrip()
+    if text[:1] == "[":
+        text = text[1:].lstrip()  # '[Title]' is text, '[{' a list of panels
+    return text[0] == "{" if text else None
+
+def json_panels(data):
+    """Returns the panels of a complete structured script."""
+    if isinstance(data, dict):
+        data = data.get("panels", next((value for value in data.values() if isinstance(value, list)), []))
+    if not isinstance(data, list):
+        return []
+    return [json_panel(n, values) for n, values in enumerate((v for v in data if isinstance(v, dict)), 1)]
+
+def json_panel(panel_num, values):
+    """Builds a panel from one object of a structured script."""
+    fields = {}
+    for key, value in values.items():
+        name = FIELD_NAMES.get(str(key).lower().replace("_", " "))
+        if name and value is not None and name not in fields:
+            fields[name] = clean_text(value if isinstance(value, str) else json.dumps(value))
+    return make_panel(panel_num, "", fields)
+
+class PanelStreamParser:
+    """Splits a script into panels in one pass, while it streams in.
+
+    In text scripts a 'Panel N' header (plain, numbered or in the Modelfile's
+    markdown) starts a panel, which is complete as soon as the next header
+    appears; its block is then read once for 'Image Prompt:' /
+    'Description:' / 'Text:' fields and free text. Scripts that start with
+    '{' or '[{', after any ```json fence, are structured, and each panel
+    object is decoded the moment its closing brace arrives. Only the panel
+    still being written is kept in the working buffer, and only its
+    unfinished line is looked at again when more text arrives, so the work
+    grows linearly with the script.
+    ``close()`` returns what is left when the stream ends.
+    """
+    JSON_TOKEN = re.compile(r"[{}\[\]\"]")
+    STRING_TOKEN = re.compile(r"[\"\\]")
+
+    def __init__(self):
+        self.chunks = []
+        self.structured = None  # Decided by the first character that is not whitespace
+        self._buffer = ""  # The text not yet turned into panels; offsets below are into it
+        self._scan_from = 0  # Where to look for the next header
+        self._header = None  # (number, end offset) of the header of the panel being read
+        self._pos = 0  # Next character of a structured script to scan
+        self._containers = []  # Open JSON objects and arrays
+        self._in_string = False
+        self._object_start = None  # (offset, depth) of the panel object being read
+        self._objects = 0
+
+    @property
+    def text(self):
+        """The whole script received so far."""
+        return "".join(self.chunks)
+
+    def feed(self, chunk):
+        """Adds streamed text and returns the panels it completed."""
+        self.chunks.append(chunk)
+        self._buffer += chunk
+        if self.structured is None:
+            stripped = self._buffer.lstrip()
+            if "```".startswith(stripped[:3]):
+                # A code fence, or the start of one: decide from the line after it
+                fence = FENCE.match(stripped)
+                stripped = stripped[fence.end():] if fence else ""
+            self.structured = json_start(stripped)
+            if self.structured is None:
+                return []
+            if self.structured:
+                self._buffer = stripped
+        return self._feed_json() if self.structured else self._feed_text()
+
+    def close(self):
+        """Returns the final panel once the stream has ended."""
+        if self.structured and not self._objects:
+            # Not JSON after all, e.g. a text script in braces: read it again as text
+            self.structured = False
+            self._buffer, self._scan_from = self.text, 0
+        if self.structured:
+            return []  # An object cut off by the end of the stream is not a panel
+        panels = self._feed_text(final=True)
+        if self._header:
+            panels.append(parse_panel(self._header[0], self._buffer[self._header[1]:]))
+            self._header = None
+        return panels
+
+    # --- Text scripts ---
+
+    def _feed_text(self, final=False):
+        panels = []
+        text = self._buffer
+        for match in PANEL_HEADER.finditer(text, self._scan_from):
+            if not final and not match.group(2) and match.end() == len(text):
+                break  # 'Panel 1' may still become 'Panel 12:'
+            start = header_start(text, match)
+            if start is None:
+                continue
+            if self._header:
+                panels.append(parse_panel(self._header[0], text[self._header[1]:start]))
+            self._header = (match.group(1), match.end())
+            self._scan_from = match.end()
+        # A header starts a line (or follows a space), so only the unfinished line is searched again
+        line_start = text.rfind("\n", self._scan_from) + 1
+        if line_start:
+            self._scan_from = line_start
+        # Drop what is already done: the finished panels, or a title before the first one
+        done = self._header[1] if self._header else self._scan_from
+        if done:
+            self._buffer = text[done:]
+            self._scan_from -= done
+            if self._header:
+                self._header = (self._header[0], 0)
+        return panels
+
+    # --- Structured scripts ---
+
+    def _feed_json(self):
+        panels = []
+        text = self._buffer
+        pos = self._pos
+        while True:
+            if self._in_string:
+                match = self.STRING_TOKEN.search(text, pos)
+                if not match:
+                    pos = len(text)
+                    break
+                if match.group() == "\\":
+                    if match.end() == len(text):
+                        pos = match.start()  # The escaped character has not arrived yet
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                pos = match.end()
+                continue
+            match = self.JSON_TOKEN.search(text, pos)
+            if not match:
+                pos = len(text)
+                break
+            char, pos = match.group(), match.end()
+            if char == "\"":
+                self._in_string = True
+            elif char in "{[":
+                # Panels are the objects listed in an array, e.g. {"panels": [{...}, ...]}
+                if char == "{" and self._containers[-1:] == ["["] and self._object_start is None:
+                    self._object_start = (match.start(), len(self._containers))
+                self._containers.append(char)
+            else:
+                if self._containers:
+                    self._containers.pop()
+                if self._object_start and len(self._containers) == self._object_start[1]:
+                    panels += self._json_panel(text[self._object_start[0]:pos])
+                    self._object_start = None
+        # Keep only the panel object being read
+        done = self._object_start[0] if self._object_start else pos
+        self._buffer = text[done:]
+        self._pos = pos - done
+        if self._object_start:
+            self._object_start = (0, self._object_start[1])
+        return panels
+
+    def _json_panel(self, raw):
+        try:
+            values = json.loads(raw)
+        except ValueError:
+            return []
+        if not isinstance(values, dict):
+            return []
+        self._objects += 1
+        return [json_panel(self._objects, values)]
+
+# Function to parse comic script into panels
+def parse_comic_script(script, panel_count=PANEL_COUNT):
+    """Splits a finished script, text or JSON, into its panels 1 to ``panel_count``.
+
+    Missing panels are not made up; ``check_panels`` reports them.
+    """
+    start_time = time.time()
+    found = None
+    fence = FENCE.search(script)
+    if fence and json_start(script[fence.end():]):
+        script = script[fence.end():].split("```", 1)[0]  # JSON in a code block, maybe after a sentence
+    if json_start(script):
+        try:
+            found = json_panels(json.loads(script))
+        except ValueError:
+            pass  # Cut short; the stream parser still finds the panels that are complete
+    if not found:
+        parser = PanelStreamParser()
+        found = parser.feed(script) + parser.close()
+    panels = {}
+    for panel in found:
+        if 1 <= panel["number"] <= panel_count:
+            panels.setdefault(panel["number"], panel)  # A repeated header does not replace the panel
+    panels = sorted(panels.values(), key=lambda x: x["number"])
+    tracing.record("parse", start_time, time.time(), panels=len(panels))
+    return panels
+
+def check_panels(panels, panel_count=PANEL_COUNT):
+    """Returns what keeps parsed panels from being drawn, or an empty list."""
+    numbers = {panel["number"] for panel in panels}
+    missing = [str(n) for n in range(1, panel_count + 1) if n not in numbers]
+    problems = [f"missing panel{'s' if len(missing) > 1 else ''} {', '.join(missing)}"] if missing else []
+    problems += [f"panel {panel['number']} has no image prompt" for panel in panels if not panel["prompt"]]
+    return problems
+
+# --- ComfyUI Image Generator ---
+
+# ComfyUI Configuration
+COMFYUI_PATH = "C:\\ComfyUI_windows_portable\\ComfyUI"  # Update with your ComfyUI directory
+COMFYUI_HOST = "127.0.0.1:8188"  # The local server started by start_comfyui
+# Comma-separated host:port list of render servers; panels go to the least-loaded healthy one
+COMFYUI_SERVERS = [h.strip() for h in os.environ.get("COMFYUI_SERVERS", COMFYUI_HOST).split(",") if h.strip()]
+WS_URL = "ws://{server}/ws"
+CLIENT_ID = comfyui_events.CLIENT_ID  # Shared with the WebSocket listener so its events reach us
+POLL_INTERVAL = 0.5  # Seconds between status checks
+USE_WEBSOCKET = True  # Wait on ComfyUI's /ws events, polling /history only as a fallback
+WS_HISTORY_CHECK = 5  # Seconds between safety-net /history reads while on the WebSocket
+STRIP_TIMEOUT = 1800  # Seconds allowed for all panels of a strip in pipelined mode
+RENDER_ATTEMPTS = 3  # Servers tried per panel before giving up
+RENDER_ATTEMPT_TIMEOUT = 600  # Seconds before a render is retried on another server
+# Renders allowed in flight per server at once; further panels wait for a free slot (0 = unlimited)
+MAX_IN_FLIGHT_PER_SERVER = int(os.environ.get("COMFYUI_MAX_IN_FLIGHT", "0"))
+# Node results a started ComfyUI keeps (--cache-lru), so a prompt is encoded once and later panels,
+# redraws and finishing passes reuse its conditioning; 0 keeps only the last prompt's, ComfyUI's default
+COMFYUI_CACHE_LRU = int(os.environ.get("COMFYUI_CACHE_LRU", "128"))
+
+# Rendered panel cache, keyed on the fully resolved workflow
+IMAGE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_cache")
+IMAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Least recently used images are evicted beyond this
+
+# Spool for downloaded panels; panels only carry the path of their file
+IMAGE_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_spool")
+SESSION_QUOTA_BYTES = 256 * 1024 ** 2  # Per session; its oldest strips are deleted beyond this
+IMAGE_STORE_MAX_BYTES = 4 * 1024 ** 3  # All sessions together
+IMAGE_STORE_MAX_AGE = 24 * 3600  # Seconds before a strip is deleted whatever the quotas
+
+# Background job queue shared by the app and comic_worker.py
+JOB_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3")
+JOB_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_results")
+JOB_MAX_AGE = 24 * 3600  # Seconds a finished job and its images are kept
+
+# Throwaway render that loads the model, encoders and VAE before the first real panel
+WARMUP_SETTINGS = {"width": 64, "height": 64, "steps": 1, "cfg": 1.0, "seed": 0, "sampler": "euler", "scheduler": "normal"}
+WARMUP_TIMEOUT = 600  # Seconds allowed for the first, cold model load
+WARMUP_RETRY_INTERVAL = 300  # Seconds before ensure_warm() retries a warm-up that failed or timed out
+STATUS_TTL = 3  # Seconds server_status() reuses a probe before refreshing it in the background
+PANEL_INPUTS = ("seed", "width", "height", "steps", "cfg", "sampler", "scheduler", "model_path")  # Besides the prompt
+
+# Quick previews first, full quality only for the panels that are kept
+PREVIEW = "preview"  # A panel's "quality" while it only has a preview image
+PREVIEW_STEPS = 8  # Sampler steps of a preview
+PREVIEW_SCALE = 0.5  # Preview width and height relative to the full panel
+PREVIEW_MIN_SIZE = 256  # Pixels; smaller latents lose the composition
+REFINE_DENOISE = 0.6  # Share of a preview the full-quality pass redraws; 1.0 renders from scratch
+
+# Default models for Flux.1
+DEFAULT_MODEL = "flux1-dev-Q4_0.gguf"
+T5_ENCODER = "t5-gguf-encoder"  # Update with your actual T5 encoder name
+CLIP_ENCODER = "clip-l-encoder"  # Update with your actual CLIP-L encoder name
+
+# ComfyUI server status
+comfyui_process = None
+server_running = False
+warm_servers = {}  # host -> (model_path, workflow key) of its last successful warm-up
+warming_servers = set()
+failed_warmups = {}  # host -> ((model_path, workflow key), time) of its last failed warm-up
+warm_lock = threading.Lock()
+server_statuses = {}  # host -> (time of the last probe, running)
+refreshing_statuses = set()
+status_lock = threading.Lock()
+
+def load_custom_workflow(file_path=None, progress=SILENT):
+    """Load custom workflow from a JSON file or return the default workflow."""
+    if file_path and os.path.exists(file_path):
+        try:
+            with open(file_path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            progress.error(f"Failed to load workflow: {e}")
+            return None
+    else:
+        # Default workflow optimized for Flux.1 with both encoders
+        return {
+            "1": {
+                "class_type": "Load Checkpoint",
+                "inputs": {
+                    "ckpt_name": DEFAULT_MODEL
+                }
+            },
+            "2": {
+                "class_type": "CLIPTextEncode",
+                "inputs": {
+                    "text": "A beautiful landscape",
+                    "clip": ["1", 1]  # CLIP-L encoder output from checkpoint
+                }
+            },
+            "3": {
+                "class_type": "T5TextEncode",
+                "inputs": {
+                    "text": "A beautiful landscape",
+                    "t5": ["1", 3]  # T5 encoder output from checkpoint
+                }
+            },
+            "4": {
+                "class_type": "Empty Latent Image",
+                "inputs": {
+                    "width": 768,
+                    "height": 768,
+                    "batch_size": 1
+                }
+            },
+            "5": {
+                "class_type": "KSampler",
+                "inputs": {
+                    "model": ["1", 0],
+                    "positive": ["2", 0],
+                    "negative": ["7", 0],
+                    "latent_image": ["4", 0],
+                    "seed": 0,
+                    "steps": 30,
+                    "cfg": 7.5,
+                    "sampler_name": "euler_a",
+                    "scheduler": "normal",
+                    "denoise": 1.0
+                }
+            },
+            "6": {
+                "class_type": "VAEDecode",
+                "inputs": {
+                    "samples": ["5", 0],
+                    "vae": ["1", 2]
+                }
+            },
+            "7": {
+                "class_type": "CLIPTextEncode",
+                "inputs": {
+                    "text": "ugly, bad quality, blurry, distorted",
+                    "clip": ["1", 1]
+                }
+            },
+            "8": {
+                "class_type": "Save Image",
+                "inputs": {
+                    "filename_prefix": "flux1_",
+                    "images": ["6", 0]
+                }
+            }
+        }
+
+def start_comfyui(progress=SILENT, model_path=DEFAULT_MODEL):
+    """Starts ComfyUI in a subprocess and warms it up with ``model_path``."""
+    global comfyui_process, server_running
+    
+    if server_running:
+        progress.info("ComfyUI is already running.")
+        return
+    
+    try:
+        cache_args = ["--cache-lru", str(COMFYUI_CACHE_LRU)] if COMFYUI_CACHE_LRU else []
+        if os.name == 'nt':  # Windows
+            comfyui_process = subprocess.Popen(["python", "main.py"] + cache_args, cwd=COMFYUI_PATH)
+        else:  # Linux or Mac
+            comfyui_process = subprocess.Popen(["python3", "main.py"] + cache_args, cwd=COMFYUI_PATH)
+        
+        # Check if server is up
+        start_time = time.time()
+        while time.time() - start_time < 30:  # 30 second timeout
+            if comfyui_client.get_client(COMFYUI_HOST).status():
+                server_running = True
+                set_server_status(COMFYUI_HOST, True)
+                progress.success("ComfyUI started successfully!")
+                get_backend_pool().refresh()
+                if warm_up(COMFYUI_HOST, model_path):
+                    progress.success("ComfyUI is warm: the model is loaded.")
+                return
+            time.sleep(1)
+        
+        progress.warning("ComfyUI started but may not be fully initialized. Proceed with caution.")
+        server_running = True
+    except Exception as e:
+        progress.error(f"Failed to start ComfyUI: {e}")
+
+def stop_comfyui(progress=SILENT):
+    """Stops the ComfyUI subprocess."""
+    global comfyui_process, server_running
+    if comfyui_process:
+        comfyui_process.terminate()
+        try:
+            comfyui_process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            comfyui_process.kill()
+        comfyui_process = None
+        server_running = False
+        set_server_status(COMFYUI_HOST, False)
+        with warm_lock:
+            warm_servers.pop(COMFYUI_HOST, None)
+            failed_warmups.pop(COMFYUI_HOST, None)
+        progress.success("ComfyUI has been shut down.")
+    else:
+        progress.info("No ComfyUI process to stop.")
+
+def check_server_status(server=None):
+    """Checks if a ComfyUI server is running.
+
+    Without ``server`` it checks whether any server in the pool is healthy.
+    """
+    if server is None:
+        return bool(get_backend_pool().healthy_backends())
+    return comfyui_client.get_client(server).status()
+
+def set_server_status(server, running):
+    with status_lock:
+        server_statuses[server] = (time.time(), running)
+
+def refresh_server_status(server=COMFYUI_HOST):
+    """Probes ``server`` and remembers the result for ``server_status``."""
+    try:
+        running = check_server_status(server)
+        set_server_status(server, running)
+        return running
+    finally:
+        with status_lock:
+            refreshing_statuses.discard(server)
+
+def server_status(server=COMFYUI_HOST, ttl=STATUS_TTL):
+    """Returns whether ``server`` is running without waiting on the network.
+
+    A probe is reused for ``ttl`` seconds. After that the old answer is still
+    returned while a background thread probes again, so only the very first
+    call for a server waits for a round trip.
+    """
+    with status_lock:
+        cached = server_statuses.get(server)
+        if cached is not None and time.time() - cached[0] > ttl and server not in refreshing_statuses:
+            refreshing_statuses.add(server)
+            threading.Thread(target=refresh_server_status, args=(server,), daemon=True).start()
+    if cached is None:
+        return refresh_server_status(server)
+    return cached[1]
+
+def get_backend_pool():
+    """Returns the shared pool of configured ComfyUI servers."""
+    return comfyui_pool.get_pool(COMFYUI_SERVERS, MAX_IN_FLIGHT_PER_SERVER or None)
+
+# --- Warm-up ---
+
+def warmup_key(model_path, workflow_json):
+    return model_path, workflow_template.get_template(workflow_json).key
+
+def warm_up(server=COMFYUI_HOST, model_path=DEFAULT_MODEL, workflow_json=None):
+    """Renders a tiny throwaway image on ``server`` so its weights are resident.
+
+    Uses the real workflow with ``WARMUP_SETTINGS`` and a preview output, so
+    the same checkpoint, encoders and VAE are loaded without saving a file;
+    the image is never downloaded. Returns True once the server is warm.
+    """
+    workflow_json = workflow_json or load_custom_workflow()
+    key = warmup_key(model_path, workflow_json)
+    with warm_lock:
+        if server in warming_servers:
+            return False
+        warming_servers.add(server)
+        warm_servers.pop(server, None)
+    try:
+        settings = dict(WARMUP_SETTINGS, model_path=model_path)
+        workflow, _ = workflow_template.get_template(workflow_json).render("warm-up", settings=settings)
+        for node_id, node in workflow.items():
+            if node.get("class_type") in ("SaveImage", "Save Image"):
+                workflow[node_id] = {"class_type": "PreviewImage", "inputs": {"images": node["inputs"]["images"]}}
+        with tracing.span("warm_up", server=server, model=model_path) as span:
+            result = queue_prompt(workflow, server)
+            warm = bool(result and "prompt_id" in result and
+                        wait_for_prompt(result["prompt_id"], time.time() + WARMUP_TIMEOUT, server))
+            span.set(warm=warm)
+        with warm_lock:
+            if warm:
+                warm_servers[server] = key
+                failed_warmups.pop(server, None)
+            else:
+                failed_warmups[server] = (key, time.time())
+        return warm
+    finally:
+        with warm_lock:
+            warming_servers.discard(server)
+
+def ensure_warm(model_path=DEFAULT_MODEL, workflow_json=None):
+    """Starts a background warm-up on every healthy server not yet warm with this model.
+
+    Servers the health checks saw go down lose their warm state, so they are
+    warmed again once they come back (e.g. after a restart). A warm-up that
+    failed or timed out is retried after ``WARMUP_RETRY_INTERVAL`` seconds.
+    """
+    workflow_json = workflow_json or load_custom_workflow()
+    key = warmup_key(model_path, workflow_json)
+    for backend in get_backend_pool().backends:
+        with warm_lock:
+            if not backend.healthy:
+                warm_servers.pop(backend.host, None)
+                failed_warmups.pop(backend.host, None)
+                continue
+            if warm_servers.get(backend.host) == key or backend.host in warming_servers:
+                continue
+            failed = failed_warmups.get(backend.host)
+            if failed and failed[0] == key and time.time() - failed[1] < WARMUP_RETRY_INTERVAL:
+                continue
+        threading.Thread(target=warm_up, args=(backend.host, model_path, workflow_json), daemon=True).start()
+
+def readiness(server=COMFYUI_HOST, model_path=DEFAULT_MODEL, workflow_json=None):
+    """Returns "down", "up", "warming" or "warm" from the pool's last health check."""
+    backend = next((b for b in get_backend_pool().backends if b.host == server), None)
+    if backend is None or not backend.healthy:
+        return "down"
+    with warm_lock:
+        if server in warming_servers:
+            return "warming"
+        if warm_servers.get(server) == warmup_key(model_path, workflow_json or load_custom_workflow()):
+            return "warm"
+    return "up"
+
+def queue_prompt(prompt, server=COMFYUI_HOST, progress=SILENT):
+    """Queues a prompt to the ComfyUI API."""
+    if USE_WEBSOCKET:
+        comfyui_events.get_listener(WS_URL.format(server=server))  # Subscribe before the prompt can finish
+    try:
+        with tracing.span("queue_prompt", server=server):
+            return comfyui_client.get_client(server).queue_prompt(prompt, CLIENT_ID)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        progress.error(f"API error: {e}")
+        return None
+
+def record_execution(entry, state=None):
+    """Splits the current render span into ComfyUI queue wait and sampling time.
+
+    Uses the execution timestamps in the prompt's /history status messages,
+    falling back to what the WebSocket listener saw.
+    """
+    render = tracing.current_span()
+    if render is None:
+        return
+    timestamps = {}
+    for message in entry.get("status", {}).get("messages", []):
+        if len(message) == 2 and isinstance(message[1], dict) and "timestamp" in message[1]:
+            timestamps[message[0]] = message[1]["timestamp"] / 1000  # Milliseconds in ComfyUI
+    started = timestamps.get("execution_start") or (state.started_at if state else None)
+    finished = timestamps.get("execution_success") or (state.finished_at if state else None) or time.time()
+    if started:
+        # ComfyUI's clock may differ from ours on remote servers, so clamp to the render span
+        started = min(max(started, render.start), time.time())
+        tracing.record("comfyui_queue_wait", render.start, started)
+        tracing.record("comfyui_execution", started, max(started, finished))
+
+def record_conditioning(entry):
+    """Counts the prompt encoders of a finished prompt that ComfyUI served from its node cache.
+
+    ComfyUI lists the nodes it did not have to run in the ``execution_cached``
+    message of the prompt's /history status. Encoders that feed no output
+    are never run, so they are not counted.
+    """
+    try:
+        workflow, outputs = entry["prompt"][2], entry["prompt"][4]
+    except (KeyError, IndexError, TypeError):
+        return
+    encoders = {node_id for node_id in workflow_template.upstream(workflow, outputs)
+                if workflow_template.is_prompt_node(workflow[node_id])}
+    cached = set()
+    for message in entry.get("status", {}).get("messages", []):
+        if len(message) == 2 and message[0] == "execution_cached" and isinstance(message[1], dict):
+            cached.update(message[1].get("nodes", []))
+    tracing.count("conditioning_hits", len(encoders & cached))
+    tracing.count("conditioning_misses", len(encoders - cached))
+
+def wait_for_prompt(prompt_id, deadline, server=COMFYUI_HOST):
+    """Waits for a prompt to finish without downloading its images.
+
+    Returns True if it succeeded before ``deadline``, False if it failed or
+    is still running.
+    """
+    client = comfyui_client.get_client(server)
+    listener = comfyui_events.get_listener(WS_URL.format(server=server)) if USE_WEBSOCKET else None
+    try:
+        while time.time() < deadline:
+            if listener is not None and listener.connected:
+                listener.wait(prompt_id, min(WS_HISTORY_CHECK, max(0, deadline - time.time())))
+            else:
+                time.sleep(POLL_INTERVAL)
+            try:
+                status = client.history(prompt_id).get(prompt_id, {}).get("status", {})
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+            if status.get("status_str") in ("success", "error"):
+                return status["status_str"] == "success"
+    finally:
+        if listener is not None:
+            listener.forget(prompt_id)
+    return False
+
+def get_image(prompt_id, deadline=None, progress=SILENT, all_outputs=False, server=COMFYUI_HOST):
+    """Retrieves the generated image from the ComfyUI API.
+
+    Only the images of the first output node are returned unless
+    ``all_outputs`` is set. Each image records the ``node_id`` that saved it.
+
+    Waits until ``deadline`` (an absolute ``time.time()`` value, one hour from
+    now by default). Status and sampler steps are reported to ``progress``.
+
+    Completion and sampler progress come from the ComfyUI WebSocket when it is
+    connected; /history is then read once the prompt finishes (and every
+    ``WS_HISTORY_CHECK`` seconds as a safety net). Without the socket it falls
+    back to polling /history every ``POLL_INTERVAL`` seconds.
+    """
+    output_images = []
+    if deadline is None:
+        deadline = time.time() + 3600  # 1 hour timeout
+    
+    progress.update(0.0)
+    
+    def on_progress(value, maximum):
+        progress.update(min(value / maximum, 1.0), f"Generation progress: step {value}/{maximum}")
+    
+    client = comfyui_client.get_client(server)
+    listener = comfyui_events.get_listener(WS_URL.format(server=server)) if USE_WEBSOCKET else None
+    failed = False
+    
+    try:
+        while time.time() < deadline and not failed:
+            try:
+                # Wait for a completion event instead of hammering /history
+                state = None
+                websocket_wait = listener is not None and listener.connected
+                if websocket_wait:
+                    timeout = min(WS_HISTORY_CHECK, max(0, deadline - time.time()))
+                    state = listener.wait(prompt_id, timeout, on_progress)
+                
+                history = client.history(prompt_id)
+                
+                if prompt_id in history and "outputs" in history[prompt_id]:
+                    # Check if generation is complete
+                    found_images = False
+                    for node_id in history[prompt_id]['outputs']:
+                        if "images" in history[prompt_id]['outputs'][node_id]:
+                            found_images = True
+                            for image in history[prompt_id]['outputs'][node_id]['images']:
+                                try:
+                                    # Streamed to the spool in chunks; the panel only keeps the file's path
+                                    with tracing.span("download", server=server) as span:
+                                        image_file = get_image_store().spool(
+                                            client.iter_view(image['filename'], image.get('subfolder', ''), image.get('type', 'output')),
+                                            {
+                                                "filename": image['filename'],
+                                                "subfolder": image.get('subfolder', ''),
+                                                "type": image.get('type', ''),
+                                                "node_id": node_id,
+                                                "server": server
+                                            }
+                                        )
+                                        span.set(bytes=image_file["size"])
+                                    tracing.count("download_bytes", image_file["size"])
+                                    output_images.append(image_file)
+                                except requests.exceptions.RequestException:
+                                    continue
+                            if not all_outputs:
+                                break
+                    
+                    if found_images:
+                        record_execution(history[prompt_id], state)
+                        record_conditioning(history[prompt_id])
+                        progress.update(1.0, "Generation complete!")
+                        return output_images
+                    
+                    # A finished prompt without images will not produce any later
+                    if history[prompt_id].get("status", {}).get("status_str") == "error":
+                        failed = True
+                        continue
+                
+                if not websocket_wait or state is not None:
+                    time.sleep(POLL_INTERVAL)
+            except Exception as e:
+                progress.warning(f"Error checking generation status: {e}")
+                time.sleep(POLL_INTERVAL * 2)  # Back off on errors
+    finally:
+        if listener is not None:
+            listener.forget(prompt_id)
+    
+    progress.update(0.0, "Generation failed!" if failed else "Generation timed out!")
+    return output_images
+
+def update_workflow_with_prompt(workflow, positive_prompt, negative_prompt=""):
+    """Returns a copy of the workflow with the sampler's prompt nodes set."""
+    return workflow_template.get_template(workflow).render(positive_prompt, negative_prompt or None)[0]
+
+# Function to build the workflow for a single panel
+def panel_workflow(panel_prompt, workflow_json, config):
+    """Returns the workflow for a comic panel and its image cache key.
+
+    Only the prompt, sampler, latent and model nodes found by the compiled
+    template are patched; ``workflow_json`` itself is left untouched.
+    """
+    settings = dict(config, seed=panel_seed(panel_prompt, config))
+    
+    # Create comic-specific prompt
+    comic_style_prompt = f"comic panel, cartoon style, {panel_prompt['prompt']}"
+    return workflow_template.get_template(workflow_json).render(comic_style_prompt, settings=settings)
+
+def panel_seed(panel, config):
+    """Returns a panel's own seed if it was given one, else the strip seed plus its number."""
+    if panel.get("seed") is not None:
+        return panel["seed"]
+    return config["seed"] + int(panel["number"])  # Use different seed for each panel
+
+def panel_inputs(panel, config):
+    """Returns the values a panel's image is rendered from."""
+    inputs = {name: config[name] for name in PANEL_INPUTS if name in config}
+    inputs.update(prompt=panel["prompt"], seed=panel_seed(panel, config))
+    return inputs
+
+def attach_image(panel, image, workflow_json, config):
+    """Returns the panel with its image and the inputs and cache key it was rendered from.
+
+    ``config`` holds the full-quality settings; a preview panel records its
+    preview settings.
+    """
+    config = tier_config(panel, workflow_json, config)
+    return dict(panel, image=image, inputs=panel_inputs(panel, config),
+                cache_key=panel_workflow(panel, workflow_json, config)[1])
+
+def stale_inputs(panel, workflow_json, config):
+    """Returns the inputs that changed since the panel was rendered, [] if its image is current.
+
+    Only changes that reach the workflow count: the cache key covers exactly
+    the values the compiled template patches, so e.g. a scheduler the
+    workflow does not use never invalidates a panel. Previews are compared
+    with the preview settings.
+    """
+    config = tier_config(panel, workflow_json, config)
+    if "image" in panel and os.path.exists(panel["image"]["path"]) and \
+            panel_workflow(panel, workflow_json, config)[1] == panel.get("cache_key"):
+        return []
+    rendered = panel.get("inputs", {})
+    changed = [name for name, value in panel_inputs(panel, config).items() if rendered.get(name) != value]
+    return changed or ["image"]  # Missing, evicted or rendered from another workflow
+
+def regenerate_panel(panel, workflow_json, config, prompt=None, new_seed=False, use_cache=True, progress=SILENT):
+    """Re-renders one panel of a strip without touching its script or the other panels.
+
+    ``prompt`` replaces the panel's image prompt and ``new_seed`` pins it to
+    a fresh random seed. A preview is redrawn as a preview. Returns the
+    updated panel, or None if the render failed.
+    """
+    # The old image is kept until the new one replaces it, to render where the prompt is encoded
+    panel = {k: v for k, v in panel.items() if k not in ("inputs", "cache_key")}
+    if prompt is not None:
+        panel["prompt"] = prompt
+    if new_seed:
+        panel["seed"] = random.randrange(1, 2 ** 32)
+    with tracing.span("regenerate", panel=panel["number"]):
+        image = generate_panel_image(panel, workflow_json, tier_config(panel, workflow_json, config), use_cache,
+                                     progress)
+    return attach_image(panel, image, workflow_json, config) if image else None
+
+def get_image_cache():
+    """Returns the shared on-disk cache of rendered panels."""
+    return image_cache.get_cache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+def get_image_store():
+    """Returns the shared spool of downloaded panel images."""
+    return image_store.get_store(IMAGE_STORE_DIR, SESSION_QUOTA_BYTES, IMAGE_STORE_MAX_BYTES, IMAGE_STORE_MAX_AGE)
+
+def preferred_server(panel):
+    """Returns the server that rendered a panel's current image, which may still hold its conditioning."""
+    return panel.get("image", {}).get("server")
+
+def get_cached_image(cache_key):
+    """Looks up a rendered panel, counting the hit or miss on the current trace.
+
+    A hit is linked into the image store, so the panel keeps its file even if
+    the cache evicts the entry later.
+    """
+    cached_image = get_image_cache().get(cache_key)
+    if cached_image:
+        cached_image = get_image_store().adopt(cached_image)
+    tracing.count("image_cache_hits" if cached_image else "image_cache_misses")
+    return cached_image
+
+def upload_images(uploads, server, progress=SILENT):
+    """Uploads {name: path} input images to ``server``. Returns False if one failed."""
+    try:
+        with tracing.span("upload", server=server, images=len(uploads)):
+            for name, path in uploads.items():
+                comfyui_client.get_client(server).upload_image(path, name)
+        return True
+    except (requests.exceptions.RequestException, OSError, ValueError) as e:
+        progress.error(f"Upload error: {e}")
+        return False
+
+def render_workflow(workflow, deadline=None, progress=SILENT, all_outputs=False, uploads=None, prefer=None):
+    """Renders a workflow on the least-loaded healthy server and returns its images.
+
+    A render that fails or runs past ``RENDER_ATTEMPT_TIMEOUT`` is retried on
+    another server, up to ``RENDER_ATTEMPTS`` servers, within ``deadline``;
+    a prompt that timed out is cancelled on the server it was abandoned on.
+    A workflow ComfyUI rejects is reported and not retried, since every
+    server would reject it. ``uploads`` ({name: path}) are sent to the chosen
+    server's input folder first, for workflows that load images. The
+    ``prefer`` server is chosen unless it is clearly busier than the others.
+    """
+    pool = get_backend_pool()
+    if deadline is None:
+        deadline = time.time() + 3600  # 1 hour timeout
+    
+    tried = set()
+    while len(tried) < RENDER_ATTEMPTS and time.time() < deadline:
+        backend = pool.acquire(exclude=tried, timeout=max(0, deadline - time.time()), prefer=prefer)
+        if backend is None:
+            break
+        tried.add(backend.host)
+        
+        # Leave time for a retry only if another server could take it
+        attempt_deadline = deadline
+        if len(tried) < RENDER_ATTEMPTS and pool.has_candidates(exclude=tried):
+            attempt_deadline = min(deadline, time.time() + RENDER_ATTEMPT_TIMEOUT)
+        
+        output_images = []
+        rejected = None
+        try:
+            with tracing.span("render", server=backend.host, attempt=len(tried)) as span:
+                result = None
+                if not uploads or upload_images(uploads, backend.host, progress):
+                    result = queue_prompt(workflow, backend.host, progress)
+                if result and "prompt_id" in result:
+                    output_images = get_image(result["prompt_id"], attempt_deadline, progress, all_outputs, backend.host)
+                    if not output_images and time.time() >= attempt_deadline:
+                        # Nobody collects it any more, so free the server for other panels
+                        cancel_prompt(result["prompt_id"], backend.host)
+                elif result:
+                    rejected = result.get("error") or result
+                    span.set(error=f"rejected: {rejected}")
+                span.set(images=len(output_images))
+        finally:
+            pool.release(backend, None if rejected else bool(output_images))
+        if rejected:
+            message = rejected.get("message", rejected) if isinstance(rejected, dict) else rejected
+            progress.error(f"ComfyUI rejected the workflow: {message}")
+            tracing.count("rejected_workflows")
+            return []
+        if output_images:
+            return output_images
+    return []
+
+def cancel_prompt(prompt_id, server):
+    """Deletes a prompt from ``server``'s queue, or interrupts it if it is already running."""
+    client = comfyui_client.get_client(server)
+    try:
+        running = client.queue().get("queue_running", [])
+        if any(len(item) > 1 and item[1] == prompt_id for item in running):
+            client.interrupt(prompt_id)
+        else:
+            client.delete_queued([prompt_id])
+        tracing.count("cancelled_renders")
+    except (requests.exceptions.RequestException, ValueError):
+        pass  # The server is unreachable; its health check deals with that
+
+# Function to generate a single panel image
+def generate_panel_image(panel_prompt, workflow_json, config, use_cache=True, progress=SILENT):
+    """Generates an image for a single comic panel."""
+    # Identical workflows render identical images, so reuse an earlier render
+    updated_workflow, cache_key = panel_workflow(panel_prompt, workflow_json, config)
+    if use_cache:
+        cached_image = get_cached_image(cache_key)
+        if cached_image:
+            return cached_image
+    
+    # Render on the least-loaded server and get the generated image
+    output_images = render_workflow(updated_workflow, progress=progress, prefer=preferred_server(panel_prompt))
+    if output_images:
+        if use_cache:
+            get_image_cache().put(cache_key, output_images[0])
+        return output_images[0]  # Return first image
+    return None
+
+# Function to generate all panels of a strip concurrently
+def generate_panels_pipelined(panels, workflow_json, config, timeout=STRIP_TIMEOUT, use_cache=True):
+    """Queues every panel up front and yields (panel, image) as each one finishes.
+
+    All panels share one deadline of ``timeout`` seconds. The image is None for
+    panels that could not be queued, failed or missed the deadline. Cached
+    panels are yielded first without touching ComfyUI.
+    """
+    deadline = time.time() + timeout
+    jobs = [(panel,) + panel_workflow(panel, workflow_json, config) + (None,) for panel in panels]
+    yield from render_panels(jobs, deadline, use_cache)
+
+def render_panels(jobs, deadline, use_cache=True):
+    """Renders (panel, workflow, cache key, uploads) jobs at once and yields (panel, image) as each finishes."""
+    submitted = []
+    for panel, updated_workflow, cache_key, uploads in jobs:
+        if use_cache:
+            cached_image = get_cached_image(cache_key)
+            if cached_image:
+                yield panel, cached_image
+                continue
+        submitted.append((panel, cache_key, updated_workflow, uploads))
+    
+    if not submitted:
+        return
+    
+    # Queue all panel workflows at once so ComfyUI never sits idle between panels,
+    # then hand back panels in completion order
+    with ThreadPoolExecutor(max_workers=len(submitted)) as executor:
+        futures = {
+            executor.submit(tracing.bind(render_workflow), updated_workflow, deadline, uploads=uploads,
+                            prefer=preferred_server(panel)): (panel, cache_key)
+            for panel, cache_key, updated_workflow, uploads in submitted
+        }
+        pending = set(futures)
+        try:
+            for future in as_completed(futures, timeout=max(0, deadline - time.time()) + POLL_INTERVAL * 4):
+                pending.discard(future)
+                panel, cache_key = futures[future]
+                try:
+                    output_images = future.result()
+                except Exception:
+                    output_images = []
+                if output_images and use_cache:
+                    get_image_cache().put(cache_key, output_images[0])
+                yield panel, output_images[0] if output_images else None
+        except FuturesTimeoutError:
+            for future in pending:
+                yield futures[future][0], None
+
+# Function to write the script and render panels at the same time
+def generate_strip_streaming(prompt, workflow_json, config, timeout=STRIP_TIMEOUT, use_cache=True,
+                             stats=None, on_script=None, script_cache=True, keep_alive=OLLAMA_KEEP_ALIVE,
+                             panel_count=PANEL_COUNT, structured=None, progress=SILENT):
+    """Streams the script and queues each panel the moment its block is complete.
+
+    Yields (panel, image) as images finish, like ``generate_panels_pipelined``.
+    ``on_script(text)`` receives the script written so far, at most every
+    ``SCRIPT_UPDATE_INTERVAL`` seconds and once more when it is done. A
+    stream that breaks off is reported to ``progress`` and kept in
+    ``stats["stream_error"]``. A panel without an image prompt is never
+    queued. If the finished script lacks panels, the model is asked for just
+    those panels of the same story, or for a new script when no panel was
+    queued yet, so every image comes from one script. When
+    given, the ``stats`` dict is filled with the final ``script``, the
+    rendered ``panels``, the ``error`` if no usable script could be written,
+    and the ``time_to_first_panel``, ``time_to_first_image``,
+    ``script_time`` and ``total_time`` measurements in seconds.
+    """
+    structured = STRUCTURED_SCRIPTS if structured is None else structured
+    start_time = time.time()
+    deadline = start_time + timeout
+    stats = {} if stats is None else stats
+    events = queue.Queue()
+    
+    # Read the LLM stream on its own thread so panels can be queued while it writes
+    def read_script():
+        parser = PanelStreamParser()
+        last_update = 0.0
+        try:
+            with tracing.span("script_stream"):  # Records the error if the stream breaks off
+                for chunk in stream_comic(prompt, use_cache=script_cache, keep_alive=keep_alive,
+                                          panel_count=panel_count, structured=structured):
+                    for panel in parser.feed(chunk):
+                        events.put(("panel", panel))
+                    # Joining the text costs a pass over it, so the page only gets a few updates a second
+                    if time.time() - last_update >= SCRIPT_UPDATE_INTERVAL:
+                        last_update = time.time()
+                        events.put(("text", parser.text))
+                for panel in parser.close():
+                    events.put(("panel", panel))
+        except Exception as e:
+            events.put(("stream_error", f"{type(e).__name__}: {e}"))
+        finally:
+            events.put(("script_done", parser.text.strip()))
+    
+    threading.Thread(target=tracing.bind(read_script), daemon=True).start()
+    
+    submitted = {}
+    in_flight = {}
+    script_done = False
+    
+    with ThreadPoolExecutor(max_workers=panel_count) as executor:
+        def submit(panel):
+            if panel["number"] in submitted or not 1 <= panel["number"] <= panel_count or not panel["prompt"]:
+                return
+            submitted[panel["number"]] = panel
+            in_flight[panel["number"]] = panel
+            stats.setdefault("time_to_first_panel", time.time() - start_time)
+            
+            updated_workflow, cache_key = panel_workflow(panel, workflow_json, config)
+            if use_cache:
+                cached_image = get_cached_image(cache_key)
+                if cached_image:
+                    events.put(("image", panel, None, [cached_image]))
+                    return
+            
+            def collect(future):
+                try:
+                    output_images = future.result()
+                except Exception:
+                    output_images = []
+                events.put(("image", panel, cache_key, output_images))
+            
+            executor.submit(tracing.bind(render_workflow), updated_workflow, deadline).add_done_callback(collect)
+        
+        while not script_done or in_flight:
+            try:
+                event = events.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            
+            if event[0] == "text":
+                if on_script:
+                    on_script(event[1])
+            elif event[0] == "stream_error":
+                stats["stream_error"] = event[1]
+                tracing.count("script_stream_errors")
+                progress.warning(f"The script stream broke off: {event[1]}")
+            elif event[0] == "panel":
+                submit(event[1])
+            elif event[0] == "script_done":
+                script_done = True
+                script = event[1]
+                panels = parse_comic_script(script, panel_count)
+                if check_panels(panels, panel_count):
+                    # The stream ended short or garbled; panels already queued keep their script
+                    try:
+                        if submitted:
+                            script, panels = complete_script(prompt, script, panels, panel_count, structured,
+                                                             keep_alive, attempts=max(1, SCRIPT_ATTEMPTS - 1))
+                        else:
+                            script, panels = write_script(prompt, panel_count, structured, use_cache=False,
+                                                          keep_alive=keep_alive, attempts=max(1, SCRIPT_ATTEMPTS - 1))
+                    except ScriptError as e:
+                        stats["error"] = str(e)
+                if on_script:
+                    on_script(script)
+                stats["script"] = script
+                stats["script_time"] = time.time() - start_time
+                # Queue anything the streaming pass missed
+                for panel in panels:
+                    submit(panel)
+            elif event[0] == "image":
+                _, panel, cache_key, output_images = event
+                in_flight.pop(panel["number"], None)
+                if output_images:
+                    stats.setdefault("time_to_first_image", time.time() - start_time)
+                    if cache_key and use_cache:
+                        get_image_cache().put(cache_key, output_images[0])
+                yield panel, output_images[0] if output_images else None
+        
+        # Whatever is still outstanding missed the strip deadline
+        for panel in list(in_flight.values()):
+            yield panel, None
+    
+    stats["panels"] = sorted(submitted.values(), key=lambda x: x["number"])
+    stats["total_time"] = time.time() - start_time
+
+# --- Render Quality ---
+
+def preview_config(config, workflow_json):
+    """Returns the settings of a quick preview: the same seeds at ``PREVIEW_STEPS`` and reduced size."""
+    template = workflow_template.get_template(workflow_json)
+    latent = template.workflow[template.latents[0]]["inputs"] if template.latents else {}
+    sampler = template.workflow[template.samplers[0]]["inputs"] if template.samplers else {}
+    preview = dict(config, steps=min(config.get("steps", sampler.get("steps", PREVIEW_STEPS)), PREVIEW_STEPS))
+    for name in ("width", "height"):
+        size = config.get(name, latent.get(name))
+        if isinstance(size, int):
+            # Latent sizes must stay multiples of 64
+            preview[name] = min(size, max(PREVIEW_MIN_SIZE, int(size * PREVIEW_SCALE) // 64 * 64))
+    return preview
+
+def is_preview(panel):
+    """Checks whether a panel only has a preview image so far."""
+    return panel.get("quality") == PREVIEW
+
+def tier_config(panel, workflow_json, config):
+    """Returns the settings a panel is rendered with at its quality."""
+    return preview_config(config, workflow_json) if is_preview(panel) else config
+
+def finish_workflow(panel, workflow_json, config):
+    """Returns (workflow, cache key, uploads) of a preview panel's full-quality render.
+
+    When the workflow decodes with a VAE the preview is uploaded and refined
+    at full size, redrawing ``REFINE_DENOISE`` of it, which keeps the
+    composition that was accepted and skips the first sampling steps.
+    Otherwise the panel is rendered from scratch with its seed; a different
+    size can then change the composition.
+    """
+    updated_workflow, cache_key = panel_workflow(panel, workflow_json, config)
+    template = workflow_template.get_template(workflow_json)
+    preview = panel.get("image")
+    if REFINE_DENOISE >= 1 or not template.can_refine or not preview or not os.path.exists(preview["path"]):
+        return updated_workflow, cache_key, None
+    digest = preview.get("sha256") or image_store.file_digest(preview["path"])
+    name = f"comiccrafter_{digest[:16]}{os.path.splitext(preview['path'])[1] or '.png'}"
+    cache_key = hashlib.sha256(f"{cache_key}:refine:{REFINE_DENOISE}:{digest}".encode("utf-8")).hexdigest()
+    return template.refine(updated_workflow, name, REFINE_DENOISE), cache_key, {name: preview["path"]}
+
+def finish_panels(panels, workflow_json, config, timeout=STRIP_TIMEOUT, use_cache=True):
+    """Renders preview panels at full quality, all at once, and yields the finished panels.
+
+    Yields (preview, panel) as each finishes, like ``generate_panels_pipelined``;
+    the panel is None if its render failed or missed the deadline.
+    """
+    deadline = time.time() + timeout
+    previews = {panel["number"]: panel for panel in panels}
+    jobs = []
+    for panel in panels:
+        panel = {k: v for k, v in panel.items() if k != "quality"}
+        jobs.append((panel,) + finish_workflow(panel, workflow_json, config))
+    for panel, image in render_panels(jobs, deadline, use_cache):
+        if image:
+            tracing.count("finished_panels")
+        yield previews[panel["number"]], attach_image(panel, image, workflow_json, config) if image else None
+
+def merge_panel_workflows(panel_workflows):
+    """Combines per-panel workflows into one ComfyUI prompt.
+
+    ``panel_workflows`` is a list of (panel number, workflow) pairs. Nodes that
+    resolve identically for every panel and only depend on such nodes (the
+    checkpoint loader, the negative prompt...) are kept once, so ComfyUI runs
+    them a single time. Everything downstream of a per-panel input is copied
+    under a ``panel<N>_`` prefix. Returns the merged workflow and a mapping of
+    merged node id to panel number.
+    """
+    workflows = [workflow for _, workflow in panel_workflows]
+    first = workflows[0]
+    
+    shared = set()
+    if len(workflows) > 1:
+        candidates = {
+            node_id for node_id, node in first.items()
+            if all(workflow.get(node_id) is node or workflow.get(node_id) == node for workflow in workflows[1:])
+        }
+        changed = True
+        while changed:
+            changed = False
+            for node_id in candidates - shared:
+                links = [v[0] for v in first[node_id]["inputs"].values() if is_node_link(v)]
+                if all(link in shared for link in links):
+                    shared.add(node_id)
+                    changed = True
+    
+    merged = {node_id: first[node_id] for node_id in shared}
+    node_panels = {}
+    for number, workflow in panel_workflows:
+        prefix = f"panel{number}_"
+        for node_id, node in workflow.items():
+            if node_id in shared:
+                continue
+            inputs = dict(node["inputs"])
+            for name, value in inputs.items():
+                if is_node_link(value) and value[0] in workflow and value[0] not in shared:
+                    inputs[name] = [prefix + value[0], value[1]]
+            merged[prefix + node_id] = dict(node, inputs=inputs)
+            node_panels[prefix + node_id] = number
+    return merged, node_panels
+
+# Function to generate all panels of a strip as a single ComfyUI job
+def generate_panels_batched(panels, workflow_json, config, timeout=STRIP_TIMEOUT, use_cache=True, progress=SILENT):
+    """Renders every uncached panel in one ComfyUI job and yields (panel, image).
+
+    Shared model loading and encoding run once per strip instead of once per
+    panel. Each panel keeps its own sampler seed (``config["seed"] + number``).
+    """
+    deadline = time.time() + timeout
+    
+    misses = []
+    for panel in panels:
+        updated_workflow, cache_key = panel_workflow(panel, workflow_json, config)
+        if use_cache:
+            cached_image = get_cached_image(cache_key)
+            if cached_image:
+                yield panel, cached_image
+                continue
+        misses.append((panel, cache_key, updated_workflow))
+    
+    if not misses:
+        return
+    
+    batched_workflow, node_panels = merge_panel_workflows(
+        [(panel["number"], updated_workflow) for panel, _, updated_workflow in misses]
+    )
+    
+    # Split the job's outputs back into panels by the node that saved them
+    images_by_panel = {}
+    for image in render_workflow(batched_workflow, deadline, progress, all_outputs=True):
+        number = node_panels.get(image["node_id"])
+        if number is not None:
+            images_by_panel.setdefault(number, image)
+    
+    for panel, cache_key, _ in misses:
+        panel_image = images_by_panel.get(panel["number"])
+        if panel_image and use_cache:
+            get_image_cache().put(cache_key, panel_image)
+        yield panel, panel_image
+
+def get_job_queue():
+    """Returns the persistent queue of background strip jobs."""
+    return job_queue.JobQueue(JOB_DB_PATH)
+
+def load_job_panels(result):
+    """Turns a finished job's result into panels whose images point at the saved files."""
+    panels = []
+    for panel in result["panels"]:
+        if not panel.get("image_path") or not os.path.exists(panel["image_path"]):
+            continue
+        image = dict(panel["image"], path=panel["image_path"])
+        if "sha256" not in image:
+            image["sha256"] = image_store.file_digest(image["path"])  # Jobs finished before the image store
+        panels.append(dict(panel, image=image))
+    return panels
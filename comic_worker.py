@@ -0,0 +1,138 @@
+"""Background worker that renders comic strip jobs from the SQLite queue.
+
+Run one or more of these next to the Streamlit app::
+
+    python comic_worker.py --concurrency 2 --max-in-flight 2
+
+Each worker claims the highest-priority queued job, writes the script and
+generates its panels with the same pipeline as the app, saves the images
+under ``JOB_RESULTS_DIR/<job id>/`` and stores the result in the queue.
+Finished jobs older than ``--keep-results`` are deleted with their images.
+``--max-in-flight`` bounds the panels rendering on each ComfyUI server, and
+``--metrics-port`` serves the strip traces and stage metrics over HTTP.
+"""
+import argparse
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import comic_core as cc
+import image_store
+import job_queue
+import tracing
+
+STALE_JOB_CHECK = 60  # Seconds between checks for abandoned and expired jobs
+
+
+def job_config(payload):
+    """Returns a job's render settings, picking the seed now if it was left random (0)."""
+    config = payload["config"]
+    return config if config.get("seed") else dict(config, seed=int(time.time()))
+
+
+def run_job(job, results_dir):
+    """Generates the strip described by a job and returns its result."""
+    payload = job["payload"]
+    config = job_config(payload)
+    script, panels = cc.write_script(payload["topic"], payload.get("panel_count", cc.PANEL_COUNT),
+                                     payload.get("structured"), payload.get("script_cache", True),
+                                     payload.get("keep_alive", cc.OLLAMA_KEEP_ALIVE))
+    workflow_json = payload.get("workflow") or cc.load_custom_workflow()
+
+    job_dir = os.path.join(results_dir, job["id"])
+    os.makedirs(job_dir, exist_ok=True)
+
+    generate_panels = cc.generate_panels_batched if payload.get("batched") else cc.generate_panels_pipelined
+    results = []
+    try:
+        with image_store.strip(job["id"]):
+            for panel, panel_image in generate_panels(panels, workflow_json, config,
+                                                      payload.get("timeout", cc.STRIP_TIMEOUT),
+                                                      payload.get("use_cache", True)):
+                if not panel_image:
+                    continue
+                image_path = os.path.join(job_dir, f"panel_{panel['number']}.png")
+                image_store.save_image(panel_image, image_path)
+                image = {k: v for k, v in panel_image.items() if k != "path"}
+                results.append(dict(panel, image=image, image_path=image_path))
+    finally:
+        cc.get_image_store().discard(job["id"])  # The job directory keeps its own links
+
+    if not results:
+        raise RuntimeError("Failed to generate any comic panels. Check the ComfyUI logs for errors.")
+    results.sort(key=lambda x: x["number"])
+    return {"script": script, "panels": results, "config": config}
+
+
+def process_job(jobs, job, results_dir):
+    try:
+        with tracing.trace("strip", "strips", topic=job["payload"]["topic"], job_id=job["id"]):
+            result = run_job(job, results_dir)
+        jobs.complete(job["id"], result)
+        print(f"Job {job['id']} done")
+    except Exception as e:
+        jobs.fail(job["id"], e)
+        shutil.rmtree(os.path.join(results_dir, job["id"]), ignore_errors=True)  # Nothing will show its panels
+        print(f"Job {job['id']} failed: {e}")
+
+
+def expire_jobs(jobs, results_dir, older_than):
+    """Deletes finished jobs older than ``older_than`` seconds and their saved images."""
+    expired = jobs.expire(older_than)
+    for job_id in expired:
+        shutil.rmtree(os.path.join(results_dir, job_id), ignore_errors=True)
+    return len(expired)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render queued comic strip jobs.")
+    parser.add_argument("--db", default=cc.JOB_DB_PATH, help="job queue database")
+    parser.add_argument("--results-dir", default=cc.JOB_RESULTS_DIR)
+    parser.add_argument("--concurrency", type=int, default=2, help="strips processed at once")
+    parser.add_argument("--max-in-flight", type=int, default=2, help="panels rendering per ComfyUI server")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between queue checks")
+    parser.add_argument("--stale-after", type=float, default=cc.STRIP_TIMEOUT * 2,
+                        help="seconds after which a running job is assumed abandoned")
+    parser.add_argument("--keep-results", type=float, default=cc.JOB_MAX_AGE,
+                        help="seconds a finished job and its images are kept")
+    parser.add_argument("--metrics-port", type=int, default=tracing.METRICS_PORT,
+                        help="serve /metrics and /traces on this port (0 to disable)")
+    parser.add_argument("--trace-file", default=tracing.TRACE_FILE, help="append finished traces to this JSON lines file")
+    args = parser.parse_args()
+
+    cc.MAX_IN_FLIGHT_PER_SERVER = args.max_in_flight
+    tracing.TRACE_FILE = args.trace_file
+    if args.metrics_port:
+        tracing.start_server(args.metrics_port)
+    jobs = job_queue.JobQueue(args.db)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    slots = threading.Semaphore(args.concurrency)
+    last_stale_check = 0
+    print(f"Worker {worker_id} polling {args.db}")
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        while True:
+            if time.time() - last_stale_check > STALE_JOB_CHECK:
+                requeued = jobs.requeue_stale(args.stale_after)
+                if requeued:
+                    print(f"Requeued {requeued} abandoned jobs")
+                expired = expire_jobs(jobs, args.results_dir, args.keep_results)
+                if expired:
+                    print(f"Deleted {expired} expired jobs")
+                last_stale_check = time.time()
+
+            slots.acquire()
+            job = jobs.claim(worker_id)
+            if job is None:
+                slots.release()
+                time.sleep(args.poll_interval)
+                continue
+            print(f"Job {job['id']} claimed: {job['payload']['topic']}")
+            executor.submit(process_job, jobs, job, args.results_dir).add_done_callback(lambda _: slots.release())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,373 +1,373 @@
 import streamlit as st
-import subprocess
+import os
 import time
-import requests
 import json
-import os
 import threading
-import re
-
-# --- Ollama Comic Generator ---
+import uuid
+from functools import partial
+import comfyui_client
+import image_store
+import job_queue
+import strip_export
+import tracing
+from comic_core import (
+    COMFYUI_HOST, COMFYUI_SERVERS, DEFAULT_MODEL, MAX_PANELS, OLLAMA_KEEP_ALIVE, PANEL_COUNT, PREVIEW,
+    STRIP_TIMEOUT, STRUCTURED_SCRIPTS, Progress, ScriptError, attach_image, check_server_status, ensure_warm,
+    finish_panels, generate_panel_image, generate_panels_batched, generate_panels_pipelined,
+    generate_strip_streaming, get_backend_pool, get_image_cache, get_image_store, get_job_queue, is_preview,
+    load_custom_workflow, load_job_panels, preview_config, readiness, regenerate_panel, server_status,
+    stale_inputs, start_comfyui, stop_comfyui, write_script,
+)
 
 # Startup prompt
 STARTUP_PROMPT = "Hello! I'm your comic generator. Give me a topic, and I'll create a fun 4-panel comic strip!"
 
-# Function to generate comic script using Ollama CLI
-def generate_comic(prompt):
-    model = "comiccrafter"  # Use your custom model or "mistral"
-    full_prompt = f"Generate a 4-panel comic strip script about: {prompt}. Please format it as 'Panel 1: [description of visual scene] - [character dialogue/text]', and so on for all 4 panels. Make each panel concise and visual."
-
-    # Call Ollama CLI using 'run' instead of 'chat'
-    result = subprocess.run(
-        ["ollama", "run", model],
-        input=full_prompt,
-        text=True,
-        capture_output=True
-    )
+JOB_POLL_INTERVAL = 2  # Seconds between job status refreshes in the app
 
-    if result.returncode == 0:
-        return result.stdout.strip()
-    else:
-        error_msg = result.stderr if result.stderr else "Unknown error occurred."
-        return f"Error generating comic: {error_msg}"
-
-# Function to parse comic script into panels
-def parse_comic_script(script):
-    # Regular expression to find panel descriptions
-    panels = []
-    panel_regex = r"Panel (\d+):(.*?)(?=Panel \d+:|$)"
-    matches = re.findall(panel_regex, script, re.DOTALL)
-    
-    for match in matches:
-        panel_num, content = match
-        # Split the content into visual description and dialogue if possible
-        parts = content.split('-', 1)
-        if len(parts) > 1:
-            visual = parts[0].strip()
-            dialogue = parts[1].strip()
-        else:
-            visual = content.strip()
-            dialogue = ""
-        
-        panels.append({
-            "number": int(panel_num),
-            "visual": visual,
-            "dialogue": dialogue,
-            "prompt": visual  # Use visual description as image generation prompt
-        })
-    
-    # If parsing failed or didn't find enough panels, fallback to simple splitting
-    if len(panels) < 4:
-        # Simple fallback: try to split by newlines and look for Panel keywords
-        lines = script.split('\n')
-        current_panel = None
-        
-        for line in lines:
-            if line.strip():
-                if line.lower().startswith("panel"):
-                    try:
-                        panel_num = int(re.search(r"Panel (\d+)", line, re.IGNORECASE).group(1))
-                        content = line.split(':', 1)[1].strip() if ':' in line else ""
-                        current_panel = {
-                            "number": panel_num,
-                            "visual": content,
-                            "dialogue": "",
-                            "prompt": content
-                        }
-                        panels.append(current_panel)
-                    except:
-                        # If we can't extract a panel number, just continue
-                        pass
-                elif current_panel and not line.startswith("Panel"):
-                    # Append to current panel's content
-                    current_panel["dialogue"] += " " + line.strip()
-                    current_panel["prompt"] += " " + line.strip()
-    
-    # If we still don't have 4 panels, create empty ones
-    while len(panels) < 4:
-        panels.append({
-            "number": len(panels) + 1,
-            "visual": "Comic scene",
-            "dialogue": "Missing panel content",
-            "prompt": "Comic scene"
-        })
-    
-    # Sort panels by number
-    panels.sort(key=lambda x: x["number"])
-    return panels[:4]  # Limit to 4 panels
-
-# --- ComfyUI Image Generator ---
-
-# ComfyUI Configuration
-COMFYUI_PATH = "C:\\ComfyUI_windows_portable\\ComfyUI"  # Update with your ComfyUI directory
-API_URL = "http://127.0.0.1:8188/prompt"
-HISTORY_URL = "http://127.0.0.1:8188/history/"
-UPLOAD_URL = "http://127.0.0.1:8188/upload/image"
-CLIENT_ID = str(time.time())
-POLL_INTERVAL = 0.5  # Seconds between status checks
-
-# Default models for Flux.1
-DEFAULT_MODEL = "flux1-dev-Q4_0.gguf"
-T5_ENCODER = "t5-gguf-encoder"  # Update with your actual T5 encoder name
-CLIP_ENCODER = "clip-l-encoder"  # Update with your actual CLIP-L encoder name
-
-# ComfyUI server status
-comfyui_process = None
-server_running = False
-
-def load_custom_workflow(file_path=None):
-    """Load custom workflow from a JSON file or return the default workflow."""
-    if file_path and os.path.exists(file_path):
+# Newer Streamlit versions read download data from a callable only when the button is clicked
+try:
+    from streamlit.proto.DownloadButton_pb2 import DownloadButton as DownloadButtonProto
+    DEFERRED_DOWNLOADS = "deferred_file_id" in DownloadButtonProto.DESCRIPTOR.fields_by_name
+except ImportError:
+    DEFERRED_DOWNLOADS = False
+
+class StreamlitProgress(Progress):
+    """Shows pipeline messages as Streamlit alerts and render progress as a bar."""
+    def __init__(self):
+        self.bar = None
+        self.text = None
+
+    def info(self, message):
+        st.info(message)
+
+    def success(self, message):
+        st.success(message)
+
+    def warning(self, message):
+        st.warning(message)
+
+    def error(self, message):
+        st.error(message)
+
+    def update(self, fraction, message=None):
+        if self.bar is None:
+            self.bar = st.progress(0)
+            self.text = st.empty()
+        self.bar.progress(min(max(fraction, 0.0), 1.0))
+        if message:
+            self.text.text(message)
+
+def http_summary(before, after):
+    """Describes the ComfyUI HTTP requests made between two ``total_stats`` snapshots."""
+    parts = []
+    for endpoint, stats in sorted(after.items()):
+        previous = before.get(endpoint, {"count": 0, "seconds": 0.0})
+        count = stats["count"] - previous["count"]
+        if count:
+            parts.append(f"{endpoint} {count}× {(stats['seconds'] - previous['seconds']) * 1000:.0f} ms")
+    return "ComfyUI HTTP: " + (", ".join(parts) if parts else "no requests")
+
+def trace_summary(trace):
+    """Describes a finished strip trace as total seconds per stage plus its counters."""
+    stages = {}
+    for span in trace["spans"]:
+        count, seconds = stages.get(span["name"], (0, 0.0))
+        stages[span["name"]] = (count + 1, seconds + (span["duration"] or 0))
+    lines = [f"{trace['name']}: {trace['duration']:.1f}s"]
+    lines += [f"  {name}: {count}× {seconds:.2f}s" for name, (count, seconds) in stages.items()]
+    lines += [f"  {name}: {value}" for name, value in sorted(trace["counters"].items())]
+    return "\n".join(lines)
+
+def parse_upload(uploaded_workflow):
+    """Returns the JSON of an uploaded workflow, parsing each upload only once per session.
+
+    Reruns then hand the same workflow object around, so its compiled
+    template is reused. Raises ``ValueError`` if the file is not JSON.
+    """
+    upload_key = (uploaded_workflow.file_id, uploaded_workflow.size)
+    cached = st.session_state.get("parsed_workflow")
+    if cached is None or cached[0] != upload_key:
+        uploaded_workflow.seek(0)
+        cached = st.session_state["parsed_workflow"] = (upload_key, json.load(uploaded_workflow))
+    return cached[1]
+
+def load_uploaded_workflow(uploaded_workflow):
+    """Returns the uploaded workflow, or the default one if none was uploaded or it is invalid."""
+    if uploaded_workflow:
         try:
-            with open(file_path, 'r') as f:
-                return json.load(f)
+            workflow_json = parse_upload(uploaded_workflow)
+            st.success("Custom workflow loaded successfully")
+            return workflow_json
         except Exception as e:
             st.error(f"Failed to load workflow: {e}")
-            return None
+    return load_custom_workflow(progress=StreamlitProgress())
+
+def active_workflow():
+    """Returns the uploaded workflow without reporting on it, or None for the default one."""
+    uploaded_workflow = st.session_state.get("workflow_file")
+    if uploaded_workflow:
+        try:
+            return parse_upload(uploaded_workflow)
+        except ValueError:
+            pass  # load_uploaded_workflow() reports it when a strip is drawn
+    return None
+
+def render_panel(panel, border_width, border_color, text_height):
+    """Draws a generated panel image with its dialogue box."""
+    # Create panel container with border
+    st.markdown(f"""
+    <div style="border: {border_width}px solid {border_color}; margin: 5px; padding: 0;">
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # Display a thumbnail; the full image is only read for downloads
+    st.image(
+        get_image_store().thumbnail(panel["image"]), 
+        caption=f"Panel {panel['number']}", 
+        use_column_width=True
+    )
+    
+    # Display text in a box below the image
+    st.markdown(f"""
+    <div style="
+        border: {border_width}px solid {border_color}; 
+        border-top: none;
+        padding: 10px; 
+        background-color: white; 
+        min-height: {text_height}px;
+        overflow-y: auto;
+        margin-bottom: 15px;
+        font-family: 'Comic Sans MS', cursive, sans-serif;
+    ">
+        {panel["dialogue"]}
+    </div>
+    """, unsafe_allow_html=True)
+
+def download_button(label, make_data, file_name, mime):
+    """Offers a file whose bytes ``make_data()`` only produces when the button is clicked.
+
+    Streamlit versions without deferred downloads get the bytes up front.
+    """
+    if DEFERRED_DOWNLOADS:
+        # "ignore" keeps the page as it is, so the strip stays on screen after a download
+        st.download_button(label, data=make_data, file_name=file_name, mime=mime, on_click="ignore")
     else:
-        # Default workflow optimized for Flux.1 with both encoders
-        return {
-            "1": {
-                "class_type": "Load Checkpoint",
-                "inputs": {
-                    "ckpt_name": DEFAULT_MODEL
-                }
-            },
-            "2": {
-                "class_type": "CLIPTextEncode",
-                "inputs": {
-                    "text": "A beautiful landscape",
-                    "clip": ["1", 1]  # CLIP-L encoder output from checkpoint
-                }
-            },
-            "3": {
-                "class_type": "T5TextEncode",
-                "inputs": {
-                    "text": "A beautiful landscape",
-                    "t5": ["1", 3]  # T5 encoder output from checkpoint
-                }
-            },
-            "4": {
-                "class_type": "Empty Latent Image",
-                "inputs": {
-                    "width": 768,
-                    "height": 768,
-                    "batch_size": 1
-                }
-            },
-            "5": {
-                "class_type": "KSampler",
-                "inputs": {
-                    "model": ["1", 0],
-                    "positive": ["2", 0],
-                    "negative": ["7", 0],
-                    "latent_image": ["4", 0],
-                    "seed": 0,
-                    "steps": 30,
-                    "cfg": 7.5,
-                    "sampler_name": "euler_a",
-                    "scheduler": "normal",
-                    "denoise": 1.0
-                }
-            },
-            "6": {
-                "class_type": "VAEDecode",
-                "inputs": {
-                    "samples": ["5", 0],
-                    "vae": ["1", 2]
-                }
-            },
-            "7": {
-                "class_type": "CLIPTextEncode",
-                "inputs": {
-                    "text": "ugly, bad quality, blurry, distorted",
-                    "clip": ["1", 1]
-                }
-            },
-            "8": {
-                "class_type": "Save Image",
-                "inputs": {
-                    "filename_prefix": "flux1_",
-                    "images": ["6", 0]
-                }
-            }
-        }
+        st.download_button(label, data=make_data(), file_name=file_name, mime=mime)
 
-def start_comfyui():
-    """Starts ComfyUI in a subprocess."""
-    global comfyui_process, server_running
+def show_downloads(generated_panels, border_width, border_color, text_height,
+                   export_format="PNG", export_quality=90, panel_downloads=False):
+    """Offers the strip (and optionally each panel) for download."""
+    # Download button for the whole comic strip
+    st.subheader("Download Options")
+    if strip_export.available():
+        download_button(
+            f"Download Comic Strip ({export_format})",
+            partial(strip_export.export_strip, generated_panels, export_format, export_quality,
+                    border_width, border_color, text_height),
+            file_name=f"comic_strip.{strip_export.EXTENSIONS[export_format]}",
+            mime=strip_export.FORMATS[export_format]
+        )
+    else:
+        st.info("Install Pillow (pip install pillow) to download the whole strip as one file.")
     
-    if server_running:
-        st.info("ComfyUI is already running.")
+    # Individual panels are only embedded in the page when asked for
+    if panel_downloads or not strip_export.available():
+        for panel in generated_panels:
+            download_button(
+                f"Download Panel {panel['number']}",
+                partial(image_store.read_image, panel["image"]),
+                file_name=f"comic_panel_{panel['number']}_{panel['image']['filename']}",
+                mime=f"image/{panel['image']['type']}" if panel['image']['type'] != 'jpeg' else "image/jpg"
+            )
+
+def show_job(job_id):
+    """Shows a background job's status, refreshing the page until it finishes.
+
+    A finished job becomes the session's strip, so its panels can be edited.
+    """
+    job = get_job_queue().get(job_id)
+    if job is None:
         return
     
-    try:
-        if os.name == 'nt':  # Windows
-            comfyui_process = subprocess.Popen(["python", "main.py"], cwd=COMFYUI_PATH)
-        else:  # Linux or Mac
-            comfyui_process = subprocess.Popen(["python3", "main.py"], cwd=COMFYUI_PATH)
-        
-        # Check if server is up
-        start_time = time.time()
-        while time.time() - start_time < 30:  # 30 second timeout
-            try:
-                requests.get("http://127.0.0.1:8188/", timeout=1)
-                server_running = True
-                st.success("ComfyUI started successfully!")
-                return
-            except requests.exceptions.RequestException:
-                time.sleep(1)
-        
-        st.warning("ComfyUI started but may not be fully initialized. Proceed with caution.")
-        server_running = True
-    except Exception as e:
-        st.error(f"Failed to start ComfyUI: {e}")
-
-def stop_comfyui():
-    """Stops the ComfyUI subprocess."""
-    global comfyui_process, server_running
-    if comfyui_process:
-        comfyui_process.terminate()
-        try:
-            comfyui_process.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            comfyui_process.kill()
-        comfyui_process = None
-        server_running = False
-        st.success("ComfyUI has been shut down.")
+    if job["status"] in (job_queue.QUEUED, job_queue.RUNNING):
+        if job["status"] == job_queue.QUEUED:
+            st.info(f"Comic strip queued ({get_job_queue().position(job_id)} jobs ahead)...")
+        else:
+            st.info(f"Generating comic strip for \"{job['payload']['topic']}\" "
+                    f"({time.time() - job['started']:.0f}s so far)...")
+        time.sleep(JOB_POLL_INTERVAL)
+        st.rerun()
+    elif job["status"] == job_queue.FAILED:
+        st.error(f"Background job failed: {job['error']}")
     else:
-        st.info("No ComfyUI process to stop.")
-
-def check_server_status():
-    """Checks if the ComfyUI server is running."""
-    try:
-        response = requests.get("http://127.0.0.1:8188/", timeout=1)
-        return response.status_code == 200
-    except:
-        return False
-
-def queue_prompt(prompt):
-    """Queues a prompt to the ComfyUI API."""
-    p = {"prompt": prompt, "client_id": CLIENT_ID}
-    data = json.dumps(p).encode('utf-8')
-    try:
-        req = requests.post(url=API_URL, data=data)
-        return json.loads(req.text)
-    except requests.exceptions.RequestException as e:
-        st.error(f"API error: {e}")
-        return None
-
-def get_image(prompt_id):
-    """Retrieves the generated image from the ComfyUI API."""
-    output_images = []
-    start_time = time.time()
-    timeout = 3600  # 1 hour timeout
-    
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+        payload = job["payload"]
+        workflow_json = payload.get("workflow") or load_custom_workflow()
+        job_config = job["result"].get("config", payload["config"])  # With the seed the worker picked
+        generated_panels = [attach_image(panel, panel["image"], workflow_json, job_config)
+                            for panel in load_job_panels(job["result"])]
+        if generated_panels:
+            save_strip(payload["topic"], job["result"]["script"], generated_panels, workflow_json, job_config)
+            st.session_state.pop("job_id", None)
+            st.rerun()
+        else:
+            st.error("Failed to generate any comic panels. Check the ComfyUI logs for errors.")
+
+# --- Panel Editing ---
+
+def save_strip(topic, script, generated_panels, workflow_json, config, notes=(), auto_finish=False):
+    """Keeps a finished strip in the session so its panels can be edited on later reruns.
+
+    Panels only hold paths to their images, so this costs no image memory.
+    With ``auto_finish`` its previews are rendered at full quality as soon as
+    the strip has been shown.
+    """
+    st.session_state["strip"] = {
+        "id": uuid.uuid4().hex,
+        "topic": topic,
+        "script": script,
+        "panels": sorted(generated_panels, key=lambda x: x["number"]),
+        "workflow": workflow_json,
+        "seed": config["seed"],  # Kept when the sidebar seed is random
+        "notes": list(notes),
+        "auto_finish": auto_finish,
+    }
+
+def replace_panels(strip, updated_panels):
+    """Swaps re-rendered panels into the session's strip."""
+    updated = {panel["number"]: panel for panel in updated_panels}
+    strip["panels"] = [updated.get(panel["number"], panel) for panel in strip["panels"]]
+    st.session_state["strip"] = strip
+
+def update_panels(strip, outdated, config, image_session, use_cache):
+    """Re-renders only the panels whose inputs changed, all at once, previews as previews."""
+    updated_panels = []
+    tiers = (
+        ([panel for panel in outdated if is_preview(panel)], preview_config(config, strip["workflow"])),
+        ([panel for panel in outdated if not is_preview(panel)], config),
+    )
+    with tracing.trace("panels", "panel_redraws", topic=strip["topic"], panels=len(outdated)), image_store.strip(image_session):
+        with st.spinner(f"Re-rendering {len(outdated)} panels..."):
+            for tier_panels, tier_config in tiers:
+                for panel, panel_image in generate_panels_pipelined(tier_panels, strip["workflow"], tier_config,
+                                                                    use_cache=use_cache):
+                    if panel_image:
+                        updated_panels.append(attach_image(panel, panel_image, strip["workflow"], config))
+                    else:
+                        st.error(f"Failed to generate image for panel {panel['number']}")
+    replace_panels(strip, updated_panels)
+
+def finish_previews(strip, previews, config, image_session, use_cache):
+    """Renders the kept previews at full quality, all at once."""
+    finished = []
+    with tracing.trace("finish", "strip_finishes", topic=strip["topic"], panels=len(previews)), image_store.strip(image_session):
+        with st.spinner(f"Rendering {len(previews)} panels at full quality..."):
+            for preview, panel in finish_panels(previews, strip["workflow"], config, use_cache=use_cache):
+                if panel:
+                    finished.append(panel)
+                else:
+                    st.error(f"Failed to render panel {preview['number']} at full quality")
+    replace_panels(strip, finished)
+
+def show_strip(strip, config, image_session, use_cache, border_width, border_color, text_height,
+               export_format="PNG", export_quality=90, panel_downloads=False):
+    """Shows the session's strip with per-panel redraw and prompt editing.
+
+    Each panel remembers the inputs it was rendered from; panels whose inputs
+    the sidebar has since changed are flagged and can be updated on their
+    own, reusing the script and every other panel. Previews can be finished
+    at full quality one by one or all together.
+    """
+    panels = strip["panels"]
+    workflow_json = strip["workflow"]
+    store = get_image_store()
+    store.touch([panel["image"] for panel in panels])  # Evict older strips before the one on screen
+    stale = {panel["number"]: stale_inputs(panel, workflow_json, config) for panel in panels}
+    outdated = [panel for panel in panels if stale[panel["number"]]]
+    previews = [panel for panel in panels if is_preview(panel)]
     
-    while time.time() - start_time < timeout:
-        try:
-            history = requests.get(url=HISTORY_URL + prompt_id, timeout=5).json()
-            
-            # Update progress if available
-            if prompt_id in history and "outputs" in history[prompt_id]:
-                if "progress" in history[prompt_id]:
-                    progress = history[prompt_id]["progress"]
-                    progress_bar.progress(progress)
-                    status_text.text(f"Generation progress: {progress*100:.1f}%")
-                
-                # Check if generation is complete
-                for node_id in history[prompt_id]['outputs']:
-                    if "images" in history[prompt_id]['outputs'][node_id]:
-                        for image in history[prompt_id]['outputs'][node_id]['images']:
-                            image_url = f"http://127.0.0.1:8188/view?filename={image['filename']}&subfolder={image['subfolder']}&type={image['type']}"
-                            try:
-                                image_data = requests.get(url=image_url, timeout=5).content
-                                output_images.append({
-                                    "data": image_data,
-                                    "filename": image['filename'],
-                                    "subfolder": image.get('subfolder', ''),
-                                    "type": image.get('type', '')
-                                })
-                            except requests.exceptions.RequestException:
-                                continue
-                        
-                        progress_bar.progress(1.0)
-                        status_text.text("Generation complete!")
-                        return output_images
-            
-            time.sleep(POLL_INTERVAL)
-        except Exception as e:
-            st.warning(f"Error checking generation status: {e}")
-            time.sleep(POLL_INTERVAL * 2)  # Back off on errors
+    st.subheader("Generated Comic Strip")
+    with st.expander("Generated Comic Script"):
+        st.text_area("Full Script", strip["script"], height=200, key=f"{strip['id']}_script")
     
-    status_text.text("Generation timed out!")
-    return output_images
-
-def update_workflow_with_prompt(workflow, positive_prompt, negative_prompt=""):
-    """Updates the workflow with the provided prompts."""
-    # Make a deep copy to avoid modifying the original
-    updated_workflow = json.loads(json.dumps(workflow))
+    rerender = None  # (panel, new prompt, new seed, use cache) chosen this run
+    if outdated:
+        st.warning(f"{len(outdated)} of {len(panels)} panels are out of date with the current settings.")
+        if st.button(f"Update {len(outdated)} changed panel{'s' if len(outdated) > 1 else ''}"):
+            if not check_server_status():
+                st.error("ComfyUI server is not running. Please start it first.")
+            else:
+                update_panels(strip, outdated, config, image_session, use_cache)
+                st.rerun()
     
-    # Find and update CLIP text encode nodes
-    for node_id, node in updated_workflow.items():
-        if node["class_type"] == "CLIPTextEncode":
-            # Check if this is likely a positive or negative prompt node
-            if "negative" not in node_id.lower() and "neg" not in node_id.lower():
-                if "ugly" not in node["inputs"].get("text", "").lower():  # Heuristic for positive prompt
-                    node["inputs"]["text"] = positive_prompt
-            else:  # Likely negative prompt
-                if negative_prompt:
-                    node["inputs"]["text"] = negative_prompt
-        
-        # Also update T5 encoders if present
-        elif node["class_type"] == "T5TextEncode":
-            node["inputs"]["text"] = positive_prompt
-            
-    return updated_workflow
-
-# Function to generate a single panel image
-def generate_panel_image(panel_prompt, workflow_json, config):
-    """Generates an image for a single comic panel."""
-    # Update workflow with panel-specific parameters
-    for node_id, node in workflow_json.items():
-        if node["class_type"] == "Empty Latent Image":
-            node["inputs"]["width"] = config["width"]
-            node["inputs"]["height"] = config["height"]
-        elif node["class_type"] == "KSampler":
-            node["inputs"]["steps"] = config["steps"]
-            node["inputs"]["cfg"] = config["cfg"]
-            node["inputs"]["seed"] = config["seed"] + int(panel_prompt["number"])  # Use different seed for each panel
-            node["inputs"]["sampler_name"] = config["sampler"]
-            node["inputs"]["scheduler"] = config["scheduler"]
-        elif node["class_type"] == "Load Checkpoint":
-            node["inputs"]["ckpt_name"] = config["model_path"]
-
-    # Create comic-specific prompt
-    comic_style_prompt = f"comic panel, cartoon style, {panel_prompt['prompt']}"
+    finish = []  # Previews to render at full quality this run
+    if previews and not strip.get("auto_finish"):
+        st.info(f"{len(previews)} of {len(panels)} panels are quick previews. "
+                "Redraw or edit them until they look right, then finish them at full quality.")
+        if st.button(f"Finish {len(previews)} preview{'s' if len(previews) > 1 else ''}"):
+            finish = previews
     
-    # Update prompts in workflow
-    updated_workflow = update_workflow_with_prompt(workflow_json, comic_style_prompt)
+    cols = st.columns(min(4, len(panels)))
+    for i, panel in enumerate(panels):
+        number = panel["number"]
+        with cols[i % len(cols)]:
+            if os.path.exists(panel["image"]["path"]):
+                render_panel(panel, border_width, border_color, text_height)
+            else:
+                st.info(f"Panel {number}: the image has expired, redraw it to see it again.")
+            if stale[number]:
+                st.caption("Out of date: " + ", ".join(stale[number]))
+            if is_preview(panel):
+                st.caption("Preview")
+                if st.button("Finish", key=f"{strip['id']}_finish_{number}", help="Render this panel at full quality"):
+                    finish = [panel]
+            if st.button("Redraw", key=f"{strip['id']}_redraw_{number}", help="Render this panel again with a new seed"):
+                rerender = (panel, None, True, True)
+            with st.expander(f"Edit panel {number}"):
+                prompt = st.text_area("Image prompt", panel["prompt"], key=f"{strip['id']}_prompt_{number}")
+                keep_seed = st.checkbox("Keep seed", value=True, key=f"{strip['id']}_keep_seed_{number}")
+                if st.button("Apply", key=f"{strip['id']}_apply_{number}"):
+                    # Same prompt and seed would just hit the cache, so render it afresh
+                    rerender = (panel, prompt, not keep_seed, prompt != panel["prompt"] or not keep_seed)
     
-    # Queue the prompt
-    result = queue_prompt(updated_workflow)
-    if not result or "prompt_id" not in result:
-        return None
+    if rerender:
+        panel, prompt, new_seed, panel_cache = rerender
+        if not check_server_status():
+            st.error("ComfyUI server is not running. Please start it first.")
+        else:
+            with tracing.trace("panels", "panel_redraws", topic=strip["topic"], panels=1), image_store.strip(image_session):
+                with st.spinner(f"Re-rendering panel {panel['number']}..."):
+                    updated = regenerate_panel(panel, workflow_json, config, prompt, new_seed,
+                                               use_cache and panel_cache, StreamlitProgress())
+            if updated:
+                replace_panels(strip, [updated])
+                st.rerun()
+            st.error(f"Failed to generate image for panel {panel['number']}")
     
-    prompt_id = result["prompt_id"]
+    if previews and strip.get("auto_finish"):
+        # The previews are already on screen while the full-quality pass runs
+        strip["auto_finish"] = False
+        finish = previews
+    if finish:
+        if not check_server_status():
+            st.error("ComfyUI server is not running. Please start it first.")
+        else:
+            finish_previews(strip, finish, config, image_session, use_cache)
+            st.rerun()
     
-    # Get generated image
-    output_images = get_image(prompt_id)
-    if output_images:
-        return output_images[0]  # Return first image
-    return None
+    for note in strip["notes"]:
+        st.caption(note)
+    available = [panel for panel in panels if os.path.exists(panel["image"]["path"])]
+    if available:
+        show_downloads(available, border_width, border_color, text_height,
+                       export_format, export_quality, panel_downloads)
 
 # --- Combined Streamlit App ---
 
 def main():
     """Main Streamlit application."""
     st.set_page_config(page_title="Comic Strip Generator", layout="wide")
+    if tracing.METRICS_PORT:
+        tracing.start_server(tracing.METRICS_PORT)
     st.title("Comic Strip Generator 🎭")
     st.write(STARTUP_PROMPT)
 
@@ -376,22 +376,36 @@ def main():
         st.title("ComfyUI Controls")
         
         # Server control
-        server_status = check_server_status()
-        if server_status:
-            st.success("ComfyUI server is running")
+        selected_model = st.session_state.get("model_path", DEFAULT_MODEL)
+        selected_workflow = active_workflow()
+        # Cached and refreshed in the background, so reruns do not wait on the network
+        if server_status(COMFYUI_HOST):
+            # Load the selected model and workflow in the background so the first strip is not a cold start
+            ensure_warm(selected_model, selected_workflow)
+            if readiness(COMFYUI_HOST, selected_model, selected_workflow) == "warm":
+                st.success("ComfyUI server is running (warm)")
+            else:
+                st.info("ComfyUI server is up, loading the model...")
             if st.button("Stop ComfyUI"):
-                stop_comfyui()
+                stop_comfyui(StreamlitProgress())
         else:
             st.error("ComfyUI server is not running")
             if st.button("Start ComfyUI"):
-                start_thread = threading.Thread(target=start_comfyui)
+                start_thread = threading.Thread(target=start_comfyui, args=(StreamlitProgress(), selected_model))
                 start_thread.start()
         
+        # Render server pool
+        if len(COMFYUI_SERVERS) > 1:
+            st.caption("Render servers")
+            for backend in get_backend_pool().backends:
+                state = readiness(backend.host, selected_model, selected_workflow) if backend.healthy else "ejected"
+                st.text(f"{backend.host}: {state}, load {backend.load}, in flight {backend.in_flight}")
+        
         st.divider()
         
         # Model configuration
         st.subheader("Model Configuration")
-        model_path = st.text_input("Model Path", DEFAULT_MODEL)
+        model_path = st.text_input("Model Path", DEFAULT_MODEL, key="model_path")
         width = st.slider("Width", 256, 1024, 512, 64)  # Reduced default size for comic panels
         height = st.slider("Height", 256, 1024, 512, 64)  # Reduced default size for comic panels
         
@@ -407,9 +421,79 @@ def main():
         
         st.divider()
         
+        # Generation mode
+        st.subheader("Generation Mode")
+        pipelined = st.checkbox("Pipelined generation (queue all panels at once)", value=True)
+        preview_first = st.checkbox("Preview panels first", value=False,
+                                    help="Draws quick low-step, reduced-size panels from the same seeds; "
+                                         "full quality is rendered only for the panels you keep")
+        auto_finish = st.checkbox("Finish previews automatically", value=False,
+                                  help="Renders every preview at full quality right after it is shown") \
+            if preview_first else False
+        streaming = st.checkbox("Start rendering while the script is being written", value=True)
+        batched = st.checkbox("Render all panels as one ComfyUI job", value=False,
+                              help="Used instead of per-panel jobs when the script is not streamed")
+        background = st.checkbox("Run as a background job", value=False,
+                                 help="Queues the strip for comic_worker.py so it survives reruns and refreshes")
+        priority = st.slider("Job priority", 0, 10, 5) if background else 0
+        strip_timeout = st.slider("Strip timeout (seconds)", 60, 3600, STRIP_TIMEOUT, 60)
+        
+        st.divider()
+        
+        # Image cache
+        st.subheader("Image Cache")
+        use_cache = st.checkbox("Reuse cached panels", value=True)
+        cache = get_image_cache()
+        if st.button("Purge image cache"):
+            cache.purge()
+        cache_stats = cache.stats()
+        st.caption(
+            f"{cache_stats['entries']} images, {cache_stats['bytes'] / 1024 ** 2:.1f} MB · "
+            f"{cache_stats['hits']} hits / {cache_stats['misses']} misses"
+        )
+        store_stats = get_image_store().stats()
+        st.caption(
+            f"Spooled: {store_stats['strips']} strips from {store_stats['sessions']} sessions, "
+            f"{store_stats['bytes'] / 1024 ** 2:.1f} MB"
+        )
+        # Prompt encoders ComfyUI answered from its node cache instead of running them again
+        _, counters = tracing.metrics.snapshot()
+        encodes = counters.get("conditioning_hits", 0) + counters.get("conditioning_misses", 0)
+        if encodes:
+            st.caption(f"Prompt encodings reused: {counters.get('conditioning_hits', 0)} of {encodes} "
+                       f"({counters.get('conditioning_hits', 0) / encodes:.0%})")
+        
+        # Where the last strip's time went
+        traces = tracing.recent_traces()
+        if traces:
+            with st.expander("Last strip trace"):
+                st.text(trace_summary(traces[-1]))
+        
+        # HTTP overhead per endpoint since the app started
+        with st.expander("ComfyUI HTTP stats"):
+            for endpoint, stats in sorted(comfyui_client.total_stats().items()):
+                mean_ms = stats["seconds"] / stats["count"] * 1000 if stats["count"] else 0
+                p50 = comfyui_client.percentile(stats["buckets"], 0.5) * 1000
+                p95 = comfyui_client.percentile(stats["buckets"], 0.95) * 1000
+                st.text(f"{endpoint}: {stats['count']} req, {stats['errors']} err, "
+                        f"mean {mean_ms:.0f} ms, p50 ≤{p50:.0f} ms, p95 ≤{p95:.0f} ms")
+        
+        st.divider()
+        
+        # Script generation
+        st.subheader("Script Generation")
+        keep_alive = st.text_input("Keep model loaded for", OLLAMA_KEEP_ALIVE)
+        use_script_cache = st.checkbox("Reuse scripts for repeated topics", value=True)
+        panel_count = st.slider("Panels", 1, MAX_PANELS, PANEL_COUNT)
+        structured = st.checkbox("Ask for the panels as JSON", value=STRUCTURED_SCRIPTS,
+                                 help="Ollama constrains the script to a schema with a prompt, description and "
+                                      "text per panel (needs Ollama 0.5 or later)")
+        
+        st.divider()
+        
         # Workflow upload
         st.subheader("Custom Workflow")
-        uploaded_workflow = st.file_uploader("Upload Custom Workflow (JSON)", type=["json"])
+        uploaded_workflow = st.file_uploader("Upload Custom Workflow (JSON)", type=["json"], key="workflow_file")
         
         # Comic display options
         st.divider()
@@ -417,128 +501,204 @@ def main():
         text_height = st.slider("Text Box Height", 50, 200, 100)
         border_width = st.slider("Panel Border Width", 1, 10, 2)
         border_color = st.color_picker("Border Color", "#000000")
+        export_format = st.selectbox("Strip Download Format", list(strip_export.FORMATS))
+        export_quality = st.slider("Download Quality", 50, 100, 90, 5) if export_format in ("WebP", "JPEG") else 90
+        panel_downloads = st.checkbox("Also offer individual panel downloads", value=False)
 
     # User input
     user_prompt = st.text_input("Enter a comic topic or scenario:")
 
+    # Configuration for image generation
+    config = {
+        "model_path": model_path,
+        "width": width,
+        "height": height,
+        "steps": steps,
+        "cfg": cfg,
+        "seed": seed if seed != 0 else int(time.time()),
+        "sampler": sampler,
+        "scheduler": scheduler
+    }
+
+    # This session's strips share one spool quota; its least recently used strips are evicted first
+    image_session = st.session_state.setdefault("image_session", uuid.uuid4().hex)
+    
     # Generate and display comic strip
-    if st.button("Generate Comic Strip"):
-        if user_prompt:
-            # Generate comic script
-            with st.spinner("Generating comic script..."):
-                comic_script = generate_comic(user_prompt)
+    generate = st.button("Generate Comic Strip")
+    saved = False
+    if generate:
+        if user_prompt and background:
+            # Hand the strip to the worker; the page just follows the job from here on
+            workflow_json = load_uploaded_workflow(uploaded_workflow)
+            payload = {
+                "topic": user_prompt,
+                "config": dict(config, seed=seed),  # 0 stays random, so identical requests share one job
+                "workflow": workflow_json,
+                "batched": batched,
+                "use_cache": use_cache,
+                "script_cache": use_script_cache,
+                "keep_alive": keep_alive,
+                "timeout": strip_timeout,
+                "panel_count": panel_count,
+                "structured": structured
+            }
+            st.session_state["job_id"] = get_job_queue().submit(payload, priority)
+        elif user_prompt:
+            st.session_state.pop("job_id", None)
+            mode = "streaming" if streaming else "batched" if batched else "pipelined" if pipelined else "sequential"
+            with tracing.trace("strip", "strips", topic=user_prompt, mode=mode) as strip_trace, image_store.strip(image_session):
+                if not streaming:
+                    # Generate comic script
+                    with st.spinner("Generating comic script..."):
+                        # Malformed scripts are written again before any panel is rendered
+                        try:
+                            comic_script, panels = write_script(user_prompt, panel_count, structured,
+                                                                use_script_cache, keep_alive)
+                        except ScriptError as e:
+                            st.error(f"Could not write a usable script: {e}")
+                            return
+                        
+                        # Display the full script in an expander
+                        with st.expander("Generated Comic Script"):
+                            st.text_area("Full Script", comic_script, height=200)
+
+                # Check if ComfyUI is running
+                if not check_server_status():
+                    st.error("ComfyUI server is not running. Please start it first.")
+                    return
+
+                # Load workflow
+                workflow_json = load_uploaded_workflow(uploaded_workflow)
+
+                if not workflow_json:
+                    st.error("No workflow available. Please upload a valid workflow or fix the default workflow.")
+                    return
                 
-                # Parse script into panels
-                panels = parse_comic_script(comic_script)
+                # Previews keep the seeds but sample fewer steps at a smaller size
+                render_config = preview_config(config, workflow_json) if preview_first else config
                 
-                # Display the full script in an expander
-                with st.expander("Generated Comic Script"):
-                    st.text_area("Full Script", comic_script, height=200)
-
-            # Check if ComfyUI is running
-            if not check_server_status():
-                st.error("ComfyUI server is not running. Please start it first.")
-                return
-
-            # Load workflow
-            if uploaded_workflow:
-                try:
-                    workflow_json = json.load(uploaded_workflow)
-                    st.success("Custom workflow loaded successfully")
-                except Exception as e:
-                    st.error(f"Failed to load workflow: {e}")
-                    workflow_json = load_custom_workflow()
-            else:
-                workflow_json = load_custom_workflow()
-
-            if not workflow_json:
-                st.error("No workflow available. Please upload a valid workflow or fix the default workflow.")
-                return
-            
-            # Configuration for image generation
-            config = {
-                "model_path": model_path,
-                "width": width,
-                "height": height,
-                "steps": steps,
-                "cfg": cfg,
-                "seed": seed if seed != 0 else int(time.time()),
-                "sampler": sampler,
-                "scheduler": scheduler
-            }
-            
-            # Generate images for each panel
-            generated_panels = []
-            for panel in panels:
-                with st.spinner(f"Generating panel {panel['number']}..."):
-                    # Display placeholder while image is being generated
-                    panel_placeholder = st.empty()
-                    panel_placeholder.text(f"Generating panel {panel['number']}...")
+                # Generate images for each panel
+                http_before = comfyui_client.total_stats()
+                generated_panels = []
+                notes = []
+                if streaming:
+                    st.subheader("Generated Comic Strip")
+                    script_placeholder = st.empty()
                     
-                    # Generate image for this panel
-                    panel_image = generate_panel_image(panel, workflow_json, config)
-                    if panel_image:
-                        panel["image"] = panel_image
-                        generated_panels.append(panel)
-                        panel_placeholder.empty()
+                    # Fill each panel's slot as soon as its image is ready, four panels to a row
+                    cols = st.columns(min(4, panel_count))
+                    slots = [cols[i % len(cols)].empty() for i in range(panel_count)]
+                    for i, slot in enumerate(slots):
+                        slot.text(f"Waiting for panel {i + 1}...")
+                    
+                    stats = {}
+                    with st.spinner("Writing script and generating panels..."):
+                        for panel, panel_image in generate_strip_streaming(
+                            user_prompt, workflow_json, render_config, strip_timeout, use_cache, stats,
+                            on_script=script_placeholder.text, script_cache=use_script_cache, keep_alive=keep_alive,
+                            panel_count=panel_count, structured=structured, progress=StreamlitProgress()
+                        ):
+                            slot = slots[panel["number"] - 1]
+                            if panel_image:
+                                panel["image"] = panel_image
+                                generated_panels.append(panel)
+                                with slot.container():
+                                    render_panel(panel, border_width, border_color, text_height)
+                            else:
+                                slot.error(f"Failed to generate image for panel {panel['number']}")
+                    
+                    script_placeholder.empty()
+                    if "error" in stats:
+                        st.error(f"Could not write a usable script: {stats['error']}")
+                    with st.expander("Generated Comic Script"):
+                        st.text_area("Full Script", stats.get("script", ""), height=200)
+                    
+                    timings = [f"total {stats['total_time']:.1f}s", f"script {stats.get('script_time', 0):.1f}s"]
+                    if "time_to_first_panel" in stats:
+                        timings.append(f"first panel queued {stats['time_to_first_panel']:.1f}s")
+                    if "time_to_first_image" in stats:
+                        timings.append(f"first image {stats['time_to_first_image']:.1f}s")
+                    notes.append("Timing: " + " · ".join(timings))
+                    st.caption(notes[-1])
+                    
+                    generated_panels.sort(key=lambda x: x["number"])
+                elif pipelined or batched:
+                    st.subheader("Generated Comic Strip")
+                    
+                    # Reserve a slot per panel, four to a row, and fill each one as soon as it finishes
+                    cols = st.columns(min(4, len(panels)))
+                    slots = {}
+                    for i, panel in enumerate(panels):
+                        slots[panel["number"]] = cols[i % len(cols)].empty()
+                        slots[panel["number"]].text(f"Generating panel {panel['number']}...")
+                    
+                    if batched:
+                        # One job for the whole strip, so its sampler progress can be shown here
+                        panel_results = generate_panels_batched(panels, workflow_json, render_config, strip_timeout,
+                                                                use_cache, StreamlitProgress())
                     else:
-                        st.error(f"Failed to generate image for panel {panel['number']}")
-            
-            # Display the comic strip in the desired format
-            if generated_panels:
-                st.subheader("Generated Comic Strip")
-                
-                # Use columns for panel layout
-                cols = st.columns(min(4, len(generated_panels)))
-                
-                for i, panel in enumerate(generated_panels):
-                    with cols[i % len(cols)]:
-                        # Create panel container with border
-                        st.markdown(f"""
-                        <div style="border: {border_width}px solid {border_color}; margin: 5px; padding: 0;">
-                        </div>
-                        """, unsafe_allow_html=True)
-                        
-                        # Display image
-                        st.image(
-                            panel["image"]["data"], 
-                            caption=f"Panel {panel['number']}", 
-                            use_column_width=True
-                        )
-                        
-                        # Display text in a box below the image
-                        st.markdown(f"""
-                        <div style="
-                            border: {border_width}px solid {border_color}; 
-                            border-top: none;
-                            padding: 10px; 
-                            background-color: white; 
-                            min-height: {text_height}px;
-                            overflow-y: auto;
-                            margin-bottom: 15px;
-                            font-family: 'Comic Sans MS', cursive, sans-serif;
-                        ">
-                            {panel["dialogue"]}
-                        </div>
-                        """, unsafe_allow_html=True)
+                        panel_results = generate_panels_pipelined(panels, workflow_json, render_config, strip_timeout,
+                                                                  use_cache)
+                    with st.spinner("Generating panels..."):
+                        for panel, panel_image in panel_results:
+                            slot = slots[panel["number"]]
+                            if panel_image:
+                                panel["image"] = panel_image
+                                generated_panels.append(panel)
+                                with slot.container():
+                                    render_panel(panel, border_width, border_color, text_height)
+                            else:
+                                slot.error(f"Failed to generate image for panel {panel['number']}")
+                    
+                    generated_panels.sort(key=lambda x: x["number"])
+                else:
+                    for panel in panels:
+                        with st.spinner(f"Generating panel {panel['number']}..."):
+                            # Display placeholder while image is being generated
+                            panel_placeholder = st.empty()
+                            panel_placeholder.text(f"Generating panel {panel['number']}...")
+                            
+                            # Generate image for this panel
+                            panel_image = generate_panel_image(panel, workflow_json, render_config, use_cache,
+                                                               StreamlitProgress())
+                            if panel_image:
+                                panel["image"] = panel_image
+                                generated_panels.append(panel)
+                                panel_placeholder.empty()
+                            else:
+                                st.error(f"Failed to generate image for panel {panel['number']}")
                 
-                # Download button for the whole comic strip
-                st.subheader("Download Options")
-                # Here we would implement the download functionality
-                st.info("Download functionality for complete comic will be implemented in future updates.")
+                notes.append(http_summary(http_before, comfyui_client.total_stats()))
+                st.caption(notes[-1])
+                strip_trace.set(panels=len(generated_panels))
                 
-                # Allow downloading individual panels
-                for panel in generated_panels:
-                    st.download_button(
-                        f"Download Panel {panel['number']}",
-                        data=panel["image"]["data"],
-                        file_name=f"comic_panel_{panel['number']}_{panel['image']['filename']}",
-                        mime=f"image/{panel['image']['type']}" if panel['image']['type'] != 'jpeg' else "image/jpg"
-                    )
-            else:
-                st.error("Failed to generate any comic panels. Check the ComfyUI logs for errors.")
+                # Keep the strip, with what each panel was rendered from, for editing on later runs
+                if generated_panels:
+                    script = stats.get("script", "") if streaming else comic_script
+                    if preview_first:
+                        generated_panels = [dict(panel, quality=PREVIEW) for panel in generated_panels]
+                    generated_panels = [attach_image(panel, panel["image"], workflow_json, config)
+                                        for panel in generated_panels]
+                    save_strip(user_prompt, script, generated_panels, workflow_json, config, notes, auto_finish)
+                    saved = True
+                else:
+                    st.error("Failed to generate any comic panels. Check the ComfyUI logs for errors.")
         else:
             st.warning("Please enter a topic to generate a comic!")
+    if saved:
+        st.rerun()  # Shows the saved strip with its panel actions
+    
+    # Follow this session's background job across reruns
+    if st.session_state.get("job_id"):
+        show_job(st.session_state["job_id"])
+    
+    # The session's latest strip, editable panel by panel
+    strip = st.session_state.get("strip")
+    if strip and not generate:
+        # A random sidebar seed keeps the seed the strip was drawn with
+        strip_config = config if seed else dict(config, seed=strip["seed"])
+        show_strip(strip, strip_config, image_session, use_cache, border_width, border_color, text_height,
+                   export_format, export_quality, panel_downloads)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,495 @@
+"""A small stand-in for the ComfyUI HTTP/WebSocket API, for offline testing.
+
+It implements the endpoints ComicCrafter talks to: ``/``, ``/prompt``,
+``/history/<id>``, ``/view``, ``/queue``, ``/interrupt``, ``/upload/image`` and ``/ws``. Prompts without a
+``class_type`` on every node are rejected like ComfyUI's validation does. Prompts are executed one
+at a time by a worker thread that sleeps ``render_latency`` seconds per job,
+emits the same WebSocket messages as ComfyUI and answers with solid-colour
+PNGs. Node results are cached across prompts like ComfyUI does, so
+unchanged nodes (a repeated prompt encoder, say) are reported as
+``execution_cached`` and skipped. Only the standard library is used.
+
+Run it in place of ComfyUI with::
+
+    python fake_comfyui.py --port 8188 --latency 2
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+SAVE_NODE_TYPES = ("SaveImage", "Save Image", "PreviewImage")
+UPLOAD_NAME = re.compile(rb'name="image"; filename="([^"]+)"')
+TEXT_INPUTS = ("text", "clip_l", "t5xxl", "text_g", "text_l")
+
+
+def make_png(width, height, color):
+    """Encodes a solid-colour RGB PNG."""
+    row = b"\x00" + bytes(color) * width
+    raw = zlib.compress(row * height, 1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+class WebSocketConnection:
+    """Server side of one WebSocket, enough for ComfyUI's text messages."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.open = True
+
+    def send_json(self, message):
+        payload = json.dumps(message).encode("utf-8")
+        header = bytearray([0x81])
+        if len(payload) < 126:
+            header.append(len(payload))
+        elif len(payload) < 1 << 16:
+            header.append(126)
+            header += struct.pack(">H", len(payload))
+        else:
+            header.append(127)
+            header += struct.pack(">Q", len(payload))
+        with self.lock:
+            try:
+                self.sock.sendall(bytes(header) + payload)
+            except OSError:
+                self.open = False
+
+    def _read_exact(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("socket closed")
+            data += chunk
+        return data
+
+    def serve(self):
+        """Reads client frames until the client closes the connection."""
+        try:
+            while self.open:
+                first, second = self._read_exact(2)
+                opcode = first & 0x0F
+                length = second & 0x7F
+                if length == 126:
+                    length = struct.unpack(">H", self._read_exact(2))[0]
+                elif length == 127:
+                    length = struct.unpack(">Q", self._read_exact(8))[0]
+                mask = self._read_exact(4) if second & 0x80 else b""
+                payload = self._read_exact(length)
+                if mask:
+                    payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+                if opcode == 0x8:  # Close
+                    with self.lock:
+                        self.sock.sendall(b"\x88\x00")
+                    break
+                if opcode == 0x9:  # Ping
+                    with self.lock:
+                        self.sock.sendall(bytes([0x8A, len(payload)]) + payload)
+        except (OSError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.open = False
+
+
+class FakeComfyUI:
+    """In-process fake ComfyUI server.
+
+    ``render_latency`` is the time one prompt takes, spread over ``steps``
+    sampler progress events. ``failure_rate`` is the probability that a
+    prompt ends with an ``execution_error`` instead of an image.
+    ``response_delay`` is added to every HTTP answer, like a remote or busy
+    server. ``step_latency`` adds seconds per sampler step and megapixel,
+    scaled by ``denoise``, so smaller or partial renders finish sooner.
+    Prompts loading an image that was not uploaded fail. Each text encoder
+    that is not served from the cache takes ``encode_latency`` seconds.
+    ``cache_size`` node results are kept, like ComfyUI's ``--cache-lru``;
+    with 0 only the previous prompt's are, like its default cache.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, render_latency=0.2, steps=10, failure_rate=0.0, seed=None,
+                 response_delay=0.0, step_latency=0.0, encode_latency=0.0, cache_size=0):
+        self.render_latency = render_latency
+        self.step_latency = step_latency
+        self.encode_latency = encode_latency
+        self.cache_size = cache_size
+        self.node_cache = OrderedDict()  # Node signatures whose results are kept
+        self.response_delay = response_delay
+        self.steps = steps
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.history = {}
+        self.images = {}
+        self.uploads = set()
+        self.pending = []
+        self.running = None
+        self.interrupted = None  # Prompt ID the running job is told to stop
+        self.request_counts = Counter()
+        self.sockets = {}
+        self.connections = set()
+        self.lock = threading.Condition()
+        self._counter = 0
+        self._stopped = False
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.host = f"{host}:{self.server.server_address[1]}"
+        self.url = f"http://{self.host}"
+
+    # --- Lifecycle ---
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._worker, daemon=True).start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self._stopped = True
+            self.lock.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        # Drop kept-alive HTTP and WebSocket connections too, like a crashed server
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- Execution ---
+
+    def submit(self, prompt, client_id):
+        with self.lock:
+            self._counter += 1
+            prompt_id = str(uuid.uuid4())
+            self.pending.append((self._counter, prompt_id, prompt, client_id))
+            self.lock.notify_all()
+            return prompt_id, self._counter
+
+    def _send(self, client_id, message):
+        for connection in list(self.sockets.get(client_id, [])):
+            if connection.open:
+                connection.send_json(message)
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self._stopped:
+                    self.lock.wait()
+                if self._stopped:
+                    return
+                job = self.running = self.pending.pop(0)
+            self._execute(*job)
+            with self.lock:
+                self.running = None
+
+    def _execute(self, number, prompt_id, prompt, client_id):
+        started = int(time.time() * 1000)
+        self._send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id, "timestamp": started}})
+        failed = self.random.random() < self.failure_rate
+        outputs = {}
+        signatures = self._signatures(prompt)
+        # Like ComfyUI, only run what an output node needs
+        needed = self._upstream(prompt, [node_id for node_id, node in prompt.items()
+                                         if node.get("class_type") in SAVE_NODE_TYPES])
+        cached = [node_id for node_id, node in prompt.items() if node_id in needed
+                  and signatures[node_id] in self.node_cache and node.get("class_type") not in SAVE_NODE_TYPES]
+        self._send(client_id, {"type": "execution_cached", "data": {"nodes": cached, "prompt_id": prompt_id}})
+        for node_id, node in prompt.items():
+            if node_id in cached or node_id not in needed:
+                continue
+            self._send(client_id, {"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+            inputs = node.get("inputs", {})
+            if node.get("class_type") == "LoadImage" and inputs.get("image") not in self.uploads:
+                failed = True
+                break
+            if any(isinstance(inputs.get(name), str) for name in TEXT_INPUTS):
+                time.sleep(self.encode_latency)
+            if node.get("class_type") == "KSampler":
+                steps = max(1, self.steps)
+                width, height = self._image_size(prompt)
+                latency = self.render_latency + self.step_latency * int(inputs.get("steps", 0)) * \
+                    float(inputs.get("denoise", 1.0)) * width * height / 1e6
+                for step in range(1, steps + 1):
+                    if self.interrupted == prompt_id:
+                        failed = True
+                        break
+                    time.sleep(latency / steps)
+                    self._send(client_id, {"type": "progress", "data": {
+                        "value": step, "max": steps, "prompt_id": prompt_id, "node": node_id}})
+                if failed:
+                    break
+            elif node.get("class_type") in SAVE_NODE_TYPES:
+                width, height = self._image_size(prompt)
+                seed = self._seed(prompt)
+                color = (seed * 37 % 256, seed * 91 % 256, seed * 53 % 256)
+                filename = f"{inputs.get('filename_prefix', 'ComfyUI')}_{number:05d}_.png"
+                self.images[filename] = make_png(width, height, color)
+                output = {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}
+                outputs[node_id] = output
+                self._send(client_id, {"type": "executed", "data": {
+                    "node": node_id, "output": output, "prompt_id": prompt_id}})
+
+        if not failed:
+            self._remember(signatures[node_id] for node_id in needed)
+        
+        # History messages carry millisecond timestamps, as in ComfyUI
+        messages = [["execution_start", {"prompt_id": prompt_id, "timestamp": started}],
+                    ["execution_cached", {"nodes": cached, "prompt_id": prompt_id, "timestamp": started}]]
+        finished = int(time.time() * 1000)
+        if failed:
+            messages.append(["execution_error", {"prompt_id": prompt_id, "timestamp": finished}])
+            status = {"status_str": "error", "completed": False, "messages": messages}
+            self._send(client_id, {"type": "execution_error", "data": {
+                "prompt_id": prompt_id, "exception_message": "Simulated failure"}})
+        else:
+            messages.append(["execution_success", {"prompt_id": prompt_id, "timestamp": finished}])
+            status = {"status_str": "success", "completed": True, "messages": messages}
+        self.history[prompt_id] = {
+            "prompt": [number, prompt_id, prompt, {"client_id": client_id}, list(outputs)],
+            "outputs": outputs,
+            "status": status,
+        }
+        self._send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    @staticmethod
+    def _signatures(prompt):
+        """Returns {node_id: signature} from each node's class, inputs and upstream signatures."""
+        signatures = {}
+        
+        def signature(node_id):
+            if node_id not in signatures:
+                node = prompt[node_id]
+                inputs = {}
+                for name, value in node.get("inputs", {}).items():
+                    if isinstance(value, list) and len(value) == 2 and value[0] in prompt:
+                        value = [signature(value[0]), value[1]]
+                    inputs[name] = value
+                key = json.dumps([node.get("class_type"), inputs], sort_keys=True)
+                signatures[node_id] = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            return signatures[node_id]
+        
+        for node_id in prompt:
+            signature(node_id)
+        return signatures
+
+    @staticmethod
+    def _upstream(prompt, node_ids):
+        needed = set()
+        stack = list(node_ids)
+        while stack:
+            node_id = stack.pop()
+            if node_id in needed or node_id not in prompt:
+                continue
+            needed.add(node_id)
+            stack.extend(value[0] for value in prompt[node_id].get("inputs", {}).values()
+                         if isinstance(value, list) and len(value) == 2)
+        return needed
+
+    def _remember(self, signatures):
+        if not self.cache_size:
+            self.node_cache.clear()
+        for signature in signatures:
+            self.node_cache[signature] = True
+            self.node_cache.move_to_end(signature)
+        while self.cache_size and len(self.node_cache) > self.cache_size:
+            self.node_cache.popitem(last=False)
+
+    @staticmethod
+    def _image_size(prompt):
+        for node in prompt.values():
+            if "width" in node.get("inputs", {}) and "height" in node.get("inputs", {}):
+                return int(node["inputs"]["width"]), int(node["inputs"]["height"])
+        return 64, 64
+
+    @staticmethod
+    def _seed(prompt):
+        for node in prompt.values():
+            if "seed" in node.get("inputs", {}):
+                return int(node["inputs"]["seed"])
+        return 0
+
+    def delete(self, prompt_ids):
+        with self.lock:
+            self.pending = [job for job in self.pending if job[1] not in prompt_ids]
+
+    def interrupt(self, prompt_id=None):
+        with self.lock:
+            if self.running and prompt_id in (None, self.running[1]):
+                self.interrupted = self.running[1]
+
+    def queue_state(self):
+        with self.lock:
+            running = [list(self.running[:3])] if self.running else []
+            pending = [list(job[:3]) for job in self.pending]
+        return {"queue_running": running, "queue_pending": pending}
+
+    # --- HTTP ---
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                fake.connections.add(self.connection)
+
+            def finish(self):
+                fake.connections.discard(self.connection)
+                super().finish()
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake.request_counts[url.path.split("/")[1] or "/"] += 1
+                if fake.response_delay and url.path != "/ws":
+                    time.sleep(fake.response_delay)
+                if url.path == "/":
+                    self._reply(200, b"<html>Fake ComfyUI</html>", "text/html")
+                elif url.path.startswith("/history/"):
+                    prompt_id = url.path[len("/history/"):]
+                    entry = fake.history.get(prompt_id)
+                    self._reply(200, {prompt_id: entry} if entry else {})
+                elif url.path == "/view":
+                    filename = parse_qs(url.query).get("filename", [""])[0]
+                    if filename in fake.images:
+                        self._reply(200, fake.images[filename], "image/png")
+                    else:
+                        self._reply(404, {"error": "not found"})
+                elif url.path == "/queue":
+                    self._reply(200, fake.queue_state())
+                elif url.path == "/ws":
+                    self._websocket(parse_qs(url.query).get("clientId", [""])[0])
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                fake.request_counts[url.path.split("/")[1]] += 1
+                if fake.response_delay:
+                    time.sleep(fake.response_delay)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if url.path == "/prompt":
+                    try:
+                        payload = json.loads(body)
+                        prompt = payload["prompt"]
+                    except (ValueError, KeyError):
+                        self._reply(400, {"error": "invalid prompt"})
+                        return
+                    invalid = {node_id: {"errors": [{"type": "missing_class_type"}], "class_type": None}
+                               for node_id, node in prompt.items() if not node.get("class_type")}
+                    if invalid:
+                        self._reply(400, {"error": {"type": "prompt_outputs_failed_validation",
+                                                    "message": "Prompt outputs failed validation"},
+                                          "node_errors": invalid})
+                        return
+                    prompt_id, number = fake.submit(prompt, payload.get("client_id", ""))
+                    self._reply(200, {"prompt_id": prompt_id, "number": number, "node_errors": {}})
+                elif url.path in ("/queue", "/interrupt"):
+                    try:
+                        payload = json.loads(body or b"{}")
+                    except ValueError:
+                        payload = {}
+                    if url.path == "/queue":
+                        fake.delete(payload.get("delete", []))
+                    else:
+                        fake.interrupt(payload.get("prompt_id"))
+                    self._reply(200, {})
+                elif url.path == "/upload/image":
+                    match = UPLOAD_NAME.search(body)
+                    if not match:
+                        self._reply(400, {"error": "no image"})
+                        return
+                    name = match.group(1).decode("utf-8")
+                    fake.uploads.add(name)
+                    self._reply(200, {"name": name, "subfolder": "", "type": "input"})
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def _websocket(self, client_id):
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+                connection = WebSocketConnection(self.connection)
+                fake.sockets.setdefault(client_id, []).append(connection)
+                connection.send_json({"type": "status", "data": {
+                    "status": {"exec_info": {"queue_remaining": len(fake.pending)}}, "sid": client_id}})
+                connection.serve()
+                fake.sockets[client_id].remove(connection)
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake ComfyUI server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--latency", type=float, default=2.0, help="seconds per render")
+    parser.add_argument("--steps", type=int, default=20, help="progress events per render")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--instances", type=int, default=1, help="servers on consecutive ports")
+    parser.add_argument("--response-delay", type=float, default=0.0, help="seconds added to every HTTP answer")
+    parser.add_argument("--step-latency", type=float, default=0.0, help="seconds per sampler step and megapixel")
+    parser.add_argument("--encode-latency", type=float, default=0.0, help="seconds per text encoder run")
+    parser.add_argument("--cache-lru", type=int, default=0, help="node results kept between prompts")
+    args = parser.parse_args()
+
+    fakes = []
+    for i in range(args.instances):
+        fake = FakeComfyUI(args.host, args.port + i, args.latency, args.steps, args.failure_rate,
+                           response_delay=args.response_delay, step_latency=args.step_latency,
+                           encode_latency=args.encode_latency, cache_size=args.cache_lru).start()
+        fakes.append(fake)
+        print(f"Fake ComfyUI listening on {fake.url}")
+    print("COMFYUI_SERVERS=" + ",".join(fake.host for fake in fakes))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for fake in fakes:
+            fake.stop()
+
+
+if __name__ == "__main__":
+    main()
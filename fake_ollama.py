@@ -0,0 +1,197 @@
+"""A small stand-in for Ollama's ``/api/generate``, for offline testing.
+
+It answers every prompt with a canned script about the requested topic, with
+as many panels as the prompt asks for, written at ``tokens_per_second``.
+Asked to continue a script, it writes only the panels named.
+Requests with a ``format`` get the panels as JSON instead. A
+``malformed_rate`` fraction of answers stop after the first panel, like a
+model that lost the thread. Streaming requests receive one NDJSON chunk per
+token, non-streaming ones wait for the whole script. At most ``parallel``
+generations run at once, like ``OLLAMA_NUM_PARALLEL``; the rest wait their
+turn. Only the standard library is used.
+
+Run it in place of Ollama with::
+
+    python fake_ollama.py --port 11434 --tokens-per-second 40
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT_TEMPLATE = (
+    "Panel 1: {topic}, wide establishing shot in bright daylight - \"Well, this is new.\"\n"
+    "Panel 2: close-up of the main character looking surprised about {topic} - \"Wait, what?\"\n"
+    "Panel 3: everything goes wrong around {topic}, action lines everywhere - \"Not again!\"\n"
+    "Panel 4: the characters laughing together at sunset - \"Same time tomorrow?\"\n"
+)
+PANEL_LINE = re.compile(r"Panel (\d+): (.*?) - (.*)")
+TOPIC_PATTERN = re.compile(r"comic strip script about: (.*?)\. (?:Please format|Answer in JSON|Write only)")
+COUNT_PATTERN = re.compile(r"(?:Generate a|Continue this) (\d+)-panel")
+MISSING_PATTERN = re.compile(r"Write only panels? ([\d, ]+?) of this same story")
+
+
+def tokenize(text):
+    """Splits text into word-sized tokens that join back to the same text."""
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+class FakeOllama:
+    """Serves canned scripts at a fixed token rate on a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0, tokens_per_second=40.0, parallel=1, template=SCRIPT_TEMPLATE,
+                 malformed_rate=0.0, seed=0):
+        self.tokens_per_second = tokens_per_second
+        self.template = template
+        self.malformed_rate = malformed_rate
+        self.random = random.Random(seed)
+        self.request_counts = Counter()
+        self.slots = threading.Semaphore(parallel)
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.host = f"{host}:{self.server.server_address[1]}"
+        self.url = f"http://{self.host}"
+
+    # --- Lifecycle ---
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- Generation ---
+
+    def script_for(self, prompt, structured=False):
+        match = TOPIC_PATTERN.search(prompt)
+        count = COUNT_PATTERN.search(prompt)
+        lines = self.template.format(topic=match.group(1) if match else prompt[:60]).splitlines()
+        # Repeat the template's panels until the strip is as long as asked
+        panels = [PANEL_LINE.match(line).groups()[1:] for line in lines if PANEL_LINE.match(line)]
+        panels = [panels[i % len(panels)] for i in range(int(count.group(1)) if count else len(panels))]
+        numbers = list(range(1, len(panels) + 1))
+        missing = MISSING_PATTERN.search(prompt)
+        if missing:
+            numbers = [int(n) for n in missing.group(1).split(",") if 0 < int(n) <= len(panels)]
+        if self.malformed_rate and self.random.random() < self.malformed_rate:
+            numbers = numbers[:1]
+        if structured:
+            return json.dumps({"panels": [{"prompt": panels[n - 1][0], "description": panels[n - 1][0].split(",")[0],
+                                           "text": panels[n - 1][1]} for n in numbers]}, indent=2)
+        return "".join(f"Panel {n}: {panels[n - 1][0]} - {panels[n - 1][1]}\n" for n in numbers)
+
+    def generate(self, prompt, structured=False):
+        """Yields the tokens of the answer to ``prompt`` at the configured rate."""
+        with self.slots:
+            delay = 1.0 / self.tokens_per_second if self.tokens_per_second else 0
+            next_token = time.perf_counter()
+            for token in tokenize(self.script_for(prompt, structured)):
+                next_token += delay
+                pause = next_token - time.perf_counter()
+                if pause > 0:
+                    time.sleep(pause)
+                yield token
+
+    # --- HTTP ---
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _chunk(self, body):
+                data = json.dumps(body).encode("utf-8") + b"\n"
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_GET(self):
+                fake.request_counts[self.path] += 1
+                if self.path == "/":
+                    self._reply(200, "Ollama is running")
+                elif self.path == "/api/tags":
+                    self._reply(200, {"models": [{"name": "comiccrafter:latest"}]})
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                fake.request_counts[self.path] += 1
+                try:
+                    payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    prompt = payload["prompt"]
+                except (ValueError, KeyError):
+                    self._reply(400, {"error": "invalid request"})
+                    return
+                if self.path != "/api/generate":
+                    self._reply(404, {"error": "not found"})
+                    return
+
+                model = payload.get("model", "")
+                structured = bool(payload.get("format"))
+                start = time.perf_counter()
+                if not payload.get("stream", True):
+                    tokens = list(fake.generate(prompt, structured))
+                    self._reply(200, {"model": model, "response": "".join(tokens), "done": True,
+                                      "eval_count": len(tokens),
+                                      "eval_duration": int((time.perf_counter() - start) * 1e9)})
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                count = 0
+                for token in fake.generate(prompt, structured):
+                    count += 1
+                    self._chunk({"model": model, "response": token, "done": False})
+                self._chunk({"model": model, "response": "", "done": True, "eval_count": count,
+                             "eval_duration": int((time.perf_counter() - start) * 1e9)})
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Ollama server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--parallel", type=int, default=1, help="generations served at once")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="fraction of scripts cut short")
+    args = parser.parse_args()
+
+    fake = FakeOllama(args.host, args.port, args.tokens_per_second, args.parallel,
+                      malformed_rate=args.malformed_rate).start()
+    print(f"Fake Ollama listening on {fake.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Persistent, content-addressed cache for rendered panel images.
+
+Images are keyed on a hash of the fully resolved ComfyUI workflow (prompts,
+seed, model, sampler, size, steps...), so an identical render is served from
+disk instead of the GPU. Each entry is the PNG file plus a small JSON sidecar
+with the original ComfyUI file metadata. Entries are hard-linked in from and
+out to the image store rather than read into memory. The cache is bounded in
+bytes and evicts the least recently used entries; recency is kept in the file
+mtimes so it survives restarts.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+import image_store
+
+
+def workflow_key(workflow):
+    """Returns the canonical SHA-256 hash of a workflow."""
+    canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """Size-bounded LRU image cache stored in ``directory``."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = None  # key -> [size, last_used], loaded on first use
+        self._lock = threading.Lock()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".png", base + ".json"
+
+    def _load_index(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if not name.endswith(".png"):
+                continue
+            key = name[:-4]
+            image_path, meta_path = self._paths(key)
+            try:
+                stat = os.stat(image_path)
+                size = stat.st_size + os.path.getsize(meta_path)
+            except OSError:
+                continue
+            self._entries[key] = [size, stat.st_mtime]
+
+    def get(self, key):
+        """Returns the cached image dict for ``key``, or None on a miss.
+
+        Its ``path`` is the cache's own file, which eviction may delete, so
+        callers link it elsewhere (``ImageStore.adopt``) before keeping it.
+        """
+        with self._lock:
+            self._load_index()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            image_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path, "r") as f:
+                    image = json.load(f)
+                image["path"] = image_path
+                now = time.time()
+                os.utime(image_path, (now, now))
+            except (OSError, ValueError):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries[key][1] = now
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        """Stores an image dict (its ``path`` plus ComfyUI file metadata)."""
+        meta = {k: v for k, v in image.items() if k != "path"}
+        with self._lock:
+            self._load_index()
+            image_path, meta_path = self._paths(key)
+            try:
+                # Write to temporary files first so readers never see half an entry
+                with open(meta_path + ".tmp", "w") as f:
+                    f.write(json.dumps(meta))
+                os.replace(meta_path + ".tmp", meta_path)
+                image_store.save_image(image, image_path)
+                size = os.path.getsize(image_path) + os.path.getsize(meta_path)
+            except OSError:
+                self._remove(key)
+                return
+            self._entries[key] = [size, time.time()]
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for size, _ in self._entries.values())
+        for key, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def purge(self):
+        """Deletes every cached image and resets the counters."""
+        with self._lock:
+            self._load_index()
+            for key in list(self._entries):
+                self._remove(key)
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns entry count, total bytes and hit/miss counters."""
+        with self._lock:
+            self._load_index()
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(size for size, _ in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(directory, max_bytes):
+    """Returns the shared cache for ``directory`` so counters outlive reruns."""
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = ImageCache(directory, max_bytes)
+        cache.max_bytes = max_bytes
+        return cache
@@ -0,0 +1,274 @@
+"""Spool directory for rendered panel images, so panels carry paths, not bytes.
+
+Images are streamed from ComfyUI's /view in chunks straight into a file, and
+a panel's image dict keeps ComfyUI's file metadata plus ``path``, ``size``
+and ``sha256`` instead of the PNG bytes. Pages show a small ``thumbnail``;
+the full-resolution file is only read when a strip is exported or a panel
+downloaded.
+
+Every spooled image belongs to a strip, and every strip to a session (a
+Streamlit session, a worker job, a batch run). Images downloaded inside a
+``strip`` block go to a new strip of that session; anything else goes to a
+strip of its own in the shared session. When a session goes over its quota,
+or the whole store over ``max_bytes``, the least recently used strips are
+deleted (never the one being written; ``touch`` marks a strip still on
+screen as used), and strips unused for ``max_age`` are deleted regardless.
+The index is rebuilt from the directory on first use, so the bounds hold
+across restarts.
+
+Pillow is optional. Without it thumbnails are the full images.
+"""
+import contextvars
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import lazy
+
+Image = lazy.module("PIL.Image", optional=True)  # pip install pillow
+
+DEFAULT_SESSION = "shared"
+THUMBNAIL_SIZE = 512  # Longest side of on-screen previews, in pixels
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_SUFFIX = ".thumb.jpg"
+CHUNK_SIZE = 64 * 1024
+
+_current_strip = contextvars.ContextVar("comiccrafter_strip", default=None)
+
+
+def session_name(session):
+    """Makes a session id safe to use as a directory name."""
+    return "".join(c for c in str(session) if c.isalnum() or c in "-_") or DEFAULT_SESSION
+
+
+@contextmanager
+def strip(session=DEFAULT_SESSION):
+    """Spools the images downloaded in the block into a new strip of ``session``."""
+    token = _current_strip.set((session_name(session), uuid.uuid4().hex))
+    try:
+        yield
+    finally:
+        _current_strip.reset(token)
+
+
+def file_digest(path):
+    """Returns the SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_image(image, path):
+    """Hard-links (or copies) an image's file to ``path``."""
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(image["path"], temp_path)
+    except OSError:
+        shutil.copyfile(image["path"], temp_path)  # Other file system, or no hard links
+    os.replace(temp_path, path)
+
+
+def read_image(image):
+    """Returns the full-resolution bytes of an image."""
+    with open(image["path"], "rb") as f:
+        return f.read()
+
+
+class ImageStore:
+    """Per-session, size-bounded spool of panel images in ``directory``."""
+
+    def __init__(self, directory, session_quota, max_bytes, max_age):
+        self.directory = directory
+        self.session_quota = session_quota
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._strips = None  # (session, strip) -> [bytes, last used], loaded on first use
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        if self._strips is not None:
+            return
+        self._strips = {}
+        os.makedirs(self.directory, exist_ok=True)
+        for session in os.listdir(self.directory):
+            session_dir = os.path.join(self.directory, session)
+            if not os.path.isdir(session_dir):
+                continue
+            for strip_id in os.listdir(session_dir):
+                strip_dir = os.path.join(session_dir, strip_id)
+                try:
+                    stats = [os.stat(os.path.join(strip_dir, name))
+                             for name in os.listdir(strip_dir)]
+                    last_used = os.stat(strip_dir).st_mtime
+                except OSError:
+                    continue
+                self._strips[(session, strip_id)] = [sum(s.st_size for s in stats), last_used]
+
+    def _strip_dir(self, key):
+        return os.path.join(self.directory, *key)
+
+    def _new_path(self, meta):
+        """Returns the current strip's key and a fresh file path in it."""
+        with self._lock:
+            self._load_index()  # Before the new file exists, so it is not counted twice
+        key = _current_strip.get() or (DEFAULT_SESSION, uuid.uuid4().hex)
+        strip_dir = self._strip_dir(key)
+        os.makedirs(strip_dir, exist_ok=True)
+        extension = os.path.splitext(meta.get("filename", ""))[1] or ".png"
+        return key, os.path.join(strip_dir, uuid.uuid4().hex + extension)
+
+    def _strip_of(self, path):
+        try:
+            relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.directory))
+        except ValueError:
+            return None  # Another drive on Windows
+        parts = relative.split(os.sep)
+        return (parts[0], parts[1]) if len(parts) == 3 and parts[0] != os.pardir else None
+
+    # --- Writing ---
+
+    def spool(self, chunks, meta):
+        """Writes an image arriving as ``chunks`` to the current strip and returns its dict."""
+        key, path = self._new_path(meta)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(path + ".tmp", "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            os.replace(path + ".tmp", path)
+        except BaseException:
+            try:
+                os.remove(path + ".tmp")
+            except OSError:
+                pass
+            raise
+        self._added(key, size)
+        return dict(meta, path=path, size=size, sha256=digest.hexdigest())
+
+    def adopt(self, image):
+        """Links an image kept elsewhere (e.g. in the image cache) into the current strip.
+
+        Returns the new image dict, or None if the file has gone away.
+        """
+        key, path = self._new_path(image)
+        try:
+            save_image(image, path)
+            size = os.path.getsize(path)
+            sha256 = image.get("sha256") or file_digest(path)
+        except OSError:
+            return None
+        self._added(key, size)
+        return dict(image, path=path, size=size, sha256=sha256)
+
+    def thumbnail(self, image, size=THUMBNAIL_SIZE):
+        """Returns the path of a downscaled JPEG of ``image``, writing it on first use."""
+        if Image is None:
+            return image["path"]
+        thumbnail_path = image["path"] + THUMBNAIL_SUFFIX
+        if not os.path.exists(thumbnail_path):
+            try:
+                with Image.open(image["path"]) as full:
+                    if max(full.size) <= size:
+                        return image["path"]  # Already small enough
+                    full.draft("RGB", (size, size))  # JPEG sources decode at a lower resolution
+                    preview = full.convert("RGB")
+                preview.thumbnail((size, size))
+                preview.save(thumbnail_path + ".tmp", "JPEG", quality=THUMBNAIL_QUALITY)
+                os.replace(thumbnail_path + ".tmp", thumbnail_path)
+            except OSError:
+                return image["path"]
+            key = self._strip_of(thumbnail_path)
+            if key is not None:
+                self._added(key, os.path.getsize(thumbnail_path))
+        return thumbnail_path
+
+    # --- Eviction ---
+
+    def _added(self, key, size):
+        with self._lock:
+            self._load_index()
+            entry = self._strips.setdefault(key, [0, time.time()])
+            entry[0] += size
+            entry[1] = time.time()
+            self._evict(keep=key)
+
+    def touch(self, images):
+        """Marks the strips holding ``images`` as used, so eviction takes other strips first."""
+        now = time.time()
+        with self._lock:
+            self._load_index()
+            for key in {self._strip_of(image["path"]) for image in images}:
+                if key in self._strips:
+                    self._strips[key][1] = now
+                    try:
+                        os.utime(self._strip_dir(key), (now, now))  # Survives a restart
+                    except OSError:
+                        pass
+
+    def _evict(self, keep):
+        now = time.time()
+        session_bytes = {}
+        for (session, _), (size, _) in self._strips.items():
+            session_bytes[session] = session_bytes.get(session, 0) + size
+        total = sum(session_bytes.values())
+        for key, (size, last_used) in sorted(self._strips.items(), key=lambda item: item[1][1]):
+            if key == keep:
+                continue
+            if (now - last_used > self.max_age or session_bytes[key[0]] > self.session_quota
+                    or total > self.max_bytes):
+                self._remove(key)
+                session_bytes[key[0]] -= size
+                total -= size
+
+    def _remove(self, key):
+        self._strips.pop(key, None)
+        shutil.rmtree(self._strip_dir(key), ignore_errors=True)
+        try:
+            os.rmdir(os.path.join(self.directory, key[0]))
+        except OSError:
+            pass  # The session still has other strips
+
+    def discard(self, session):
+        """Deletes every strip of ``session``, e.g. once a job has copied its panels out."""
+        session = session_name(session)
+        with self._lock:
+            self._load_index()
+            for key in [key for key in self._strips if key[0] == session]:
+                self._remove(key)
+
+    def stats(self):
+        """Returns session, strip and byte counts."""
+        with self._lock:
+            self._load_index()
+            return {
+                "sessions": len({session for session, _ in self._strips}),
+                "strips": len(self._strips),
+                "bytes": sum(size for size, _ in self._strips.values()),
+            }
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(directory, session_quota, max_bytes, max_age):
+    """Returns the shared store for ``directory`` so every rerun and thread sees one index."""
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is None:
+            store = _stores[directory] = ImageStore(directory, session_quota, max_bytes, max_age)
+        store.session_quota = session_quota
+        store.max_bytes = max_bytes
+        store.max_age = max_age
+        return store
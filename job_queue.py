@@ -0,0 +1,177 @@
+"""SQLite-backed job queue for comic strip generation.
+
+Streamlit sessions submit strips as jobs and poll for their results, while
+``comic_worker.py`` claims and renders them in a separate process, so a rerun,
+a browser refresh or a second user never aborts or duplicates work. Jobs are
+claimed highest priority first, then oldest first. Submitting a job identical
+to one that is still queued or running returns the existing job instead.
+Finished jobs are kept until ``expire`` deletes them.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    dedupe_key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, created);
+CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, status);
+"""
+
+
+def dedupe_key(payload):
+    """Returns the hash that identifies identical job payloads."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class JobQueue:
+    """Persistent priority queue of strip jobs in a SQLite file."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            yield db
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def submit(self, payload, priority=0):
+        """Queues a job and returns its id, reusing an identical in-flight job."""
+        key = dedupe_key(payload)
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id, priority FROM jobs WHERE dedupe_key = ? AND status IN (?, ?) ORDER BY created LIMIT 1",
+                (key, QUEUED, RUNNING),
+            ).fetchone()
+            if row is not None:
+                if priority > row["priority"]:
+                    db.execute("UPDATE jobs SET priority = ? WHERE id = ?", (priority, row["id"]))
+                db.execute("COMMIT")
+                return row["id"]
+            job_id = uuid.uuid4().hex
+            db.execute(
+                "INSERT INTO jobs (id, dedupe_key, payload, priority, status, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, key, json.dumps(payload), priority, QUEUED, time.time()),
+            )
+            db.execute("COMMIT")
+            return job_id
+
+    def claim(self, worker_id):
+        """Marks the next queued job as running for ``worker_id`` and returns it."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, created LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute(
+                "UPDATE jobs SET status = ?, started = ?, worker = ?, attempts = attempts + 1 WHERE id = ?",
+                (RUNNING, time.time(), worker_id, row["id"]),
+            )
+            db.execute("COMMIT")
+            return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def complete(self, job_id, result):
+        """Stores a job's result and marks it done."""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, finished = ?, result = ? WHERE id = ?",
+                (DONE, time.time(), json.dumps(result), job_id),
+            )
+
+    def fail(self, job_id, error):
+        """Marks a job as failed with an error message."""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?",
+                (FAILED, time.time(), str(error), job_id),
+            )
+
+    def requeue_stale(self, older_than):
+        """Puts running jobs started more than ``older_than`` seconds ago back in the queue."""
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND started < ?",
+                (QUEUED, RUNNING, time.time() - older_than),
+            )
+            return cursor.rowcount
+
+    def expire(self, older_than):
+        """Deletes done and failed jobs finished more than ``older_than`` seconds ago and returns their ids."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            cutoff = time.time() - older_than
+            ids = [row[0] for row in db.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND finished < ?", (DONE, FAILED, cutoff))]
+            db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished < ?", (DONE, FAILED, cutoff))
+            db.execute("COMMIT")
+            return ids
+
+    def get(self, job_id):
+        """Returns a job by id, or None."""
+        with self._connect() as db:
+            return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def position(self, job_id):
+        """Returns how many queued jobs will be claimed before ``job_id``."""
+        with self._connect() as db:
+            row = db.execute("SELECT priority, created FROM jobs WHERE id = ? AND status = ?",
+                             (job_id, QUEUED)).fetchone()
+            if row is None:
+                return 0
+            return db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority > ? OR (priority = ? AND created < ?))",
+                (QUEUED, row["priority"], row["priority"], row["created"]),
+            ).fetchone()[0]
+
+    def counts(self):
+        """Returns the number of jobs in each status."""
+        with self._connect() as db:
+            return {row[0]: row[1] for row in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")}
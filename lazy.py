@@ -0,0 +1,45 @@
+"""Modules imported on first use.
+
+``requests``, Pillow and websocket-client take longer to import than the
+rest of the pipeline together, yet a tool that only parses scripts or builds
+workflows never touches them. ``module`` returns a stand-in that imports the
+real module the first time one of its attributes is read, so importing
+``comic_core`` stays cheap and the cost is paid by the first request.
+"""
+import importlib
+import importlib.util
+import threading
+
+
+class LazyModule:
+    """Imports ``name`` when an attribute is first accessed."""
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def module(name, optional=False):
+    """Returns a lazily imported ``name``.
+
+    With ``optional`` set, returns None instead when the module is not
+    installed, so ``module is None`` checks keep working.
+    """
+    # Only the top-level package is looked up: finding a submodule would import its parent
+    if optional and importlib.util.find_spec(name.partition(".")[0]) is None:
+        return None
+    return LazyModule(name)
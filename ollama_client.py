@@ -0,0 +1,179 @@
+"""Script generation through Ollama's local HTTP API.
+
+Talking to ``/api/generate`` over a pooled keep-alive session avoids spawning
+``ollama run`` for every request, and the ``keep_alive`` field keeps the model
+loaded between strips. ``output_format`` is passed on as Ollama's ``format``
+field: "json", or a JSON schema the answer is constrained to. Finished scripts
+are memoised in a TTL cache keyed on (model, prompt, options, format), so
+asking for the same topic again is instant.
+Generated token counts and speed are reported to the current trace.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import lazy
+import tracing
+
+requests = lazy.module("requests")  # Imported by the first client
+
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434")
+DEFAULT_KEEP_ALIVE = "30m"  # How long Ollama keeps the model in memory after a request
+REQUEST_TIMEOUT = 300  # Seconds to wait for a full script
+SCRIPT_CACHE_TTL = 3600  # Seconds a generated script is reused
+SCRIPT_CACHE_SIZE = 256  # Maximum number of cached scripts
+
+
+class OllamaError(Exception):
+    """Raised when the Ollama HTTP API is unreachable or returns an error."""
+
+
+class TTLCache:
+    """Small thread-safe mapping whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def record_tokens(result):
+    """Reports the token count and speed from Ollama's final response object."""
+    tokens = result.get("eval_count")
+    if not tokens:
+        return
+    tracing.count("llm_tokens", tokens)
+    seconds = result.get("eval_duration", 0) / 1e9  # Reported in nanoseconds
+    tracing.annotate(tokens=tokens, tokens_per_second=tokens / seconds if seconds else None)
+
+
+def build_payload(model, prompt, stream, options=None, keep_alive=DEFAULT_KEEP_ALIVE, output_format=None):
+    """Returns the ``/api/generate`` request body."""
+    payload = {"model": model, "prompt": prompt, "stream": stream, "keep_alive": keep_alive}
+    if options:
+        payload["options"] = options
+    if output_format:
+        payload["format"] = output_format
+    return payload
+
+
+class OllamaClient:
+    """Keep-alive HTTP client for one Ollama server."""
+
+    def __init__(self, base_url=OLLAMA_URL, timeout=REQUEST_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def generate(self, model, prompt, options=None, keep_alive=DEFAULT_KEEP_ALIVE, output_format=None):
+        """Returns the complete response text for ``prompt``."""
+        payload = build_payload(model, prompt, False, options, keep_alive, output_format)
+        try:
+            response = self.session.post(f"{self.base_url}/api/generate", json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+            record_tokens(result)
+            return result["response"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            raise OllamaError(str(e)) from e
+
+    def stream(self, model, prompt, options=None, keep_alive=DEFAULT_KEEP_ALIVE, output_format=None):
+        """Yields the response text chunk by chunk as the model writes it."""
+        payload = build_payload(model, prompt, True, options, keep_alive, output_format)
+        try:
+            with self.session.post(f"{self.base_url}/api/generate", json=payload,
+                                   stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise OllamaError(chunk["error"])
+                    yield chunk.get("response", "")
+                    if chunk.get("done"):
+                        record_tokens(chunk)
+                        return
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise OllamaError(str(e)) from e
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+script_cache = TTLCache(SCRIPT_CACHE_TTL, SCRIPT_CACHE_SIZE)
+
+
+def get_client(base_url=OLLAMA_URL):
+    """Returns the shared client for ``base_url`` so its connections are reused."""
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            client = _clients[base_url] = OllamaClient(base_url)
+        return client
+
+
+def cache_key(model, prompt, options=None, output_format=None):
+    """Returns the script cache key for a generation request."""
+    return (model, prompt, json.dumps(options or {}, sort_keys=True), json.dumps(output_format, sort_keys=True))
+
+
+def generate(model, prompt, options=None, keep_alive=DEFAULT_KEEP_ALIVE, use_cache=True, base_url=None,
+             output_format=None):
+    """Generates a script, serving repeated requests from the TTL cache."""
+    key = cache_key(model, prompt, options, output_format)
+    if use_cache:
+        cached = script_cache.get(key)
+        tracing.count("script_cache_hits" if cached is not None else "script_cache_misses")
+        if cached is not None:
+            return cached
+    text = get_client(base_url or OLLAMA_URL).generate(model, prompt, options, keep_alive, output_format)
+    script_cache.put(key, text)
+    return text
+
+
+def stream(model, prompt, options=None, keep_alive=DEFAULT_KEEP_ALIVE, use_cache=True, base_url=None,
+           output_format=None):
+    """Streams a script, caching it once complete; cached scripts arrive in one chunk."""
+    key = cache_key(model, prompt, options, output_format)
+    if use_cache:
+        cached = script_cache.get(key)
+        tracing.count("script_cache_hits" if cached is not None else "script_cache_misses")
+        if cached is not None:
+            yield cached
+            return
+    chunks = []
+    for chunk in get_client(base_url or OLLAMA_URL).stream(model, prompt, options, keep_alive, output_format):
+        chunks.append(chunk)
+        yield chunk
+    script_cache.put(key, "".join(chunks))
@@ -0,0 +1,173 @@
+"""Composites generated panels into a single downloadable strip.
+
+The panel images, their borders and the dialogue boxes under them are laid
+out on one canvas with Pillow (every paste and fill runs in C over whole
+regions) and encoded once as PNG, WebP, JPEG or PDF. Encoded strips are kept
+in a small in-memory LRU keyed on the panel images' hashes, dialogue, layout
+and format, so Streamlit reruns serve the same bytes without compositing or
+encoding again.
+
+Pillow is optional. Without it ``available()`` is False and the app only
+offers the individual panel downloads.
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import lazy
+
+# pip install pillow; imported on the first export rather than with the app
+Image = lazy.module("PIL.Image", optional=True)
+ImageDraw = lazy.module("PIL.ImageDraw")
+ImageFont = lazy.module("PIL.ImageFont")
+
+FORMATS = {
+    "PNG": "image/png",
+    "WebP": "image/webp",
+    "JPEG": "image/jpeg",
+    "PDF": "application/pdf",
+}
+EXTENSIONS = {"PNG": "png", "WebP": "webp", "JPEG": "jpg", "PDF": "pdf"}
+COLUMNS = 4  # Panels per row, as in the app
+MARGIN = 5  # Pixels around every panel
+TEXT_PADDING = 10  # Pixels between the dialogue box border and its text
+FONT_SIZE = 16
+FONT_NAMES = ("comic.ttf", "ComicNeue-Regular.ttf", "DejaVuSans.ttf", "Arial.ttf")
+CACHE_SIZE = 16  # Encoded strips kept in memory
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_font = None
+
+
+def available():
+    """Returns True if Pillow is installed and strips can be exported."""
+    return Image is not None
+
+
+def load_font():
+    """Returns the first installed font of ``FONT_NAMES``, or Pillow's default."""
+    global _font
+    if _font is None:
+        for name in FONT_NAMES:
+            try:
+                _font = ImageFont.truetype(name, FONT_SIZE)
+                break
+            except OSError:
+                continue
+        else:
+            _font = ImageFont.load_default()
+    return _font
+
+
+def wrap_text(draw, text, font, width):
+    """Splits ``text`` into lines no wider than ``width`` pixels."""
+    lines = []
+    for paragraph in text.splitlines() or [""]:
+        line = ""
+        for word in paragraph.split():
+            candidate = f"{line} {word}" if line else word
+            if line and draw.textlength(candidate, font=font) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def compose_strip(panels, border_width=2, border_color="#000000", text_height=100, columns=COLUMNS):
+    """Lays out the panels and their dialogue on one RGB image."""
+    images = [Image.open(panel["image"]["path"]).convert("RGB") for panel in panels]
+    cell_width = images[0].width
+    images = [
+        image if image.width == cell_width
+        else image.resize((cell_width, round(image.height * cell_width / image.width)), Image.LANCZOS)
+        for image in images
+    ]
+    columns = min(columns, len(images))
+    rows = (len(images) + columns - 1) // columns
+
+    font = load_font()
+    measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    line_height = font.getbbox("Ag")[3] + 4
+    text_width = cell_width - 2 * TEXT_PADDING
+    dialogue = [wrap_text(measure, panel["dialogue"], font, text_width) for panel in panels]
+
+    # Every row is as tall as its tallest image and longest dialogue
+    image_heights = [max(image.height for image in images[r * columns:(r + 1) * columns]) for r in range(rows)]
+    text_heights = [
+        max([text_height] + [len(lines) * line_height + 2 * TEXT_PADDING
+                             for lines in dialogue[r * columns:(r + 1) * columns]])
+        for r in range(rows)
+    ]
+    cell_outer_width = cell_width + 2 * border_width + 2 * MARGIN
+    row_outer_heights = [h + t + 3 * border_width + 2 * MARGIN for h, t in zip(image_heights, text_heights)]
+
+    canvas = Image.new("RGB", (columns * cell_outer_width, sum(row_outer_heights)), "white")
+    draw = ImageDraw.Draw(canvas)
+    y = 0
+    for r in range(rows):
+        for c, (image, lines) in enumerate(zip(images[r * columns:(r + 1) * columns],
+                                               dialogue[r * columns:(r + 1) * columns])):
+            x = c * cell_outer_width + MARGIN
+            top = y + MARGIN
+            image_bottom = top + border_width + image_heights[r]
+            box_bottom = image_bottom + border_width + text_heights[r]
+            # One border-coloured block, then the image and the white text box inset into it
+            draw.rectangle((x, top, x + cell_width + 2 * border_width - 1, box_bottom + border_width - 1),
+                           fill=border_color)
+            draw.rectangle((x + border_width, top + border_width, x + border_width + cell_width - 1,
+                            image_bottom - 1), fill="white")
+            canvas.paste(image, (x + border_width, top + border_width))
+            draw.rectangle((x + border_width, image_bottom + border_width, x + border_width + cell_width - 1,
+                            box_bottom - 1), fill="white")
+            for i, line in enumerate(lines):
+                draw.text((x + border_width + TEXT_PADDING,
+                           image_bottom + border_width + TEXT_PADDING + i * line_height),
+                          line, fill="black", font=font)
+        y += row_outer_heights[r]
+    return canvas
+
+
+def encode(image, fmt="PNG", quality=90):
+    """Encodes a composited strip as ``fmt`` (a key of ``FORMATS``)."""
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    elif fmt == "WebP":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    elif fmt == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    elif fmt == "PDF":
+        image.save(buffer, format="PDF", resolution=96.0)
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    return buffer.getvalue()
+
+
+def strip_key(panels, border_width, border_color, text_height, fmt, quality):
+    """Returns the cache key of an exported strip."""
+    digest = hashlib.sha256()
+    for panel in panels:
+        digest.update(bytes.fromhex(panel["image"]["sha256"]))
+        digest.update(panel["dialogue"].encode("utf-8") + b"\0")
+    digest.update(f"{border_width}|{border_color}|{text_height}|{fmt}|{quality}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def export_strip(panels, fmt="PNG", quality=90, border_width=2, border_color="#000000", text_height=100):
+    """Returns the encoded strip, compositing it only if it is not cached."""
+    key = strip_key(panels, border_width, border_color, text_height, fmt, quality)
+    with _cache_lock:
+        data = _cache.get(key)
+        if data is not None:
+            _cache.move_to_end(key)
+            return data
+    data = encode(compose_strip(panels, border_width, border_color, text_height), fmt, quality)
+    with _cache_lock:
+        _cache[key] = data
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return data
@@ -0,0 +1,33 @@
+"""Checks that identical background requests share one job."""
+import os
+import tempfile
+import unittest
+
+import comic_worker
+import job_queue
+
+
+class DedupeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.jobs = job_queue.JobQueue(os.path.join(self.directory.name, "jobs.sqlite3"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def payload(self, seed=0):
+        config = {"width": 512, "height": 512, "steps": 20, "cfg": 7.0, "seed": seed,
+                  "sampler": "euler", "scheduler": "normal"}
+        return {"topic": "a cat who learns to skateboard", "config": config, "panel_count": 4}
+
+    def test_random_seed_requests_share_a_job(self):
+        first = self.jobs.submit(self.payload())
+        self.assertEqual(self.jobs.submit(self.payload()), first)
+
+    def test_worker_picks_the_random_seed(self):
+        self.assertNotEqual(comic_worker.job_config(self.payload())["seed"], 0)
+        self.assertEqual(comic_worker.job_config(self.payload(42))["seed"], 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+"""Per-strip traces and pipeline metrics.
+
+Every strip runs inside a ``trace``; the stages it goes through (script
+writing, parsing, prompt submission, the ComfyUI queue wait and sampling,
+image downloads) are recorded as ``span``s on it, along with counters such as
+cache hits and downloaded bytes. Each finished span also feeds a per-stage
+latency histogram, and counters are summed process-wide, so a long-running
+app or worker can be scraped as a Prometheus target.
+
+The current trace lives in a context variable. Work handed to other threads
+is wrapped with ``bind`` so its spans land on the right strip.
+
+Finished traces are kept in memory (``recent``), appended as JSON lines to
+``COMICCRAFTER_TRACE_FILE`` when it is set, and served with the metrics by
+``start_server`` (on ``COMICCRAFTER_METRICS_PORT`` in the app). Set
+``COMICCRAFTER_TRACING=0`` (or ``tracing.enabled = False``) to turn
+everything into no-ops.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+enabled = os.environ.get("COMICCRAFTER_TRACING", "1") != "0"
+TRACE_FILE = os.environ.get("COMICCRAFTER_TRACE_FILE")  # JSON lines export of finished traces
+METRICS_PORT = int(os.environ.get("COMICCRAFTER_METRICS_PORT", "0"))  # 0 leaves the endpoint off
+RECENT_TRACES = 50  # Finished traces kept in memory
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+METRIC_PREFIX = "comiccrafter"
+
+
+class Span:
+    """One timed stage of a strip."""
+
+    def __init__(self, name, attrs, start=None):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time() if start is None else start
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def as_dict(self):
+        return {"name": self.name, "start": self.start, "duration": self.duration, **self.attrs}
+
+
+class Trace:
+    """The spans and counters of one strip."""
+
+    def __init__(self, name, attrs):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def as_dict(self):
+        with self._lock:
+            spans = [span.as_dict() for span in self.spans]
+            counters = dict(self.counters)
+        return {"trace_id": self.id, "name": self.name, "start": self.start,
+                "duration": self.duration, **self.attrs, "counters": counters, "spans": spans}
+
+
+class NoopSpan:
+    """Stands in for spans and traces while tracing is off."""
+
+    def set(self, **attrs):
+        pass
+
+
+NOOP = NoopSpan()
+
+
+class Metrics:
+    """Process-wide stage histograms and counters."""
+
+    def __init__(self):
+        self.histograms = {}  # stage -> [count, sum, bucket counts]
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0, 0.0, [0] * len(STAGE_BUCKETS)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if seconds <= bound:
+                    histogram[2][i] += 1
+                    break
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {stage: (h[0], h[1], list(h[2])) for stage, h in self.histograms.items()}
+            return histograms, dict(self.counters)
+
+    def prometheus(self):
+        """Renders the metrics in the Prometheus text exposition format."""
+        histograms, counters = self.snapshot()
+        lines = [f"# TYPE {METRIC_PREFIX}_stage_seconds histogram"]
+        for stage, (count, total, buckets) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(STAGE_BUCKETS, buckets):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} '
+                             f'{cumulative}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+            lines.append(f"{METRIC_PREFIX}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+recent = deque(maxlen=RECENT_TRACES)
+_export_lock = threading.Lock()
+_current_trace = contextvars.ContextVar("comiccrafter_trace", default=None)
+_current_span = contextvars.ContextVar("comiccrafter_span", default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def trace(name, counter, **attrs):
+    """Runs the block as a new trace, exporting it when the block ends.
+
+    Each finished trace adds one to the ``counter`` metric, e.g. "strips".
+    """
+    if not enabled:
+        yield NOOP
+        return
+    current = Trace(name, attrs)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=str(e) or type(e).__name__)
+        raise
+    finally:
+        _current_trace.reset(token)
+        current.duration = time.time() - current.start
+        metrics.observe(name, current.duration)
+        metrics.count(counter)
+        finish(current)
+
+
+def finish(finished):
+    """Keeps a finished trace in memory and appends it to ``TRACE_FILE``."""
+    recent.append(finished)
+    if TRACE_FILE:
+        line = json.dumps(finished.as_dict(), default=str)
+        with _export_lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the block as a stage of the current trace."""
+    if not enabled:
+        yield NOOP
+        return
+    current = Span(name, attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=str(e) or type(e).__name__)
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            pass  # A generator holding the span was closed from another context
+        current.duration = time.time() - current.start
+        metrics.observe(name, current.duration)
+        parent = _current_trace.get()
+        if parent is not None:
+            parent.add(current)
+
+
+def record(name, start, end, **attrs):
+    """Adds a stage measured elsewhere, such as ComfyUI's own timestamps."""
+    if not enabled:
+        return
+    recorded = Span(name, attrs, start)
+    recorded.duration = max(0.0, end - start)
+    metrics.observe(name, recorded.duration)
+    parent = _current_trace.get()
+    if parent is not None:
+        parent.add(recorded)
+
+
+def annotate(**attrs):
+    """Adds attributes to the innermost open span."""
+    if enabled:
+        current = _current_span.get()
+        if current is not None:
+            current.set(**attrs)
+
+
+def count(name, value=1):
+    """Adds to a counter, both process-wide and on the current trace."""
+    if not enabled:
+        return
+    metrics.count(name, value)
+    parent = _current_trace.get()
+    if parent is not None:
+        parent.count(name, value)
+
+
+def bind(fn):
+    """Wraps ``fn`` to run in a copy of the caller's context, e.g. on another thread."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def recent_traces():
+    """Returns the finished traces kept in memory as dicts, oldest first."""
+    return [finished.as_dict() for finished in list(recent)]
+
+
+# --- Metrics Endpoint ---
+
+def make_handler():
+    """Returns the request handler serving /metrics (Prometheus text) and /traces (JSON lines).
+
+    ``http.server`` is only imported here, when metrics are actually served.
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                body, content_type = metrics.prometheus(), "text/plain; version=0.0.4"
+            elif path == "/traces":
+                body = "".join(json.dumps(t, default=str) + "\n" for t in recent_traces())
+                content_type = "application/x-ndjson"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return MetricsHandler
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def start_server(port, host="127.0.0.1"):
+    """Serves the metrics endpoint on a background thread, once per address."""
+    with _servers_lock:
+        server = _servers.get((host, port))
+        if server is None:
+            from http.server import ThreadingHTTPServer
+
+            server = _servers[(host, port)] = ThreadingHTTPServer((host, port), make_handler())
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
@@ -0,0 +1,247 @@
+"""Compiled ComfyUI workflow templates.
+
+A workflow is analysed once: starting from every sampler node, its
+``positive``, ``negative``, ``latent_image`` and ``model`` links are traced
+upstream to the text encoders, empty latent and model loader that feed it.
+Those nodes are the only slots a panel changes, so each panel's workflow is a
+shallow copy of the graph in which just the patched nodes are replaced. The
+template itself is never modified.
+
+Workflows produced by ``apply`` share their unpatched nodes with the template
+and must be treated as read-only. Their cache key is the template's hash plus
+the patched values, so large graphs are not serialised again per panel.
+
+``refine`` turns a panel's workflow into an img2img pass: the sampler starts
+from an uploaded image, scaled to the latent size and encoded with the VAE the
+workflow decodes with, instead of from an empty latent.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import image_cache
+
+SAMPLER_TYPES = ("KSampler", "KSamplerAdvanced")
+TEXT_INPUTS = ("text", "clip_l", "t5xxl", "text_g", "text_l")  # Prompt fields of the common encoders
+MODEL_INPUTS = ("ckpt_name", "unet_name")
+LATENT_TYPES = ("Empty Latent Image", "EmptyLatentImage", "EmptySD3LatentImage")
+DECODE_TYPES = ("VAEDecode", "VAEDecodeTiled")
+REFINE_PREFIX = "refine_"  # Node ids of the nodes ``refine`` adds
+TEMPLATE_CACHE_SIZE = 8
+
+
+def is_node_link(value):
+    """Checks whether a workflow input is a [node_id, output_index] link."""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+def is_prompt_node(node):
+    """Checks whether a node encodes a text prompt."""
+    return any(isinstance(node.get("inputs", {}).get(name), str) for name in TEXT_INPUTS)
+
+
+def upstream(workflow, node_ids):
+    """Returns ``node_ids`` and every node they read from, i.e. what ComfyUI runs to produce them."""
+    found = set()
+    stack = list(node_ids)
+    while stack:
+        node_id = stack.pop()
+        if node_id in found or node_id not in workflow:
+            continue
+        found.add(node_id)
+        stack.extend(value[0] for value in workflow[node_id].get("inputs", {}).values() if is_node_link(value))
+    return found
+
+
+class WorkflowTemplate:
+    """The prompt, sampler, latent and model slots of a workflow."""
+
+    def __init__(self, workflow, key=None):
+        self.workflow = workflow
+        self.samplers = [node_id for node_id, node in workflow.items() if node.get("class_type") in SAMPLER_TYPES]
+        self.positive = self._trace("positive", self._is_prompt)
+        self.negative = [node_id for node_id in self._trace("negative", self._is_prompt)
+                         if node_id not in self.positive]
+        self.latents = self._trace("latent_image", self._is_latent) or [
+            node_id for node_id, node in workflow.items() if node.get("class_type") in LATENT_TYPES]
+        self.models = self._trace("model", self._is_model) or [
+            node_id for node_id, node in workflow.items()
+            if any(name in node.get("inputs", {}) for name in MODEL_INPUTS)]
+        if not self.samplers:
+            self._guess_prompts()
+        self.vae = self._find_vae()
+        self.key = key or image_cache.workflow_key(workflow)
+
+    # --- Analysis ---
+
+    def _inputs(self, node_id):
+        return self.workflow.get(node_id, {}).get("inputs", {})
+
+    def _is_prompt(self, node_id):
+        return is_prompt_node(self.workflow.get(node_id, {}))
+
+    def _is_latent(self, node_id):
+        inputs = self._inputs(node_id)
+        return "width" in inputs and "height" in inputs and not any(is_node_link(v) for v in inputs.values())
+
+    def _is_model(self, node_id):
+        return any(name in self._inputs(node_id) for name in MODEL_INPUTS)
+
+    def _trace(self, input_name, is_target):
+        """Walks upstream from the samplers' ``input_name`` links to the nodes matching ``is_target``."""
+        found = []
+        seen = set()
+        stack = [self._inputs(s)[input_name][0] for s in self.samplers if is_node_link(self._inputs(s).get(input_name))]
+        while stack:
+            node_id = stack.pop()
+            if node_id in seen or node_id not in self.workflow:
+                continue
+            seen.add(node_id)
+            if is_target(node_id):
+                found.append(node_id)
+                continue
+            stack.extend(value[0] for value in self._inputs(node_id).values() if is_node_link(value))
+        return sorted(found)
+
+    def _find_vae(self):
+        """Returns the VAE link of the decoder fed by a sampler, or None."""
+        for node in self.workflow.values():
+            inputs = node.get("inputs", {})
+            samples = inputs.get("samples")
+            if node.get("class_type") in DECODE_TYPES and is_node_link(samples) and samples[0] in self.samplers \
+                    and is_node_link(inputs.get("vae")):
+                return inputs["vae"]
+        return None
+
+    @property
+    def can_refine(self):
+        """Whether ``refine`` can start this workflow's samplers from an image."""
+        return bool(self.vae and self.samplers and self.latents) and all(
+            self.workflow[s].get("class_type") == "KSampler" and is_node_link(self._inputs(s).get("latent_image"))
+            for s in self.samplers)
+
+    def _guess_prompts(self):
+        """Falls back to the old naming heuristics for graphs without a sampler."""
+        for node_id, node in self.workflow.items():
+            if not self._is_prompt(node_id):
+                continue
+            if "neg" in node_id.lower() or "ugly" in node["inputs"].get("text", "").lower():
+                self.negative.append(node_id)
+            else:
+                self.positive.append(node_id)
+
+    # --- Panel workflows ---
+
+    def patches(self, positive_prompt, negative_prompt=None, settings=None):
+        """Returns {node_id: {input: value}} for one panel.
+
+        ``settings`` may hold ``width``, ``height``, ``steps``, ``cfg``,
+        ``seed``, ``sampler``, ``scheduler`` and ``model_path``.
+        """
+        settings = settings or {}
+        patches = {}
+
+        def patch(node_id, name, value):
+            patches.setdefault(node_id, {})[name] = value
+
+        for node_id in self.positive:
+            for name in TEXT_INPUTS:
+                if isinstance(self._inputs(node_id).get(name), str):
+                    patch(node_id, name, positive_prompt)
+        if negative_prompt:
+            for node_id in self.negative:
+                for name in TEXT_INPUTS:
+                    if isinstance(self._inputs(node_id).get(name), str):
+                        patch(node_id, name, negative_prompt)
+        for node_id in self.latents:
+            for name in ("width", "height"):
+                if name in settings:
+                    patch(node_id, name, settings[name])
+        for node_id in self.samplers:
+            seed_input = "noise_seed" if "noise_seed" in self._inputs(node_id) else "seed"
+            for name, setting in (("steps", "steps"), ("cfg", "cfg"), (seed_input, "seed"),
+                                  ("sampler_name", "sampler"), ("scheduler", "scheduler")):
+                if setting in settings:
+                    patch(node_id, name, settings[setting])
+        if "model_path" in settings:
+            for node_id in self.models:
+                name = next(n for n in MODEL_INPUTS if n in self._inputs(node_id))
+                patch(node_id, name, settings["model_path"])
+        return patches
+
+    def apply(self, patches):
+        """Returns a copy of the workflow with ``patches`` applied, sharing unpatched nodes."""
+        workflow = dict(self.workflow)
+        for node_id, values in patches.items():
+            node = workflow[node_id]
+            workflow[node_id] = dict(node, inputs=dict(node["inputs"], **values))
+        return workflow
+
+    def cache_key(self, patches):
+        """Returns the image cache key of the workflow ``apply(patches)`` would build."""
+        canonical = json.dumps(patches, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(f"{self.key}:{canonical}".encode("utf-8")).hexdigest()
+
+    def render(self, positive_prompt, negative_prompt=None, settings=None):
+        """Returns (workflow, cache key) for one panel."""
+        patches = self.patches(positive_prompt, negative_prompt, settings)
+        return self.apply(patches), self.cache_key(patches)
+
+    def refine(self, workflow, image_name, denoise):
+        """Returns a copy of a panel workflow that samples from the uploaded ``image_name``.
+
+        The image is scaled to the workflow's latent size, so a small preview
+        becomes a full-size panel, and ``denoise`` sets how much of it is
+        redrawn. Only valid when ``can_refine`` is true.
+        """
+        size = workflow[self.latents[0]]["inputs"]
+        workflow = dict(workflow)
+        workflow[REFINE_PREFIX + "load"] = {"class_type": "LoadImage", "inputs": {"image": image_name}}
+        workflow[REFINE_PREFIX + "scale"] = {"class_type": "ImageScale", "inputs": {
+            "image": [REFINE_PREFIX + "load", 0], "upscale_method": "lanczos", "crop": "disabled",
+            "width": size["width"], "height": size["height"]}}
+        workflow[REFINE_PREFIX + "encode"] = {"class_type": "VAEEncode", "inputs": {
+            "pixels": [REFINE_PREFIX + "scale", 0], "vae": self.vae}}
+        for node_id in self.samplers:
+            node = workflow[node_id]
+            workflow[node_id] = dict(node, inputs=dict(node["inputs"], latent_image=[REFINE_PREFIX + "encode", 0],
+                                                       denoise=denoise))
+        return workflow  # The empty latent is left unused, so ComfyUI skips it
+
+
+_templates = OrderedDict()  # workflow hash -> template
+_workflow_keys = OrderedDict()  # id(workflow) -> (workflow, hash), so a workflow seen before is not hashed again
+_templates_lock = threading.Lock()
+
+
+def get_template(workflow):
+    """Returns the compiled template of ``workflow``, compiling it on first use.
+
+    Templates are remembered by the workflow's content, so a workflow loaded
+    again (e.g. on every app rerun) finds the template of an equal one. The
+    hash is remembered per workflow object, so a workflow must not be
+    modified once it has been compiled; load a new one instead.
+    """
+    with _templates_lock:
+        entry = _workflow_keys.get(id(workflow))
+        key = entry[1] if entry is not None and entry[0] is workflow else None
+        if key in _templates:
+            _templates.move_to_end(key)
+            return _templates[key]
+    if key is None:
+        key = image_cache.workflow_key(workflow)
+    with _templates_lock:
+        _workflow_keys[id(workflow)] = (workflow, key)
+        while len(_workflow_keys) > TEMPLATE_CACHE_SIZE * 4:
+            _workflow_keys.popitem(last=False)
+        template = _templates.get(key)
+        if template is not None:
+            _templates.move_to_end(key)
+            return template
+    template = WorkflowTemplate(workflow, key)
+    with _templates_lock:
+        template = _templates.setdefault(key, template)
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template